@@ -0,0 +1,74 @@
+# file: api_batch.py
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Awaitable
+
+import metrics
+
+background_tasks_gauge = metrics.gauge("api_background_tasks", "Фоновых вызовов Bot API в работе")
+background_errors = metrics.counter("api_background_errors_total", "Ошибок фоновых вызовов Bot API")
+
+# Ссылки на фоновые задачи, чтобы сборщик мусора не уничтожил их до завершения
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _await(call: Awaitable):
+    # Методы aiogram (call.answer() и т.п.) - awaitable-объекты, а не корутины; оборачиваем их
+    return await call
+
+
+def _on_background_done(task: asyncio.Task, description: str):
+    _background_tasks.discard(task)
+    background_tasks_gauge.set(len(_background_tasks))
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        background_errors.inc()
+        logging.warning(f"Фоновый вызов '{description}' завершился ошибкой: {error}")
+
+
+def fire_and_forget(call: Awaitable, description: str) -> asyncio.Task:
+    """
+    Запускает вызов в фоне, не дожидаясь результата (например, удаление старых сообщений).
+    Ошибки только логируются.
+    """
+    task = asyncio.create_task(_await(call))
+    _background_tasks.add(task)
+    background_tasks_gauge.set(len(_background_tasks))
+    task.add_done_callback(lambda t: _on_background_done(t, description))
+    return task
+
+
+async def run_parallel(*calls: Awaitable, return_exceptions: bool = False) -> list:
+    """
+    Независимые вызовы выполняются одновременно; первая ошибка пробрасывается, как при обычном await.
+    return_exceptions=True - ошибки возвращаются на месте результатов, остальные вызовы не прерываются.
+    """
+    return await asyncio.gather(*(_await(call) for call in calls), return_exceptions=return_exceptions)
+
+
+class StepTimer:
+    """Замер длительности шагов обработчика. Итог пишется в лог одной строкой"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.steps: list[tuple[str, float]] = []
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - started))
+
+    def total(self) -> float:
+        return time.perf_counter() - self._started
+
+    def log(self):
+        parts = ", ".join(f"{name}={duration * 1000:.0f}мс" for name, duration in self.steps)
+        logging.info(f"{self.name}: {parts}, всего={self.total() * 1000:.0f}мс")
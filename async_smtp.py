@@ -0,0 +1,303 @@
+# file: async_smtp.py
+import asyncio
+import base64
+import logging
+import smtplib
+import ssl
+import time
+from collections import deque
+
+from email_stream import StreamingEmail
+# Метрики общие с пулом на потоках: какой бы клиент ни был выбран, счетчики одни и те же
+from smtp_pool import (connections_opened, connections_closed, reconnects, messages_sent,
+                       keepalive_noops, connections_idle, connections_in_use)
+
+
+class AsyncSMTPConnection:
+    """
+    SMTP-клиент на asyncio streams: SSL или STARTTLS, AUTH PLAIN/LOGIN, PIPELINING.
+    Исключения - из smtplib, чтобы очередь доставки одинаково различала временные и постоянные отказы.
+    """
+
+    def __init__(self, host: str, port: int, security: str = "ssl", timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.security = security
+        self.timeout = timeout
+        self.extensions: dict[str, str] = {}
+        # Сервер принял DATA последнего письма: после этого разрыв не значит, что письмо не доставлено
+        self.data_accepted = False
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    # --- Протокол ---
+    async def _read_reply(self) -> tuple[int, bytes]:
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self._reader.readline(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise smtplib.SMTPServerDisconnected(f"Нет ответа SMTP-сервера за {self.timeout} с")
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Соединение закрыто SMTP-сервером")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                self.close()
+                raise smtplib.SMTPResponseException(-1, line)
+            lines.append(line[4:].rstrip(b"\r\n"))
+            # "250-..." - продолжение многострочного ответа, "250 ..." - последняя строка
+            if line[3:4] != b"-":
+                return code, b"\n".join(lines)
+
+    async def _write(self, data: bytes):
+        self._writer.write(data)
+        try:
+            await asyncio.wait_for(self._writer.drain(), timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.close()
+            raise smtplib.SMTPServerDisconnected("Соединение разорвано во время передачи")
+
+    async def command(self, line: str) -> tuple[int, bytes]:
+        if self._writer is None:
+            raise smtplib.SMTPServerDisconnected("Нет соединения с SMTP-сервером")
+        await self._write(line.encode("utf-8") + b"\r\n")
+        return await self._read_reply()
+
+    async def _ehlo(self):
+        code, resp = await self.command("EHLO localhost")
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, resp)
+        self.extensions = {}
+        for line in resp.decode("utf-8", errors="replace").split("\n")[1:]:
+            name, _, params = line.partition(" ")
+            self.extensions[name.lower()] = params
+
+    async def connect(self):
+        context = ssl.create_default_context()
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=context if self.security == "ssl" else None),
+                timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise smtplib.SMTPConnectError(-1, f"Не удалось подключиться к {self.host}:{self.port}".encode())
+        code, resp = await self._read_reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, resp)
+        await self._ehlo()
+        if self.security == "starttls":
+            if "starttls" not in self.extensions:
+                raise smtplib.SMTPNotSupportedError("Сервер не поддерживает STARTTLS")
+            code, resp = await self.command("STARTTLS")
+            if code != 220:
+                raise smtplib.SMTPResponseException(code, resp)
+            await asyncio.wait_for(self._writer.start_tls(context, server_hostname=self.host), timeout=self.timeout)
+            await self._ehlo()
+
+    async def login(self, username: str, password: str):
+        methods = self.extensions.get("auth", "").upper().split()
+        if "PLAIN" in methods:
+            token = base64.b64encode(f"\0{username}\0{password}".encode("utf-8")).decode("ascii")
+            code, resp = await self.command(f"AUTH PLAIN {token}")
+        else:
+            code, resp = await self.command("AUTH LOGIN")
+            if code == 334:
+                code, resp = await self.command(base64.b64encode(username.encode("utf-8")).decode("ascii"))
+            if code == 334:
+                code, resp = await self.command(base64.b64encode(password.encode("utf-8")).decode("ascii"))
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def send_streaming(self, message: StreamingEmail):
+        """MAIL FROM / RCPT TO / DATA (одним пакетом, если сервер поддерживает PIPELINING), тело - чанками"""
+        self.data_accepted = False
+        commands = [f"MAIL FROM:<{message.sender}>", f"RCPT TO:<{message.recipient}>", "DATA"]
+        if "pipelining" in self.extensions:
+            await self._write("".join(f"{line}\r\n" for line in commands).encode("utf-8"))
+            replies = [await self._read_reply() for _ in commands]
+        else:
+            replies = []
+            for line in commands:
+                replies.append(await self.command(line))
+                if replies[-1][0] >= 400:
+                    break
+
+        (mail_code, mail_resp), *rest = replies
+        if mail_code != 250:
+            await self._reset(data_started=len(replies) == 3 and replies[2][0] == 354)
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, message.sender)
+        rcpt_code, rcpt_resp = rest[0]
+        if rcpt_code not in (250, 251):
+            await self._reset(data_started=len(replies) == 3 and replies[2][0] == 354)
+            raise smtplib.SMTPRecipientsRefused({message.recipient: (rcpt_code, rcpt_resp)})
+        data_code, data_resp = rest[1]
+        if data_code != 354:
+            await self._reset()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        self.data_accepted = True
+        for chunk in message.iter_data():
+            await self._write(chunk)
+        await self._write(b".\r\n")
+        code, resp = await self._read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    async def _reset(self, data_started: bool = False):
+        # Если сервер все же принял DATA, завершаем пустое письмо, чтобы вернуться в командный режим
+        if data_started:
+            await self._write(b".\r\n")
+            await self._read_reply()
+        await self.command("RSET")
+
+    async def noop(self) -> bool:
+        try:
+            return (await self.command("NOOP"))[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    async def quit(self):
+        try:
+            await asyncio.wait_for(self.command("QUIT"), timeout=5)
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class AsyncSMTPConnectionPool:
+    """
+    Пул постоянных SMTP-соединений на asyncio: тот же интерфейс, что у SMTPConnectionPool,
+    но без потоков - одновременные письма не ограничены числом потоков to_thread.
+    """
+
+    def __init__(self, host: str, port: int, username: str | None, password: str | None,
+                 size: int = 2, security: str = "ssl", timeout: float = 30.0,
+                 keepalive_interval: float = 60.0, max_idle: float = 300.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.security = security
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.max_idle = max_idle
+
+        self._idle: deque[tuple[AsyncSMTPConnection, float]] = deque()
+        self._slots = asyncio.Semaphore(size)
+
+    async def _connect(self) -> AsyncSMTPConnection:
+        conn = AsyncSMTPConnection(self.host, self.port, self.security, self.timeout)
+        try:
+            await conn.connect()
+            # Локальные тестовые серверы (aiosmtpd) обычно не объявляют AUTH
+            if self.username and self.password and "auth" in conn.extensions:
+                await conn.login(self.username, self.password)
+        except BaseException:
+            conn.close()
+            raise
+        connections_opened.inc()
+        return conn
+
+    @staticmethod
+    async def _close(conn: AsyncSMTPConnection):
+        await conn.quit()
+        connections_closed.inc()
+
+    async def _acquire(self) -> AsyncSMTPConnection:
+        while self._idle:
+            conn, last_used = self._idle.pop()
+            connections_idle.set(len(self._idle))
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.max_idle:
+                await self._close(conn)
+                continue
+            # Давно не использовалось: проверяем, что сервер нас еще не отключил
+            if idle_for > self.keepalive_interval:
+                keepalive_noops.inc()
+                if not await conn.noop():
+                    await self._close(conn)
+                    continue
+            return conn
+        return await self._connect()
+
+    def _release(self, conn: AsyncSMTPConnection):
+        self._idle.append((conn, time.monotonic()))
+        connections_idle.set(len(self._idle))
+
+    async def send_streaming(self, message: StreamingEmail):
+        async with self._slots:
+            conn = await self._acquire()
+            connections_in_use.inc()
+            try:
+                try:
+                    await conn.send_streaming(message)
+                except smtplib.SMTPServerDisconnected:
+                    # Тело письма уже передавалось: сервер мог его принять, повтор отправил бы письмо дважды.
+                    # Решает очередь доставки
+                    if conn.data_accepted:
+                        raise
+                    # Сервер закрыл соединение, пока оно лежало в пуле: одна попытка переподключиться
+                    logging.info("SMTP-соединение разорвано сервером, переподключаемся...")
+                    reconnects.inc()
+                    conn.close()
+                    conn = await self._connect()
+                    await conn.send_streaming(message)
+                messages_sent.inc()
+            except BaseException:
+                await self._close(conn)
+                raise
+            finally:
+                connections_in_use.dec()
+            self._release(conn)
+
+    async def keepalive(self):
+        """Отправляет NOOP свободным соединениям и закрывает слишком долго простаивающие"""
+        idle, self._idle = list(self._idle), deque()
+        now = time.monotonic()
+        alive = []
+        for conn, last_used in idle:
+            keepalive_noops.inc()
+            if now - last_used > self.max_idle or not await conn.noop():
+                await self._close(conn)
+            else:
+                alive.append((conn, last_used))
+        # Соединения, вернувшиеся в пул во время проверки, остаются в конце очереди
+        self._idle.extendleft(reversed(alive))
+        connections_idle.set(len(self._idle))
+
+    async def close(self):
+        idle, self._idle = list(self._idle), deque()
+        connections_idle.set(0)
+        for conn, _ in idle:
+            await self._close(conn)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": int(connections_idle.value),
+            "in_use": int(connections_in_use.value),
+            "opened": int(connections_opened.value),
+            "closed": int(connections_closed.value),
+            "reconnects": int(reconnects.value),
+            "sent": int(messages_sent.value),
+        }
+
+
+async def run_keepalive(pool: AsyncSMTPConnectionPool):
+    """Фоновая задача: периодический NOOP для свободных соединений пула"""
+    while True:
+        await asyncio.sleep(pool.keepalive_interval)
+        try:
+            await pool.keepalive()
+        except Exception as e:
+            logging.warning(f"Ошибка keepalive SMTP-пула: {e}")
@@ -0,0 +1,219 @@
+# file: benchmarks/anti_flood.py
+"""
+Анти-флуд: цена на апдейт и эффект при флуде, без сети.
+
+1. Накладные расходы: вызов AntiFloodMiddleware с пустым хэндлером против вызова хэндлера напрямую -
+   для обычного апдейта (много разных пользователей) и для отбрасываемого (один пользователь флудит).
+2. Флуд через настоящий router: обычные пользователи заполняют анкету, а флудеры после /start
+   шлют поток текста на шаге с медиа (каждое такое сообщение - чтение анкеты, фильтры и ответ
+   process_media_invalid). Прогон без анти-флуда и с ним: сколько обращений к хранилищу и вызовов
+   Bot API стоил флуд и как он сказался на обычных пользователях.
+
+Запуск: python -m benchmarks.anti_flood [--updates 200000] [--users 200] [--flooders 5] [--flood 500]
+                                        [--think-ms 1000] [--output файл.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# Очередь, кэш медиа и спаны - во временном каталоге, а не в data/ бота.
+# Переменные задаются до импорта config
+_TMP_DIR = tempfile.mkdtemp(prefix="anti-flood-")
+os.environ["DELIVERY_QUEUE_PATH"] = os.path.join(_TMP_DIR, "delivery_queue.sqlite3")
+os.environ["MEDIA_CACHE_DIR"] = os.path.join(_TMP_DIR, "media_cache")
+os.environ["TRACE_EXPORT_PATH"] = os.path.join(_TMP_DIR, "traces.jsonl")
+# Анти-флуд в этом бенчмарке подключается вручную (с ним и без него в одном процессе)
+os.environ["ANTIFLOOD_ENABLED"] = "false"
+
+from aiogram import Dispatcher
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import ANTIFLOOD_BURST, ANTIFLOOD_RATE_PER_SEC, ANTIFLOOD_WINDOW_LIMIT, ANTIFLOOD_WINDOW_SEC
+from delivery_queue import delivery_queue
+from fsm_storage import ChatEventIsolation, InstrumentedStorage, storage_duration
+from handlers import router as main_router
+from media_cache import media_cache
+from media_prefetch import media_prefetcher
+from middlewares import setup_middlewares
+from middlewares.anti_flood import AntiFloodMiddleware, flood_dropped, flood_warnings
+
+from benchmarks.fake_telegram import BOT_ID, bound_update, build_script, fake_bot
+
+
+def _anti_flood() -> AntiFloodMiddleware:
+    return AntiFloodMiddleware(rate=ANTIFLOOD_RATE_PER_SEC, burst=ANTIFLOOD_BURST, window=ANTIFLOOD_WINDOW_SEC,
+                               window_limit=ANTIFLOOD_WINDOW_LIMIT)
+
+
+# --- 1. Накладные расходы ---
+async def overhead(updates: int) -> dict:
+    bot = fake_bot()
+
+    async def handler(event, data):
+        return None
+
+    async def measure(events: list, middleware) -> float:
+        started = time.perf_counter()
+        for update, data in events:
+            if middleware is None:
+                await handler(update, data)
+            else:
+                await middleware(handler, update, data)
+        return (time.perf_counter() - started) / len(events) * 1e9
+
+    # Обычный апдейт: пользователей столько, что никто не упирается в лимит
+    users = max(1, updates // 2)
+    passing = []
+    for i in range(updates):
+        update = bound_update(bot, i + 1, BOT_ID + 1 + i % users, i + 1, {"text": "текст"})
+        passing.append((update, {"event_from_user": update.message.from_user}))
+    # Флуд одного пользователя: после запаса burst почти все апдейты отбрасываются
+    flood_update = bound_update(bot, 1, BOT_ID + 1, 1, {"text": "спам"})
+    flooding = [(flood_update, {"event_from_user": flood_update.message.from_user})] * updates
+
+    baseline = await measure(passing, None)
+    result = {
+        "baseline_ns": baseline,
+        "pass_ns": await measure(passing, _anti_flood()) - baseline,
+        # Предупреждение отправляется один раз за окно через поддельную сессию - в среднем это копейки
+        "drop_ns": await measure(flooding, _anti_flood()) - baseline,
+    }
+    await bot.session.close()
+    return result
+
+
+# --- 2. Флуд через настоящий router ---
+def _set_anti_flood(dp: Dispatcher, middleware: AntiFloodMiddleware | None):
+    # Анти-флуд стоит перед FSMContextMiddleware, как в setup_middlewares
+    for registered in list(dp.update.outer_middleware):
+        if isinstance(registered, AntiFloodMiddleware):
+            dp.update.outer_middleware.unregister(registered)
+    if middleware is not None:
+        dp.update.outer_middleware.unregister(dp.fsm)
+        dp.update.outer_middleware(middleware)
+        dp.update.outer_middleware(dp.fsm)
+
+
+async def _legit_user(dp: Dispatcher, bot, user_id: int, rng: random.Random, think: float,
+                      latencies: list[float]) -> bool:
+    await asyncio.sleep(rng.uniform(0, 2))
+    for message_id, (_, step) in enumerate(build_script(user_id, "photo", rng), start=1):
+        await asyncio.sleep(rng.expovariate(1 / think))
+        started = time.perf_counter()
+        await dp.feed_update(bot, bound_update(bot, message_id, user_id, message_id, step))
+        latencies.append(time.perf_counter() - started)
+    return await dp.storage.get_state(key=StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)) is None
+
+
+async def _flooder(dp: Dispatcher, bot, user_id: int, flood: int):
+    await dp.feed_update(bot, bound_update(bot, 1, user_id, 1, {"text": "/start"}))
+    await dp.feed_update(bot, bound_update(bot, 2, user_id, 2, {"callback": "report_type:garbage"}))
+    for message_id in range(3, flood + 3):
+        await dp.feed_update(bot, bound_update(bot, message_id, user_id, message_id, {"text": "спам"}))
+        # Отброшенный апдейт не уступает цикл событий; в боте апдейты приходят из сети по одному
+        await asyncio.sleep(0)
+
+
+async def flood_run(dp: Dispatcher, bot, args, offset: int) -> dict:
+    rng = random.Random(args.seed)
+    session = bot.session
+    calls_before = sum(session.calls.values())
+    storage_before = storage_duration.value
+    dropped_before, warnings_before = flood_dropped.value, flood_warnings.value
+    latencies: list[float] = []
+
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(_legit_user(dp, bot, offset + i, random.Random(rng.random()), args.think_ms / 1000, latencies)
+          for i in range(args.users)),
+        *(_flooder(dp, bot, offset + args.users + i, args.flood) for i in range(args.flooders)),
+    )
+    duration = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "duration_sec": round(duration, 2),
+        "completed": sum(result is True for result in results[:args.users]),
+        "legit_p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+        "legit_p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "storage_ops": int(storage_duration.value - storage_before),
+        "api_calls": sum(session.calls.values()) - calls_before,
+        "dropped": int(flood_dropped.value - dropped_before),
+        "warnings": int(flood_warnings.value - warnings_before),
+    }
+
+
+async def main(args):
+    cost = await overhead(args.updates)
+    print(f"Накладные расходы на апдейт: пропущенный +{cost['pass_ns']:.0f} нс, "
+          f"отброшенный +{cost['drop_ns']:.0f} нс (пустой хэндлер: {cost['baseline_ns']:.0f} нс)")
+
+    bot = fake_bot()
+    dp = Dispatcher(storage=InstrumentedStorage(MemoryStorage(), "memory"), events_isolation=ChatEventIsolation())
+    dp.include_router(main_router)
+    setup_middlewares(dp)
+
+    # Доставка заявок не входит в замер: задачи только проходят через очередь
+    async def _discard(job):
+        pass
+
+    delivery_queue.register("group", _discard)
+    delivery_queue.register("email", _discard)
+    await delivery_queue.start()
+
+    print(f"Пользователей: {args.users}, флудеров: {args.flooders} по {args.flood} сообщений")
+    runs = []
+    for index, enabled in enumerate((False, True)):
+        _set_anti_flood(dp, _anti_flood() if enabled else None)
+        result = await flood_run(dp, bot, args, offset=BOT_ID + 1 + index * 1_000_000)
+        runs.append({"anti_flood": enabled, **result})
+        print(f"анти-флуд {'вкл ' if enabled else 'выкл'} | время: {result['duration_sec']:>6.2f} с | "
+              f"анкет завершено: {result['completed']:>4} | p50/p95 обычных: {result['legit_p50_ms']:.2f}/"
+              f"{result['legit_p95_ms']:.2f} мс | обращений к хранилищу: {result['storage_ops']:>6} | "
+              f"вызовов Bot API: {result['api_calls']:>5} | отброшено: {result['dropped']:>5} | "
+              f"предупреждений: {result['warnings']}")
+    await delivery_queue.stop()
+    await media_prefetcher.close()
+    await media_cache.close()
+    await bot.session.close()
+
+    output = args.output or os.path.join("benchmarks", "results",
+                                         f"anti_flood_{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "config": {"updates": args.updates, "users": args.users, "flooders": args.flooders,
+                              "flood": args.flood, "think_ms": args.think_ms, "seed": args.seed,
+                              "rate_per_sec": ANTIFLOOD_RATE_PER_SEC, "burst": ANTIFLOOD_BURST,
+                              "window_sec": ANTIFLOOD_WINDOW_SEC, "window_limit": ANTIFLOOD_WINDOW_LIMIT},
+                   "overhead_ns": {key: round(value, 1) for key, value in cost.items()},
+                   "runs": runs}, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+
+def parse_args(argv: list[str]):
+    parser = argparse.ArgumentParser(description="Накладные расходы и эффект анти-флуда")
+    parser.add_argument("--updates", type=int, default=200_000, help="апдейтов в замере накладных расходов")
+    parser.add_argument("--users", type=int, default=200, help="обычных пользователей")
+    parser.add_argument("--flooders", type=int, default=5, help="флудеров")
+    parser.add_argument("--flood", type=int, default=500, help="сообщений от каждого флудера")
+    parser.add_argument("--think-ms", type=float, default=1000, help="средняя пауза обычного пользователя")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда сохранить JSON (по умолчанию benchmarks/results/)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args(sys.argv[1:])))
+    finally:
+        shutil.rmtree(_TMP_DIR, ignore_errors=True)
@@ -0,0 +1,98 @@
+# file: benchmarks/email_attachments.py
+"""
+Объем письма (байт в SMTP DATA) и время отправки фото: оригинал против пережатой копии.
+Фото генерируется синтетически (градиент + шум, EXIF с камерой и GPS), письмо уходит на локальный aiosmtpd.
+
+Запуск (нужны Pillow и aiosmtpd): python -m benchmarks.email_attachments [ширина] [высота]
+"""
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from aiosmtpd.controller import Controller
+from PIL import ExifTags, Image
+
+from email_stream import StreamingEmail
+from media_transcode import recompress_photo, shutdown_executor
+from smtp_pool import SMTPConnectionPool
+
+HOST, PORT = "127.0.0.1", 8027
+ROUNDS = 5
+
+
+class _DiscardHandler:
+    async def handle_DATA(self, server, session, envelope):
+        return "250 OK"
+
+
+def _make_photo(path: str, width: int, height: int):
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    image = Image.merge("RGB", (gradient, noise, gradient.rotate(90).resize((width, height))))
+    exif = image.getexif()
+    exif[ExifTags.Base.Make] = "Benchmark"
+    exif[ExifTags.Base.Model] = "Camera"
+    exif[ExifTags.IFD.GPSInfo] = {1: "N", 2: (55.0, 45.0, 21.0), 3: "E", 4: (37.0, 37.0, 4.0)}
+    image.save(path, "JPEG", quality=95, exif=exif)
+
+
+def _wire_bytes(path: str) -> int:
+    with open(path, 'rb') as f:
+        message = StreamingEmail("bench@example.com", "bench@example.com", "benchmark", "<p>benchmark</p>",
+                                 attachment=f, attachment_name=os.path.basename(path))
+        return sum(len(chunk) for chunk in message.iter_data())
+
+
+def _send(pool: SMTPConnectionPool, path: str):
+    with open(path, 'rb') as f:
+        pool.send_streaming(StreamingEmail("bench@example.com", "bench@example.com", "benchmark",
+                                           "<p>benchmark</p>", attachment=f,
+                                           attachment_name=os.path.basename(path)))
+
+
+async def main(width: int, height: int):
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, "photo.jpg")
+    _make_photo(source, width, height)
+    controller = Controller(_DiscardHandler(), hostname=HOST, port=PORT)
+    controller.start()
+    pool = SMTPConnectionPool(HOST, PORT, None, None, size=1, security="plain")
+    try:
+        # Прогрев: соединение с SMTP и запуск процессов пула
+        await asyncio.to_thread(_send, pool, source)
+        await recompress_photo(source, os.path.join(directory, "warmup.jpg"))
+
+        before, after = [], []
+        for i in range(ROUNDS):
+            started = time.perf_counter()
+            await asyncio.to_thread(_send, pool, source)
+            before.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            destination = os.path.join(directory, f"small{i}.jpg")
+            if not await recompress_photo(source, destination):
+                destination = source
+            await asyncio.to_thread(_send, pool, destination)
+            after.append(time.perf_counter() - started)
+
+        print(f"Фото {width}x{height}, файл {os.path.getsize(source) / 1024:.0f} КБ")
+        print(f"{'':<10} | {'байт в DATA':>12} | {'отправка, мс (медиана)':>23}")
+        print(f"{'оригинал':<10} | {_wire_bytes(source):>12} | {statistics.median(before) * 1000:>23.1f}")
+        print(f"{'пережатое':<10} | {_wire_bytes(destination):>12} | {statistics.median(after) * 1000:>23.1f}")
+        with Image.open(destination) as result:
+            exif = result.getexif()
+            print(f"EXIF после пережатия: {sorted(exif.keys())}, GPS: {exif.get_ifd(ExifTags.IFD.GPSInfo)}")
+    finally:
+        await asyncio.to_thread(pool.close)
+        controller.stop()
+        shutdown_executor()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 4032,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 3024))
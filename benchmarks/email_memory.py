@@ -0,0 +1,97 @@
+# file: benchmarks/email_memory.py
+"""
+Пиковое потребление памяти (RSS) при отправке письма с вложением 1/10/20 МБ:
+старый способ (MIMEApplication + smtplib.send_message) против потоковой отправки.
+
+Запуск (нужен aiosmtpd): python -m benchmarks.email_memory
+Каждое измерение выполняется в отдельном процессе, чтобы пик RSS не наследовался.
+"""
+import multiprocessing
+import os
+import resource
+import smtplib
+import tempfile
+import time
+
+from aiosmtpd.controller import Controller
+
+SIZES_MB = (1, 10, 20)
+HOST, PORT = "127.0.0.1", 8026
+
+
+class _DiscardHandler:
+    async def handle_DATA(self, server, session, envelope):
+        return "250 OK"
+
+
+def _peak_rss_mb() -> float:
+    # В Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_legacy(path: str, result):
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    baseline = _peak_rss_mb()
+    started = time.perf_counter()
+    msg = MIMEMultipart()
+    msg['From'] = "bench@example.com"
+    msg['To'] = "bench@example.com"
+    msg['Subject'] = "benchmark"
+    msg.attach(MIMEText("<p>benchmark</p>", 'html'))
+    with open(path, "rb") as f:
+        attachment = MIMEApplication(f.read(), Name="video.mp4")
+    attachment['Content-Disposition'] = 'attachment; filename="video.mp4"'
+    msg.attach(attachment)
+    with smtplib.SMTP(HOST, PORT) as server:
+        server.send_message(msg)
+    result.put((_peak_rss_mb() - baseline, time.perf_counter() - started))
+
+
+def _run_streaming(path: str, result):
+    from email_stream import StreamingEmail
+    from smtp_pool import SMTPConnectionPool
+
+    baseline = _peak_rss_mb()
+    started = time.perf_counter()
+    pool = SMTPConnectionPool(HOST, PORT, None, None, size=1, security="plain")
+    with open(path, "rb") as f:
+        pool.send_streaming(StreamingEmail("bench@example.com", "bench@example.com", "benchmark",
+                                           "<p>benchmark</p>", attachment=f, attachment_name="video.mp4"))
+    pool.close()
+    result.put((_peak_rss_mb() - baseline, time.perf_counter() - started))
+
+
+def _measure(target, path: str) -> tuple[float, float]:
+    result = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(path, result))
+    process.start()
+    value = result.get()
+    process.join()
+    return value
+
+
+def main():
+    controller = Controller(_DiscardHandler(), hostname=HOST, port=PORT, data_size_limit=0)
+    controller.start()
+    try:
+        print(f"{'Размер':>8} | {'legacy, МБ RSS':>15} | {'stream, МБ RSS':>15} | {'legacy, с':>9} | {'stream, с':>9}")
+        for size_mb in SIZES_MB:
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                f.write(os.urandom(size_mb * 1024 * 1024))
+                path = f.name
+            try:
+                legacy_rss, legacy_time = _measure(_run_legacy, path)
+                stream_rss, stream_time = _measure(_run_streaming, path)
+            finally:
+                os.unlink(path)
+            print(f"{size_mb:>5} МБ | {legacy_rss:>15.1f} | {stream_rss:>15.1f} | "
+                  f"{legacy_time:>9.2f} | {stream_time:>9.2f}")
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# file: benchmarks/fake_telegram.py
+"""
+Telegram без сети для бенчмарков: поддельная сессия Bot и апдейты анкеты ReportForm.
+Модуль не трогает окружение и config, поэтому его можно импортировать и в дочерних процессах.
+"""
+import asyncio
+import datetime
+import itertools
+import random
+from collections import Counter
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import TelegramMethod
+from aiogram.types import (CallbackQuery, Chat, File, Location, Message, PhotoSize, Update, User, Video,
+                           VideoNote)
+
+BOT_ID = 100000
+MEDIA_SIZES = {"photo": 250 * 1024, "video": 4 * 1024 * 1024, "video_note": 1024 * 1024}
+
+
+# --- Поддельный Telegram ---
+class FakeSession(BaseSession):
+    """
+    Сессия Bot без сети: отправка сообщений возвращает новое сообщение, остальные методы - True.
+    latency имитирует время ответа Bot API; скачивание файла отдает нули нужного размера.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        returning = method.__returning__
+        if returning is Message:
+            return Message(message_id=next(self._message_ids), date=datetime.datetime.now(),
+                           chat=Chat(id=getattr(method, "chat_id", 0), type="private"))
+        if returning is File:
+            return File(file_id=method.file_id, file_unique_id=f"u{method.file_id}",
+                        file_size=MEDIA_SIZES["photo"], file_path=f"files/{method.file_id}")
+        return True
+
+    async def stream_content(self, url: str, headers: dict | None = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        remaining = MEDIA_SIZES["photo"]
+        while remaining > 0:
+            size = min(chunk_size, remaining)
+            remaining -= size
+            yield b"\0" * size
+
+    async def close(self):
+        pass
+
+
+def fake_bot(rate_share: float = 1.0, latency: float = 0.0) -> Bot:
+    """
+    Фабрика бота с поддельной сессией (в том числе для процессов-воркеров: функция модуля передается через pickle).
+    Лимитов отправки нет, поэтому rate_share не используется.
+    """
+    return Bot(token=f"{BOT_ID}:LOADTEST", session=FakeSession(latency),
+               default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+
+# --- Сценарий пользователя ---
+def _user(user_id: int) -> User:
+    return User(id=user_id, is_bot=False, first_name=f"User{user_id}")
+
+
+def _message(user_id: int, message_id: int, **content) -> Message:
+    return Message(message_id=message_id, date=datetime.datetime.now(),
+                   chat=Chat(id=user_id, type="private"), from_user=_user(user_id), **content)
+
+
+def _callback(user_id: int, message_id: int, data: str) -> CallbackQuery:
+    bot_message = Message(message_id=message_id, date=datetime.datetime.now(),
+                          chat=Chat(id=user_id, type="private"), from_user=User(id=BOT_ID, is_bot=True,
+                                                                                first_name="Bot"),
+                          text="...")
+    return CallbackQuery(id=f"{user_id}:{message_id}", from_user=_user(user_id),
+                         chat_instance=str(user_id), message=bot_message, data=data)
+
+
+def _media(user_id: int, media_type: str) -> dict:
+    file_id, unique_id = f"{media_type}-{user_id}", f"{media_type[0]}{user_id}"
+    size = MEDIA_SIZES[media_type]
+    if media_type == "photo":
+        return {"photo": [PhotoSize(file_id=file_id, file_unique_id=unique_id, width=1280, height=960,
+                                    file_size=size)]}
+    if media_type == "video":
+        return {"video": Video(file_id=file_id, file_unique_id=unique_id, width=1280, height=720,
+                               duration=15, file_size=size)}
+    return {"video_note": VideoNote(file_id=file_id, file_unique_id=unique_id, length=384, duration=10,
+                                    file_size=size)}
+
+
+def build_script(user_id: int, media_type: str, rng: random.Random) -> list[tuple[str, dict]]:
+    """
+    Шаги анкеты: (состояние, в котором приходит апдейт, содержимое апдейта).
+    Ветки (тип проблемы, геометка или адрес, обратная связь, email) выбираются случайно.
+    """
+    garbage = rng.random() < 0.5
+    script = [
+        ("start", {"text": "/start"}),
+        ("awaiting_type", {"callback": "report_type:garbage" if garbage else "report_type:air"}),
+        ("awaiting_media", _media(user_id, media_type)),
+        ("awaiting_description", {"text": "Контейнеры переполнены уже неделю, мусор лежит вокруг площадки"}),
+    ]
+    if garbage:
+        script.append(("awaiting_rodents_choice", {"callback": rng.choice(("rodents:yes", "rodents:no"))}))
+    if rng.random() < 0.7:
+        script += [("awaiting_location_choice", {"callback": "loc_choice:geo"}),
+                   ("awaiting_location_geo", {"location": Location(latitude=55.7558 + rng.random() / 100,
+                                                                  longitude=37.6173 + rng.random() / 100)})]
+    else:
+        script += [("awaiting_location_choice", {"callback": "loc_choice:address"}),
+                   ("awaiting_location_address", {"text": "г. Москва, ул. Тверская, д. 1"})]
+    script.append(("awaiting_name", {"text": "Иван"}))
+    if rng.random() < 0.5:
+        script.append(("awaiting_feedback_choice", {"callback": "feedback:yes"}))
+        if rng.random() < 0.3:
+            script.append(("awaiting_contact_email", {"callback": "skip:email"}))
+        else:
+            script.append(("awaiting_contact_email", {"text": f"user{user_id}@example.com"}))
+        script.append(("awaiting_contact_phone", {"text": "+79991234567"}))
+    else:
+        script.append(("awaiting_feedback_choice", {"callback": "feedback:no"}))
+    script.append(("awaiting_confirmation", {"callback": "confirm:send"}))
+    return script
+
+
+def build_update(update_id: int, user_id: int, message_id: int, step: dict) -> Update:
+    """Апдейт шага сценария (без привязки к боту)"""
+    if "callback" in step:
+        return Update(update_id=update_id, callback_query=_callback(user_id, message_id, step["callback"]))
+    return Update(update_id=update_id, message=_message(user_id, message_id, **step))
+
+
+def bound_update(bot: Bot, update_id: int, user_id: int, message_id: int, step: dict) -> Update:
+    update = build_update(update_id, user_id, message_id, step)
+    # Как при поллинге: апдейт разбирается с привязкой к боту до обработки (вне замера),
+    # иначе feed_update пересобирает его через JSON
+    return Update.model_validate(update.model_dump(), context={"bot": bot})
@@ -0,0 +1,80 @@
+# file: benchmarks/fsm_storage.py
+"""
+Задержка операций FSM-хранилищ: get_state / get_data / update_data.
+Сравниваются MemoryStorage aiogram, BoundedMemoryStorage (FSM_STORAGE=memory: сроки и лимиты анкет),
+SQLiteStorage и Redis-хранилище (на fakeredis, если он установлен).
+
+Запуск: python -m benchmarks.fsm_storage [число_операций]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from fsm_storage import BoundedMemoryStorage, SQLiteStorage, create_redis_storage
+from states import ReportForm
+
+USERS = 200
+
+
+def _percentile(values: list[float], q: float) -> float:
+    return statistics.quantiles(values, n=100)[int(q) - 1]
+
+
+async def _measure(storage, operations: int) -> dict[str, list[float]]:
+    keys = [StorageKey(bot_id=1, chat_id=user, user_id=user) for user in range(USERS)]
+    for key in keys:
+        await storage.set_state(key, ReportForm.awaiting_description)
+        await storage.set_data(key, {"complaint_type": "🗑 Скопление мусора", "is_garbage_report": True,
+                                     "photo_id": "AgACAgIAAxkBAAI" * 4, "media_type": "photo"})
+
+    timings = {"get_state": [], "get_data": [], "update_data": []}
+    for i in range(operations):
+        key = keys[i % USERS]
+        started = time.perf_counter()
+        await storage.get_state(key)
+        timings["get_state"].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await storage.get_data(key)
+        timings["get_data"].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await storage.update_data(key, {"description": f"Описание проблемы №{i}"})
+        timings["update_data"].append(time.perf_counter() - started)
+        # Отдаем управление циклу, чтобы фоновые сбросы на диск шли как в реальной работе
+        await asyncio.sleep(0)
+    return timings
+
+
+async def main(operations: int):
+    backends = [("memory (aiogram)", lambda: MemoryStorage()),
+                ("memory", lambda: BoundedMemoryStorage(ttl=3600, max_sessions=100_000, max_bytes=100 * 1024 * 1024))]
+
+    tmp_dir = tempfile.mkdtemp()
+    backends.append(("sqlite", lambda: SQLiteStorage(os.path.join(tmp_dir, "fsm.sqlite3"), ttl=3600)))
+
+    try:
+        from fakeredis.aioredis import FakeRedis
+        backends.append(("redis (fakeredis)", lambda: create_redis_storage("", ttl=3600, redis=FakeRedis())))
+    except ImportError:
+        print("fakeredis не установлен, Redis-хранилище пропущено")
+
+    print(f"{'Хранилище':<18} | {'операция':<11} | {'p50, мкс':>9} | {'p95, мкс':>9} | {'p99, мкс':>9}")
+    for name, factory in backends:
+        storage = factory()
+        timings = await _measure(storage, operations)
+        await storage.close()
+        for operation, values in timings.items():
+            micros = [v * 1_000_000 for v in values]
+            print(f"{name:<18} | {operation:<11} | {_percentile(micros, 50):>9.1f} | "
+                  f"{_percentile(micros, 95):>9.1f} | {_percentile(micros, 99):>9.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
@@ -0,0 +1,257 @@
+# file: benchmarks/load_test.py
+"""
+Нагрузочный тест диалога без сети: настоящий handlers.router в Dispatcher (с middleware бота),
+а вместо Telegram - поддельная сессия Bot, которая отвечает на вызовы Bot API локально.
+Тысячи виртуальных пользователей проходят ReportForm от /start до confirm:send с паузами
+"на раздумье" и заданной долей фото / видео / кружков.
+
+Итог: пропускная способность, p50/p95/p99 задержки обработки апдейта по состояниям анкеты,
+пиковая память процесса. Результаты сохраняются в JSON; с --baseline печатается сравнение с прошлым прогоном.
+
+--isolation задает очередность апдейтов одного чата (как EVENT_ISOLATION; redis - на fakeredis),
+--double-tap - долю пользователей, которые дважды подряд нажимают "Отправить". Без блокировок
+такие нажатия дают дубли заявок, с блокировками - нет; независимые пользователи от них не замедляются.
+
+Запуск: python -m benchmarks.load_test [--users 2000] [--think-ms 1000] [--media photo=0.6,video=0.3,video_note=0.1]
+                                       [--api-latency-ms 0] [--storage memory|sqlite] [--output файл.json]
+                                       [--isolation none|memory|redis] [--double-tap 0.0]
+                                       [--baseline прошлый.json]
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+# Очередь, кэш медиа, SQLite-хранилище анкет и спаны - во временном каталоге, а не в data/ бота.
+# Переменные задаются до импорта config
+_TMP_DIR = tempfile.mkdtemp(prefix="load-test-")
+os.environ["DELIVERY_QUEUE_PATH"] = os.path.join(_TMP_DIR, "delivery_queue.sqlite3")
+os.environ["MEDIA_CACHE_DIR"] = os.path.join(_TMP_DIR, "media_cache")
+os.environ["FSM_SQLITE_PATH"] = os.path.join(_TMP_DIR, "fsm.sqlite3")
+os.environ["TRACE_EXPORT_PATH"] = os.path.join(_TMP_DIR, "traces.jsonl")
+# Виртуальные пользователи отвечают быстрее людей; анти-флуд измеряется отдельно (benchmarks.anti_flood)
+os.environ["ANTIFLOOD_ENABLED"] = "false"
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.fsm.storage.memory import DisabledEventIsolation
+
+from delivery_queue import delivery_queue, queue_depth
+from fsm_storage import (BoundedMemoryStorage, ChatEventIsolation, InstrumentedStorage, RedisChatEventIsolation,
+                         SQLiteStorage)
+from handlers import router as main_router
+from media_cache import media_cache
+from media_prefetch import media_prefetcher
+from middlewares import setup_middlewares
+from states import ReportForm
+
+from benchmarks.fake_telegram import BOT_ID, MEDIA_SIZES, FakeSession, bound_update, build_script
+
+
+class LoadTest:
+    def __init__(self, dp: Dispatcher, bot: Bot, args):
+        self.dp = dp
+        self.bot = bot
+        self.args = args
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.completed = 0
+        self.updates = 0
+        self.reports = 0
+        self._update_ids = itertools.count(1)
+
+    async def _think(self, rng: random.Random):
+        if self.args.think_ms > 0:
+            await asyncio.sleep(rng.expovariate(1000 / self.args.think_ms))
+
+    async def run_user(self, user_id: int, media_type: str, rng: random.Random):
+        # Пользователи приходят не одновременно, а в течение ramp-up
+        await asyncio.sleep(rng.uniform(0, self.args.ramp_up))
+        for message_id, (state, step) in enumerate(build_script(user_id, media_type, rng), start=1):
+            await self._think(rng)
+            update = bound_update(self.bot, next(self._update_ids), user_id, message_id, step)
+            # Двойное нажатие: второй такой же колбэк приходит, пока обрабатывается первый
+            double_tap = state == "awaiting_confirmation" and rng.random() < self.args.double_tap
+            started = time.perf_counter()
+            try:
+                if double_tap:
+                    repeat = bound_update(self.bot, next(self._update_ids), user_id, message_id, step)
+                    await asyncio.gather(self.dp.feed_update(self.bot, update),
+                                         self.dp.feed_update(self.bot, repeat))
+                else:
+                    await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                self.errors[f"{state}: {type(e).__name__}"] += 1
+                return
+            finally:
+                self.latencies[state].append(time.perf_counter() - started)
+                self.updates += 2 if double_tap else 1
+        self.completed += 1
+
+
+def _summary(values: list[float]) -> dict:
+    millis = sorted(v * 1000 for v in values)
+    quantiles = statistics.quantiles(millis, n=100) if len(millis) > 1 else millis * 99
+    return {"count": len(millis), "p50_ms": round(quantiles[49], 3), "p95_ms": round(quantiles[94], 3),
+            "p99_ms": round(quantiles[98], 3), "max_ms": round(millis[-1], 3)}
+
+
+def _parse_media_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in MEDIA_SIZES:
+            raise argparse.ArgumentTypeError(f"Неизвестный тип медиа: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _print_report(result: dict, baseline: dict | None):
+    print(f"Пользователей: {result['config']['users']}, завершили анкету: {result['completed']}, "
+          f"апдейтов: {result['updates']}, ошибок: {sum(result['errors'].values())}")
+    print(f"Время: {result['duration_sec']:.1f} с, апдейтов/с: {result['updates_per_sec']:.1f}, "
+          f"заявок/с: {result['reports_per_sec']:.1f}, пиковая память: {result['peak_rss_mb']:.1f} МБ")
+    print(f"{'состояние':<26} | {'апдейтов':>8} | {'p50, мс':>8} | {'p95, мс':>8} | {'p99, мс':>8}"
+          + (f" | {'p95 было':>8}" if baseline else ""))
+    for state, summary in result["latency"].items():
+        line = (f"{state:<26} | {summary['count']:>8} | {summary['p50_ms']:>8.2f} | {summary['p95_ms']:>8.2f} | "
+                f"{summary['p99_ms']:>8.2f}")
+        if baseline:
+            previous = baseline.get("latency", {}).get(state)
+            line += f" | {previous['p95_ms']:>8.2f}" if previous else f" | {'-':>8}"
+        print(line)
+    print(f"Заявок поставлено в очередь: {result['reports']}, дублей: {result['duplicate_reports']} "
+          f"(очередность апдейтов: {result['config']['isolation']}, двойных нажатий: {result['config']['double_tap']})")
+    if baseline:
+        print(f"Было: апдейтов/с {baseline['updates_per_sec']:.1f}, пиковая память {baseline['peak_rss_mb']:.1f} МБ")
+    for error, count in result["errors"].items():
+        print(f"Ошибка {error}: {count}")
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    mix = args.media
+    session = FakeSession(args.api_latency_ms / 1000)
+    bot = Bot(token=f"{BOT_ID}:LOADTEST", session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Хранилище обернуто так же, как в боте (create_storage): замеры входят в время апдейта
+    if args.storage == "sqlite":
+        storage = InstrumentedStorage(SQLiteStorage(os.environ["FSM_SQLITE_PATH"], ttl=3600), "sqlite")
+    else:
+        storage = InstrumentedStorage(BoundedMemoryStorage(ttl=3600), "memory")
+    if args.isolation == "redis":
+        # Redis-совместимая замена в памяти: сетевые задержки настоящего сервера в замер не входят
+        from fakeredis.aioredis import FakeRedis
+        # (у FakeRedis пул ограничен 100 соединениями, у настоящего клиента по умолчанию - нет)
+        isolation = RedisChatEventIsolation(FakeRedis(max_connections=100_000), timeout=60, wait=30)
+    elif args.isolation == "memory":
+        isolation = ChatEventIsolation()
+    else:
+        isolation = DisabledEventIsolation()
+    dp = Dispatcher(storage=storage, events_isolation=isolation)
+    dp.include_router(main_router)
+    setup_middlewares(dp)
+
+    # Доставка в группу и на email не входит в замер: задачи только проходят через очередь
+    test = LoadTest(dp, bot, args)
+
+    async def _count_report(job):
+        test.reports += 1
+
+    async def _discard(job):
+        pass
+
+    delivery_queue.register("group", _count_report)
+    delivery_queue.register("email", _discard)
+    await delivery_queue.start()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    users = [test.run_user(BOT_ID + 1 + i, rng.choices(list(mix), weights=list(mix.values()))[0],
+                           random.Random(rng.random()))
+             for i in range(args.users)]
+    await asyncio.gather(*users)
+    duration = time.perf_counter() - started
+    # ru_maxrss в Linux - в килобайтах
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Задачи, поставленные последними, должны дойти до подсчета заявок
+    while queue_depth.value > 0:
+        await asyncio.sleep(0.05)
+    await delivery_queue.stop()
+    await media_prefetcher.close()
+    await media_cache.close()
+    await storage.close()
+
+    # Состояния в порядке прохождения анкеты
+    order = ["start", *(state.state.split(":")[1] for state in ReportForm.__states__)]
+    result = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {"users": args.users, "think_ms": args.think_ms, "ramp_up_sec": args.ramp_up,
+                   "media": mix, "api_latency_ms": args.api_latency_ms, "storage": args.storage,
+                   "isolation": args.isolation, "double_tap": args.double_tap,
+                   "seed": args.seed, "python": sys.version.split()[0]},
+        "duration_sec": round(duration, 3),
+        "completed": test.completed,
+        "updates": test.updates,
+        "updates_per_sec": round(test.updates / duration, 1),
+        "reports_per_sec": round(test.completed / duration, 1),
+        "reports": test.reports,
+        "duplicate_reports": test.reports - test.completed,
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "rss_growth_mb": round((peak_rss - rss_before) / 1024, 1),
+        "latency": {state: _summary(values) for state, values in sorted(
+            test.latencies.items(), key=lambda item: order.index(item[0]) if item[0] in order else len(order))},
+        "api_calls": dict(session.calls.most_common()),
+        "errors": dict(test.errors),
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    _print_report(result, baseline)
+
+    output = args.output or os.path.join("benchmarks", "results",
+                                         f"load_test_{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+
+def parse_args(argv: list[str]):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест анкеты без сети")
+    parser.add_argument("--users", type=int, default=2000, help="число виртуальных пользователей")
+    parser.add_argument("--think-ms", type=float, default=1000, help="средняя пауза пользователя между шагами")
+    parser.add_argument("--ramp-up", type=float, default=10, help="за сколько секунд приходят все пользователи")
+    parser.add_argument("--media", type=_parse_media_mix, default="photo=0.6,video=0.3,video_note=0.1",
+                        help="доли типов медиа")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="имитируемая задержка ответа Bot API")
+    parser.add_argument("--storage", choices=("memory", "sqlite"), default="memory", help="FSM-хранилище")
+    parser.add_argument("--isolation", choices=("none", "memory", "redis"), default="memory",
+                        help="очередность апдейтов одного чата")
+    parser.add_argument("--double-tap", type=float, default=0.0,
+                        help="доля пользователей, дважды нажимающих \"Отправить\"")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора сценариев")
+    parser.add_argument("--output", help="куда сохранить JSON (по умолчанию benchmarks/results/)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args(sys.argv[1:])))
+    finally:
+        shutil.rmtree(_TMP_DIR, ignore_errors=True)
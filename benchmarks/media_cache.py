@@ -0,0 +1,82 @@
+# file: benchmarks/media_cache.py
+"""
+Доставка медиа заявки для письма: холодный кэш (скачивание из Telegram) против теплого (файл уже на диске).
+Telegram имитируется: get_file - задержка сети, download_file - запись файла с ограниченной скоростью.
+Отдельно проверяется single-flight: несколько одновременных запросов одного файла.
+
+Запуск: python -m benchmarks.media_cache [задержка_мс] [скорость_МБ/с]
+"""
+import asyncio
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from media_cache import MediaCache
+
+SIZES_MB = (1, 10)
+CHUNK = 64 * 1024
+
+
+class FakeTelegram:
+    def __init__(self, latency: float, bandwidth: float):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.downloads = 0
+        self.sizes: dict[str, int] = {}
+
+    async def get_file(self, file_id: str):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(file_path=f"documents/{file_id}.mp4")
+
+    async def download_file(self, file_path: str, destination: str):
+        self.downloads += 1
+        size = self.sizes[file_path.split('/')[-1].split('.')[0]]
+        await asyncio.sleep(self.latency)
+        with open(destination, 'wb') as f:
+            for _ in range(0, size, CHUNK):
+                f.write(b"\0" * CHUNK)
+                await asyncio.sleep(CHUNK / self.bandwidth)
+
+
+async def _deliver(cache: MediaCache, bot: FakeTelegram, file_id: str) -> float:
+    """Как задача отправки письма: берем путь из кэша и читаем файл целиком"""
+    started = time.perf_counter()
+    path = await cache.get(bot, file_id, f"unique-{file_id}")
+    with open(path, 'rb') as f:
+        while f.read(CHUNK):
+            pass
+    return time.perf_counter() - started
+
+
+async def main(latency_ms: float, bandwidth_mb: float):
+    directory = tempfile.mkdtemp()
+    bot = FakeTelegram(latency_ms / 1000, bandwidth_mb * 1024 * 1024)
+    cache = MediaCache(directory, max_bytes=100 * 1024 * 1024, ttl=3600)
+    try:
+        print(f"Telegram: задержка {latency_ms:.0f} мс, скорость {bandwidth_mb:.0f} МБ/с")
+        print(f"{'Файл':>6} | {'холодный, мс':>12} | {'теплый, мс':>10}")
+        for size in SIZES_MB:
+            file_id = f"file{size}mb"
+            bot.sizes[file_id] = size * 1024 * 1024
+            cold = await _deliver(cache, bot, file_id)
+            warm = await _deliver(cache, bot, file_id)
+            print(f"{size:>4}МБ | {cold * 1000:>12.1f} | {warm * 1000:>10.1f}")
+
+        bot.downloads = 0
+        file_id = "duplicate"
+        bot.sizes[file_id] = 5 * 1024 * 1024
+        started = time.perf_counter()
+        await asyncio.gather(*(_deliver(cache, bot, file_id) for _ in range(10)))
+        print(f"10 одновременных запросов одного файла (5 МБ): {(time.perf_counter() - started) * 1000:.0f} мс, "
+              f"скачиваний из Telegram: {bot.downloads}")
+        print(f"Статистика кэша: {cache.stats()}")
+    finally:
+        await cache.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 100,
+                     float(sys.argv[2]) if len(sys.argv) > 2 else 20))
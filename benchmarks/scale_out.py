@@ -0,0 +1,172 @@
+# file: benchmarks/scale_out.py
+"""
+Пропускная способность режима супервизора (BOT_WORKERS) на 1/2/4/8 воркерах без сети.
+Источник апдейтов - локальный повтор: сценарии анкеты из нагрузочного теста или записанный JSONL
+(по одному апдейту Bot API в строке, как их возвращает getUpdates). Апдейты идут через настоящий
+Supervisor: консистентный хеш по from.id, процессы-воркеры с общим SQLite-хранилищем анкет и общая
+очередь доставки, которую разбирает этот процесс.
+
+Каждый виртуальный пользователь отправляет следующий шаг после подтверждения предыдущего, как живой
+пользователь, дождавшийся ответа бота. Замер - от первого апдейта до последнего подтверждения
+(запуск процессов в него не входит).
+
+Запуск: python -m benchmarks.scale_out [--workers 1,2,4,8] [--users 500] [--api-latency-ms 0]
+                                       [--replay апдейты.jsonl] [--record апдейты.jsonl] [--output файл.json]
+"""
+import argparse
+import asyncio
+import datetime
+import functools
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+# Общие для всех процессов файлы - во временном каталоге; воркеры наследуют окружение при запуске.
+# Переменные задаются до импорта config
+_TMP_DIR = tempfile.mkdtemp(prefix="scale-out-")
+os.environ["DELIVERY_QUEUE_PATH"] = os.path.join(_TMP_DIR, "delivery_queue.sqlite3")
+os.environ["MEDIA_CACHE_DIR"] = os.path.join(_TMP_DIR, "media_cache")
+os.environ["TRACE_EXPORT_PATH"] = os.path.join(_TMP_DIR, "traces.jsonl")
+os.environ["FSM_STORAGE"] = "sqlite"
+# Порты метрик воркеров в бенчмарке не нужны
+os.environ["METRICS_ENABLED"] = "false"
+# Пользователи отправляют шаги без пауз; анти-флуд измеряется отдельно (benchmarks.anti_flood)
+os.environ["ANTIFLOOD_ENABLED"] = "false"
+
+from delivery_queue import delivery_queue
+from supervisor import Supervisor, routing_key
+
+from benchmarks.fake_telegram import BOT_ID, build_script, build_update, fake_bot
+
+MEDIA_MIX = {"photo": 0.6, "video": 0.3, "video_note": 0.1}
+
+
+def generate(users: int, seed: int) -> list[list[dict]]:
+    """Апдейты анкеты в формате Bot API, по списку на пользователя"""
+    rng = random.Random(seed)
+    update_id = 0
+    scripts = []
+    for i in range(users):
+        user_id = BOT_ID + 1 + i
+        media_type = rng.choices(list(MEDIA_MIX), weights=list(MEDIA_MIX.values()))[0]
+        script = []
+        for message_id, (_, step) in enumerate(build_script(user_id, media_type, random.Random(rng.random())),
+                                               start=1):
+            update_id += 1
+            script.append(build_update(update_id, user_id, message_id, step).model_dump(
+                mode="json", by_alias=True, exclude_none=True))
+        scripts.append(script)
+    return scripts
+
+
+def load_replay(path: str) -> list[list[dict]]:
+    """Записанные апдейты, сгруппированные по пользователю с сохранением порядка"""
+    by_user: dict[int, list[dict]] = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                raw = json.loads(line)
+                by_user[routing_key(raw)].append(raw)
+    return list(by_user.values())
+
+
+async def _replay_user(supervisor: Supervisor, script: list[dict], latencies: list[float]) -> int:
+    failed = 0
+    for raw in script:
+        started = time.perf_counter()
+        handled = await (await supervisor.submit(raw))
+        latencies.append(time.perf_counter() - started)
+        failed += not handled
+    return failed
+
+
+async def run(workers: int, scripts: list[list[dict]], api_latency: float) -> dict:
+    # Свое хранилище анкет на каждый прогон: пользователи начинают анкету с нуля
+    os.environ["FSM_SQLITE_PATH"] = os.path.join(_TMP_DIR, f"fsm_{workers}.sqlite3")
+    supervisor = Supervisor(workers, functools.partial(fake_bot, latency=api_latency), rate_share=1.0,
+                            max_pending=sum(map(len, scripts)))
+    await supervisor.start()
+    latencies: list[float] = []
+    started = time.perf_counter()
+    failed = sum(await asyncio.gather(*(_replay_user(supervisor, script, latencies) for script in scripts)))
+    duration = time.perf_counter() - started
+    # Остановка воркеров сбрасывает буфер анкет; задачи доставки разбирает этот процесс
+    await supervisor.stop()
+
+    latencies.sort()
+    return {
+        "workers": workers,
+        "updates": len(latencies),
+        "failed": failed,
+        "duration_sec": round(duration, 3),
+        "updates_per_sec": round(len(latencies) / duration, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+async def main(args):
+    scripts = load_replay(args.replay) if args.replay else generate(args.users, args.seed)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for script in scripts:
+                f.writelines(json.dumps(raw, ensure_ascii=False) + "\n" for raw in script)
+        print(f"Апдейты записаны в {args.record}")
+
+    # Доставка не входит в замер: задачи только проходят через общую очередь
+    async def _discard(job):
+        pass
+
+    delivery_queue.register("group", _discard)
+    delivery_queue.register("email", _discard)
+    await delivery_queue.start(poll_interval=0.2)
+
+    runs = []
+    for workers in args.workers:
+        result = await run(workers, scripts, args.api_latency_ms / 1000)
+        runs.append(result)
+        print(f"воркеров: {workers:>2} | апдейтов/с: {result['updates_per_sec']:>8.1f} | "
+              f"p50: {result['p50_ms']:>7.2f} мс | p95: {result['p95_ms']:>8.2f} мс | "
+              f"не обработано: {result['failed']}")
+    await delivery_queue.stop()
+
+    cpus = os.cpu_count()
+    if cpus and max(args.workers) > cpus:
+        print(f"Процессоров: {cpus} - воркеров больше, чем ядер, рост пропускной способности не ожидается")
+    output = args.output or os.path.join("benchmarks", "results",
+                                         f"scale_out_{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "config": {"users": len(scripts), "api_latency_ms": args.api_latency_ms,
+                              "replay": args.replay, "seed": args.seed, "cpus": cpus,
+                              "python": sys.version.split()[0]},
+                   "runs": runs}, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+
+def parse_args(argv: list[str]):
+    parser = argparse.ArgumentParser(description="Пропускная способность режима супервизора по числу воркеров")
+    parser.add_argument("--workers", type=lambda value: [int(part) for part in value.split(",")],
+                        default=[1, 2, 4, 8], help="числа воркеров через запятую")
+    parser.add_argument("--users", type=int, default=500, help="число виртуальных пользователей")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="имитация времени ответа Bot API")
+    parser.add_argument("--replay", help="JSONL с апдейтами вместо сгенерированных сценариев")
+    parser.add_argument("--record", help="сохранить апдейты прогона в JSONL для повторного использования")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл результатов (по умолчанию benchmarks/results/)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args(sys.argv[1:])))
+    finally:
+        shutil.rmtree(_TMP_DIR, ignore_errors=True)
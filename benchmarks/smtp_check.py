@@ -0,0 +1,281 @@
+# file: benchmarks/smtp_check.py
+"""
+Проверка asyncio SMTP-клиента (async_smtp) на локальном aiosmtpd, без внешнего сервера:
+- plain: письмо доходит целиком (тема, тело, вложение);
+- STARTTLS + AUTH: неверный пароль - SMTPAuthenticationError, верный - письмо доставлено по TLS;
+- implicit SSL (порт как у 465);
+- отказы сервера: получатель - SMTPRecipientsRefused, отправитель - SMTPSenderRefused,
+  письмо после DATA - SMTPDataError; все они - SMTPException, и соединение после отказа продолжает работать;
+- PIPELINING: MAIL FROM / RCPT TO / DATA уходят одной записью, если сервер объявил расширение,
+  и по одной команде, если нет; сервер без STARTTLS - SMTPNotSupportedError;
+- разрыв после точки, завершающей письмо: пул (и этот, и пул на потоках из smtp_pool) не отправляет письмо
+  повторно (сервер мог его принять), а передает SMTPServerDisconnected очереди доставки;
+- концы строк: в данных DATA нет голого LF (в том числе в перенесенной длинной кириллической теме),
+  а тема доходит до сервера без искажений.
+
+Сертификат для TLS - самоподписанный, создается через openssl во временном каталоге
+и подключается клиенту через SSL_CERT_FILE (без openssl TLS-проверки пропускаются).
+
+Запуск (нужен aiosmtpd): python -m benchmarks.smtp_check
+"""
+import asyncio
+import email
+import re
+import email.policy
+import io
+import os
+import shutil
+import smtplib
+import ssl
+import subprocess
+import sys
+import tempfile
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+from async_smtp import AsyncSMTPConnection, AsyncSMTPConnectionPool
+from email_stream import StreamingEmail
+from smtp_pool import SMTPConnectionPool
+
+HOST = "localhost"
+PORTS = {"plain": 8029, "starttls": 8030, "ssl": 8031, "no_pipelining": 8032, "drop": 8033}
+USERNAME, PASSWORD = "bot@example.com", "secret"
+ATTACHMENT = os.urandom(64 * 1024)
+# Тема длиннее одной закодированной строки: Header переносит ее на несколько строк
+LONG_SUBJECT = "Новая заявка о нарушении: незаконная свалка мусора возле дома по улице Ленина"
+
+
+class _Handler:
+    """Принимает письма; отказывает получателю refused@, отправителю blocked@ и письмам с темой "reject" """
+
+    def __init__(self, pipelining: bool = True, drop_after_data: bool = False):
+        self.pipelining = pipelining
+        self.drop_after_data = drop_after_data
+        self.messages: list[email.message.Message] = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        if self.pipelining:
+            responses.insert(-1, "250-PIPELINING")
+        return responses
+
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        if address.startswith("blocked@"):
+            return "550 5.7.1 Sender blocked"
+        envelope.mail_from = address
+        return "250 OK"
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("refused@"):
+            return "550 5.1.1 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        message = email.message_from_bytes(envelope.content, policy=email.policy.default)
+        if message["Subject"] == "reject":
+            return "554 5.6.0 Message rejected"
+        self.messages.append(message)
+        if self.drop_after_data:
+            # Письмо принято, но ответ до клиента не доходит
+            server.transport.close()
+        return "250 OK"
+
+
+def _authenticator(server, session, envelope, mechanism, auth_data):
+    # handled=False: ответ 535 на неверный пароль отправляет сам aiosmtpd (по умолчанию handled=True - без ответа)
+    return AuthResult(success=auth_data.login == USERNAME.encode() and auth_data.password == PASSWORD.encode(),
+                      handled=False)
+
+
+class _CountingConnection(AsyncSMTPConnection):
+    """Считает записи в сокет: по ним видно, ушли ли команды конверта одним пакетом"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes = 0
+
+    async def _write(self, data: bytes):
+        self.writes += 1
+        await super()._write(data)
+
+
+def _message(recipient: str = "admin@example.com", sender: str = USERNAME, subject: str = "Заявка") -> StreamingEmail:
+    return StreamingEmail(sender, recipient, subject, "<p>Тело заявки</p>",
+                          attachment=io.BytesIO(ATTACHMENT), attachment_name="photo.jpg")
+
+
+def _make_certificate(directory: str) -> tuple[str, str] | None:
+    if shutil.which("openssl") is None:
+        return None
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-keyout", key, "-out", cert, "-subj", f"/CN={HOST}",
+                    "-addext", f"subjectAltName=DNS:{HOST},IP:127.0.0.1"],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+class Checks:
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name: str, ok: bool, detail: str = ""):
+        self.failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} | {name}{f' ({detail})' if detail else ''}")
+
+    async def expect(self, name: str, call, error: type[Exception]):
+        try:
+            await call
+        except error as e:
+            self.check(name, isinstance(e, smtplib.SMTPException), f"{type(e).__name__}")
+        except Exception as e:
+            self.check(name, False, f"ожидалось {error.__name__}, получено {type(e).__name__}: {e}")
+        else:
+            self.check(name, False, f"ожидалось {error.__name__}, ошибки нет")
+
+
+def _delivered(handler: _Handler) -> bool:
+    if not handler.messages:
+        return False
+    message = handler.messages[-1]
+    attachments = [part.get_payload(decode=True) for part in message.walk() if part.get_filename()]
+    return message["Subject"] == "Заявка" and attachments == [ATTACHMENT]
+
+
+async def check_plain(checks: Checks, handler: _Handler):
+    conn = _CountingConnection(HOST, PORTS["plain"], security="plain", timeout=5)
+    await conn.connect()
+    checks.check("plain: сервер объявил PIPELINING", "pipelining" in conn.extensions)
+
+    conn.writes = 0
+    await conn.send_streaming(_message())
+    checks.check("plain: письмо доставлено целиком", _delivered(handler))
+    # Запись команд конверта одна, дальше - чанки тела и завершающая точка
+    envelope_writes = conn.writes - len(list(_message().iter_data())) - 1
+    checks.check("pipelining: MAIL/RCPT/DATA одной записью", envelope_writes == 1, f"записей: {envelope_writes}")
+
+    await checks.expect("отказ получателю -> SMTPRecipientsRefused",
+                        conn.send_streaming(_message("refused@example.com")), smtplib.SMTPRecipientsRefused)
+    await checks.expect("отказ отправителю -> SMTPSenderRefused",
+                        conn.send_streaming(_message(sender="blocked@example.com")), smtplib.SMTPSenderRefused)
+    await checks.expect("отказ после DATA -> SMTPDataError",
+                        conn.send_streaming(_message(subject="reject")), smtplib.SMTPDataError)
+    handler.messages.clear()
+    await conn.send_streaming(_message())
+    checks.check("соединение работает после отказов", _delivered(handler))
+    await checks.expect("нет STARTTLS -> SMTPNotSupportedError",
+                        AsyncSMTPConnection(HOST, PORTS["plain"], security="starttls", timeout=5).connect(),
+                        smtplib.SMTPNotSupportedError)
+    await conn.quit()
+
+
+async def check_line_endings(checks: Checks, handler: _Handler):
+    data = b"".join(_message(subject=LONG_SUBJECT).iter_data())
+    headers = data.split(b"\r\n\r\n", 1)[0]
+    checks.check("длинная тема перенесена на несколько строк", b"\r\n =?utf-8?" in headers)
+    bare = len(re.findall(rb"(?<!\r)\n", data))
+    checks.check("нет голого LF в данных DATA", not bare, f"голых LF: {bare}")
+
+    conn = AsyncSMTPConnection(HOST, PORTS["plain"], security="plain", timeout=5)
+    await conn.connect()
+    handler.messages.clear()
+    await conn.send_streaming(_message(subject=LONG_SUBJECT))
+    await conn.quit()
+    received = handler.messages[-1]["Subject"] if handler.messages else None
+    checks.check("длинная тема доставлена без искажений", received == LONG_SUBJECT, repr(received))
+
+
+async def check_no_pipelining(checks: Checks, handler: _Handler):
+    conn = _CountingConnection(HOST, PORTS["no_pipelining"], security="plain", timeout=5)
+    await conn.connect()
+    conn.writes = 0
+    await conn.send_streaming(_message())
+    envelope_writes = conn.writes - len(list(_message().iter_data())) - 1
+    checks.check("без PIPELINING: команды по одной", envelope_writes == 3 and _delivered(handler),
+                 f"записей: {envelope_writes}")
+    await checks.expect("без PIPELINING: отказ получателю -> SMTPRecipientsRefused",
+                        conn.send_streaming(_message("refused@example.com")), smtplib.SMTPRecipientsRefused)
+    await conn.quit()
+
+
+async def check_drop_after_data(checks: Checks, handler: _Handler):
+    pool = AsyncSMTPConnectionPool(HOST, PORTS["drop"], None, None, size=1, security="plain", timeout=5)
+    await checks.expect("разрыв после точки -> SMTPServerDisconnected", pool.send_streaming(_message()),
+                        smtplib.SMTPServerDisconnected)
+    checks.check("разрыв после точки: письмо не отправлено повторно", len(handler.messages) == 1,
+                 f"доставлено: {len(handler.messages)}")
+    await pool.close()
+
+    handler.messages.clear()
+    threaded = SMTPConnectionPool(HOST, PORTS["drop"], None, None, size=1, security="plain", timeout=5)
+    await checks.expect("пул на потоках: разрыв после точки -> SMTPServerDisconnected",
+                        asyncio.to_thread(threaded.send_streaming, _message()), smtplib.SMTPServerDisconnected)
+    checks.check("пул на потоках: письмо не отправлено повторно", len(handler.messages) == 1,
+                 f"доставлено: {len(handler.messages)}")
+    threaded.close()
+
+
+async def check_starttls(checks: Checks, handler: _Handler):
+    await checks.expect("STARTTLS: неверный пароль -> SMTPAuthenticationError",
+                        AsyncSMTPConnectionPool(HOST, PORTS["starttls"], USERNAME, "wrong", size=1,
+                                                security="starttls", timeout=5).send_streaming(_message()),
+                        smtplib.SMTPAuthenticationError)
+    pool = AsyncSMTPConnectionPool(HOST, PORTS["starttls"], USERNAME, PASSWORD, size=2, security="starttls", timeout=5)
+    await asyncio.gather(*(pool.send_streaming(_message()) for _ in range(4)))
+    checks.check("STARTTLS + AUTH: 4 письма через пул", len(handler.messages) == 4 and _delivered(handler),
+                 f"доставлено: {len(handler.messages)}")
+    await pool.close()
+
+
+async def check_ssl(checks: Checks, handler: _Handler):
+    pool = AsyncSMTPConnectionPool(HOST, PORTS["ssl"], None, None, size=1, security="ssl", timeout=5)
+    await pool.send_streaming(_message())
+    checks.check("implicit SSL: письмо доставлено", _delivered(handler))
+    await pool.close()
+
+
+async def main() -> int:
+    checks = Checks()
+    tmp_dir = tempfile.mkdtemp(prefix="smtp-check-")
+    controllers = []
+    try:
+        handlers = {name: _Handler(pipelining=name != "no_pipelining", drop_after_data=name == "drop")
+                    for name in PORTS}
+        controllers = [Controller(handlers[name], hostname=HOST, port=PORTS[name])
+                       for name in ("plain", "no_pipelining", "drop")]
+        certificate = _make_certificate(tmp_dir)
+        if certificate:
+            server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            server_context.load_cert_chain(*certificate)
+            # Клиент проверяет сертификат по умолчанию (ssl.create_default_context): доверяем самоподписанному
+            os.environ["SSL_CERT_FILE"] = certificate[0]
+            controllers.append(Controller(handlers["starttls"], hostname=HOST, port=PORTS["starttls"],
+                                          tls_context=server_context, require_starttls=True,
+                                          authenticator=_authenticator, auth_require_tls=True))
+            controllers.append(Controller(handlers["ssl"], hostname=HOST, port=PORTS["ssl"],
+                                          ssl_context=server_context))
+        for controller in controllers:
+            controller.start()
+
+        await check_plain(checks, handlers["plain"])
+        await check_line_endings(checks, handlers["plain"])
+        await check_no_pipelining(checks, handlers["no_pipelining"])
+        await check_drop_after_data(checks, handlers["drop"])
+        if certificate:
+            await check_starttls(checks, handlers["starttls"])
+            await check_ssl(checks, handlers["ssl"])
+        else:
+            print("skip | openssl не найден: STARTTLS и SSL не проверены")
+    finally:
+        for controller in controllers:
+            controller.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print("Все проверки пройдены" if not checks.failed else f"Не пройдено проверок: {checks.failed}")
+    return 1 if checks.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
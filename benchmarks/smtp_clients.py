@@ -0,0 +1,89 @@
+# file: benchmarks/smtp_clients.py
+"""
+Одновременная отправка писем: пул smtplib в потоках (to_thread) против asyncio-клиента.
+Локальный aiosmtpd отвечает на DATA с задержкой, имитируя удаленный сервер.
+
+Запуск (нужен aiosmtpd): python -m benchmarks.smtp_clients [писем] [задержка_мс]
+"""
+import asyncio
+import io
+import statistics
+import sys
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+
+from async_smtp import AsyncSMTPConnectionPool
+from email_stream import StreamingEmail
+from smtp_pool import SMTPConnectionPool
+
+HOST, PORT = "127.0.0.1", 8028
+POOL_SIZES = (4, 16, 64)
+ATTACHMENT = b"\0" * (16 * 1024)
+
+
+class _SlowHandler:
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.delay)
+        return "250 OK"
+
+
+def _message() -> StreamingEmail:
+    return StreamingEmail("bench@example.com", "bench@example.com", "benchmark", "<p>benchmark</p>",
+                          attachment=io.BytesIO(ATTACHMENT), attachment_name="photo.jpg")
+
+
+async def _run(pool, send, emails: int) -> tuple[float, list[float], int]:
+    latencies = []
+    peak_threads = threading.active_count()
+
+    async def one():
+        nonlocal peak_threads
+        started = time.perf_counter()
+        await send(pool, _message())
+        latencies.append(time.perf_counter() - started)
+        peak_threads = max(peak_threads, threading.active_count())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(emails)))
+    return time.perf_counter() - started, latencies, peak_threads
+
+
+async def _send_thread(pool: SMTPConnectionPool, message: StreamingEmail):
+    await asyncio.to_thread(pool.send_streaming, message)
+
+
+async def _send_async(pool: AsyncSMTPConnectionPool, message: StreamingEmail):
+    await pool.send_streaming(message)
+
+
+async def main(emails: int, delay_ms: float):
+    controller = Controller(_SlowHandler(delay_ms / 1000), hostname=HOST, port=PORT)
+    controller.start()
+    try:
+        print(f"{emails} писем по {len(ATTACHMENT) // 1024} КБ, ответ сервера на DATA через {delay_ms:.0f} мс")
+        print(f"{'клиент':<8} | {'пул':>4} | {'всего, мс':>10} | {'писем/с':>8} | {'p50, мс':>8} | "
+              f"{'p95, мс':>8} | {'потоков':>7}")
+        for size in POOL_SIZES:
+            for name, pool_class, send in (("thread", SMTPConnectionPool, _send_thread),
+                                           ("asyncio", AsyncSMTPConnectionPool, _send_async)):
+                pool = pool_class(HOST, PORT, None, None, size=size, security="plain")
+                total, latencies, threads = await _run(pool, send, emails)
+                if isinstance(pool, AsyncSMTPConnectionPool):
+                    await pool.close()
+                else:
+                    await asyncio.to_thread(pool.close)
+                quantiles = statistics.quantiles(latencies, n=100)
+                print(f"{name:<8} | {size:>4} | {total * 1000:>10.0f} | {emails / total:>8.1f} | "
+                      f"{quantiles[49] * 1000:>8.0f} | {quantiles[94] * 1000:>8.0f} | {threads:>7}")
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+                     float(sys.argv[2]) if len(sys.argv) > 2 else 50))
@@ -1,17 +1,44 @@
 # file: bot.py
 import asyncio
+import functools
 import logging
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
-from config import BOT_TOKEN, admin_group_id
+from config import (BOT_TOKEN, BOT_MODE, BOT_WORKERS, DELIVERY_POLL_INTERVAL_SEC, DROP_PENDING_UPDATES, EMAIL_ENABLED,
+                    MEDIA_LINKS_ENABLED, METRICS_ENABLED, TRACING_ENABLED, admin_group_id)
+from delivery_queue import delivery_queue
+from fsm_storage import create_event_isolation, create_storage
 from handlers import router as main_router
+from handlers.common import draft_expired
+from logic import close_smtp_pool, register_delivery_handlers, run_smtp_keepalive
+from media_cache import media_cache
+from media_links import run_cleanup as run_media_links_cleanup, start_media_server
+from media_prefetch import media_prefetcher
+from media_transcode import shutdown_executor
+from metrics_server import start_metrics_server
+from report_dedup import report_dedup
+from middlewares import setup_middlewares, setup_session_middlewares
+from supervisor import run_supervised_polling
+from tracing import exporter as trace_exporter
+from webhook import run_webhook
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
+
+def create_bot(rate_share: float = 1.0) -> Bot:
+    """Бот с лимитами отправки; в режиме воркеров каждый процесс создает свой с долей общего лимита"""
+    bot = Bot(
+        token=BOT_TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+    setup_session_middlewares(bot, rate_share)
+    return bot
+
+
 # Главная функция для запуска бота
 async def main():
     # Проверка наличия обязательных переменных окружения
@@ -19,21 +46,79 @@ async def main():
         logging.critical("!!! ОШИБКА: BOT_TOKEN или GROUP_ID не установлены в .env файле. Бот не может запуститься.")
         return
 
+    # Несколько процессов-воркеров (BOT_WORKERS): этот процесс получает апдейты и доставляет заявки
+    supervised = BOT_WORKERS > 1
+    if supervised and BOT_MODE == "webhook":
+        logging.warning("BOT_WORKERS поддерживается только в режиме поллинга, бот запускается одним процессом")
+        supervised = False
+
     # Инициализация бота и диспетчера
-    bot = Bot(
-        token=BOT_TOKEN,
-        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-    )
-    dp = Dispatcher()
+    bot = create_bot(1 / (BOT_WORKERS + 1) if supervised else 1.0)
+    # Хранилище состояний выбирается в .env (FSM_STORAGE): memory, sqlite или redis.
+    # Апдейты одного чата обрабатываются по очереди (EVENT_ISOLATION), разных - параллельно.
+    # Брошенные анкеты в памяти удаляются по сроку и лимиту; пользователь получает уведомление
+    storage = create_storage(on_expire=functools.partial(draft_expired, bot))
+    dp = Dispatcher(storage=storage, events_isolation=create_event_isolation(storage))
 
-    # Подключение главного роутера
+    # Подключение главного роутера и middleware
     dp.include_router(main_router)
+    setup_middlewares(dp)
 
     logging.info("Бот запускается...")
 
-    # Удаление старых вебхуков и запуск поллинга
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # Запуск очереди доставки (незавершенные после перезапуска заявки будут досланы автоматически)
+    # (в режиме воркеров задачи ставят другие процессы, поэтому очередь еще и периодически проверяется)
+    register_delivery_handlers(bot)
+    await delivery_queue.start(poll_interval=DELIVERY_POLL_INTERVAL_SEC if supervised else None)
+
+    # Фоновый keepalive для пула SMTP-соединений
+    smtp_keepalive_task = None
+    if EMAIL_ENABLED:
+        smtp_keepalive_task = asyncio.create_task(run_smtp_keepalive())
+
+    # Ссылки на медиа в письмах: очистка устаревших файлов и HTTP-сервер (в режиме вебхука - общий с вебхуком)
+    media_links_cleanup_task = None
+    media_server = None
+    if MEDIA_LINKS_ENABLED:
+        media_links_cleanup_task = asyncio.create_task(run_media_links_cleanup())
+        if BOT_MODE != "webhook":
+            media_server = await start_media_server()
+
+    # Метрики Prometheus на локальном порту
+    metrics_server = await start_metrics_server() if METRICS_ENABLED else None
+
+    # Сброс спанов трассировки в файл
+    trace_export_task = asyncio.create_task(trace_exporter.run()) if TRACING_ENABLED else None
+
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        elif supervised:
+            await run_supervised_polling(bot, dp, create_bot, BOT_WORKERS)
+        else:
+            # Удаление старых вебхуков и запуск поллинга
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            await dp.start_polling(bot)
+    finally:
+        await delivery_queue.stop()
+        await report_dedup.close()
+        await media_prefetcher.close()
+        await media_cache.close()
+        shutdown_executor()
+        if smtp_keepalive_task:
+            smtp_keepalive_task.cancel()
+            await close_smtp_pool()
+        if media_links_cleanup_task:
+            media_links_cleanup_task.cancel()
+        if media_server:
+            await media_server.cleanup()
+        if metrics_server:
+            await metrics_server.cleanup()
+        if trace_export_task:
+            trace_export_task.cancel()
+            # Спаны доставок, завершившихся при остановке
+            await trace_exporter.flush()
+        await bot.session.close()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 # file: config.py
 import os
 import logging
+import shutil
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из файла .env
@@ -10,12 +11,63 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_ID = os.getenv("GROUP_ID")
 
+# --- Режим получения апдейтов ---
+# polling - опрос getUpdates, webhook - aiohttp-сервер, на который Telegram присылает апдейты
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Удалять ли накопившиеся за время простоя апдейты при запуске (по умолчанию - нет, заявки не теряются)
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "false").lower() in ("1", "true", "yes")
+# Публичный адрес (https://example.com), по которому Telegram доступен вебхук; пусто - локальный режим
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько апдейтов обрабатывается одновременно (остальные ждут своей очереди)
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "40"))
+# Сколько ждать завершения текущих хэндлеров при остановке (секунды)
+WEBHOOK_DRAIN_TIMEOUT_SEC = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SEC", "30"))
+
+# --- Ограничение исходящих сообщений (лимиты Telegram) ---
+# Общий лимит бота (Telegram: ~30 сообщений в секунду)
+RATE_LIMIT_GLOBAL_PER_SEC = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SEC", "25"))
+# Личный чат: ~1 сообщение в секунду, с небольшим запасом на несколько сообщений подряд
+RATE_LIMIT_PRIVATE_PER_SEC = float(os.getenv("RATE_LIMIT_PRIVATE_PER_SEC", "1"))
+RATE_LIMIT_PRIVATE_BURST = int(os.getenv("RATE_LIMIT_PRIVATE_BURST", "5"))
+# Группа (в т.ч. группа администраторов): ~20 сообщений в минуту
+RATE_LIMIT_GROUP_PER_MIN = float(os.getenv("RATE_LIMIT_GROUP_PER_MIN", "20"))
+# Сколько раз повторять вызов после ответа RetryAfter, прежде чем вернуть ошибку
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+
 # --- Настройки SMTP для email ---
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = os.getenv("SMTP_PORT")
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 SENDER_PASSWORD = os.getenv("SENDER_PASSWORD")
 RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL")
+# Email отправляется, только если заданы все настройки SMTP
+EMAIL_ENABLED = all([SMTP_SERVER, SMTP_PORT, SENDER_EMAIL, SENDER_PASSWORD, RECIPIENT_EMAIL])
+# Режим защиты соединения: ssl (порт 465), starttls (порт 587) или plain (локальный тестовый сервер)
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "ssl").lower()
+# Клиент SMTP: asyncio (без потоков, с PIPELINING) или thread (smtplib в пуле потоков)
+SMTP_CLIENT = os.getenv("SMTP_CLIENT", "asyncio").lower()
+# Таймаут подключения и ожидания ответа сервера (секунды)
+SMTP_TIMEOUT_SEC = float(os.getenv("SMTP_TIMEOUT_SEC", "30"))
+
+# --- Сводка заявок на email ---
+# Вместо отдельного письма на каждую заявку заявки копятся и отправляются одним письмом:
+# раз в INTERVAL секунд, при накоплении MAX_REPORTS заявок или MAX_MB вложений (что наступит раньше)
+EMAIL_DIGEST_ENABLED = os.getenv("EMAIL_DIGEST_ENABLED", "false").lower() in ("1", "true", "yes")
+EMAIL_DIGEST_INTERVAL_SEC = float(os.getenv("EMAIL_DIGEST_INTERVAL_SEC", "300"))
+EMAIL_DIGEST_MAX_REPORTS = int(os.getenv("EMAIL_DIGEST_MAX_REPORTS", "20"))
+EMAIL_DIGEST_MAX_BYTES = int(os.getenv("EMAIL_DIGEST_MAX_MB", "20")) * 1024 * 1024
+
+# --- Пул SMTP-соединений ---
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+# Как часто проверять свободные соединения командой NOOP (секунды)
+SMTP_POOL_KEEPALIVE_SEC = float(os.getenv("SMTP_POOL_KEEPALIVE_SEC", "60"))
+# Сколько свободное соединение может простаивать, прежде чем его закроют (секунды)
+SMTP_POOL_MAX_IDLE_SEC = float(os.getenv("SMTP_POOL_MAX_IDLE_SEC", "300"))
 
 # --- Валидация и преобразование ID группы ---
 try:
@@ -25,6 +77,48 @@ except (ValueError, TypeError):
     logging.critical("GROUP_ID не найден или имеет неверный формат в .env!")
     admin_group_id = 0
 
+# --- Очередь доставки заявок (группа администраторов и email) ---
+# Файл SQLite, в котором хранятся еще не доставленные заявки
+DELIVERY_QUEUE_PATH = os.getenv("DELIVERY_QUEUE_PATH", "data/delivery_queue.sqlite3")
+# Сколько задач доставки выполняется одновременно
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "4"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "10"))
+# Экспоненциальная задержка между попытками: base * 2^(попытка-1), но не больше max (секунды)
+DELIVERY_BACKOFF_BASE_SEC = float(os.getenv("DELIVERY_BACKOFF_BASE_SEC", "2"))
+DELIVERY_BACKOFF_MAX_SEC = float(os.getenv("DELIVERY_BACKOFF_MAX_SEC", "600"))
+# Через сколько секунд "зависшая" задача (процесс упал во время отправки) будет взята повторно
+DELIVERY_LEASE_SEC = float(os.getenv("DELIVERY_LEASE_SEC", "300"))
+
+# Как публиковать заявку в группе администраторов:
+# full - геометка отдельным сообщением с картой, compact - ссылкой на карту в подписи (меньше вызовов Bot API)
+GROUP_DELIVERY_POLICY = os.getenv("GROUP_DELIVERY_POLICY", "compact").lower()
+
+# --- Хранилище состояний анкеты (FSM) ---
+# memory - в памяти процесса (теряется при перезапуске), sqlite - файл на диске, redis - Redis-совместимый сервер
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").lower()
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "data/fsm.sqlite3")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Через сколько секунд без изменений незаполненная анкета считается брошенной и удаляется
+FSM_STATE_TTL_SEC = float(os.getenv("FSM_STATE_TTL_SEC", str(24 * 60 * 60)))
+# memory: лимит анкет в памяти - по числу и по объему (байты JSON); сверх лимита вытесняются давно не
+# использованные. 0 - без лимита
+FSM_MEMORY_MAX_SESSIONS = int(os.getenv("FSM_MEMORY_MAX_SESSIONS", "100000"))
+FSM_MEMORY_MAX_BYTES = int(os.getenv("FSM_MEMORY_MAX_BYTES", str(100 * 1024 * 1024)))
+# memory: как часто проверять сроки брошенных анкет (секунды)
+FSM_REAP_INTERVAL_SEC = float(os.getenv("FSM_REAP_INTERVAL_SEC", "60"))
+# memory: сообщать пользователю, что его незаконченная заявка удалена
+FSM_EXPIRED_NOTICE = os.getenv("FSM_EXPIRED_NOTICE", "true").lower() in ("1", "true", "yes")
+# SQLite: изменения сбрасываются на диск пачкой раз в интервал или при накоплении batch_size ключей
+FSM_FLUSH_INTERVAL_SEC = float(os.getenv("FSM_FLUSH_INTERVAL_SEC", "0.1"))
+FSM_FLUSH_BATCH_SIZE = int(os.getenv("FSM_FLUSH_BATCH_SIZE", "100"))
+# Очередность апдейтов одного чата: memory - блокировки в процессе, redis - общие для нескольких процессов
+# (через REDIS_URL), none - без блокировок. Без них два быстрых нажатия "Отправить" отправят заявку дважды
+EVENT_ISOLATION = os.getenv("EVENT_ISOLATION", "redis" if FSM_STORAGE == "redis" else "memory").lower()
+# Redis: через сколько секунд блокировка снимается сама (если процесс упал посреди апдейта)
+EVENT_LOCK_TIMEOUT_SEC = float(os.getenv("EVENT_LOCK_TIMEOUT_SEC", "60"))
+# Redis: сколько апдейт ждет блокировку своего чата, прежде чем завершиться ошибкой
+EVENT_LOCK_WAIT_SEC = float(os.getenv("EVENT_LOCK_WAIT_SEC", "30"))
+
 # --- Регулярные выражения для валидации ---
 PHONE_REGEX = r"^\+?[78][-\s(]*\d{3}[-\s)]*\d{3}[-\s]*\d{2}[-\s]*\d{2}$"
 EMAIL_REGEX = r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$"
@@ -39,4 +133,91 @@ MAX_VIDEO_SIZE_BYTES = MAX_VIDEO_SIZE_MB * 1024 * 1024
 # Лимит Telegram ~8MB. Ставим 10MB с запасом.
 MAX_VIDEO_NOTE_SIZE_MB = 10
 MAX_VIDEO_NOTE_SIZE_BYTES = MAX_VIDEO_NOTE_SIZE_MB * 1024 * 1024
-# --- ⬆️ КОНЕЦ НОВОГО БЛОКА ⬆️ ---
\ No newline at end of file
+# --- ⬆️ КОНЕЦ НОВОГО БЛОКА ⬆️ ---
+
+# --- Фоновая загрузка медиа ---
+# Медиа для письма начинает скачиваться сразу после получения, а не после нажатия "Отправить"
+MEDIA_PREFETCH_ENABLED = os.getenv("MEDIA_PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# --- Кэш медиа на диске (ключ - file_unique_id) ---
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "data/media_cache")
+# При превышении размера удаляются давно не использованные файлы
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_MB", "500")) * 1024 * 1024
+# Файл, к которому не обращались дольше этого срока, удаляется (секунды)
+MEDIA_CACHE_TTL_SEC = float(os.getenv("MEDIA_CACHE_TTL_SEC", str(7 * 24 * 60 * 60)))
+
+# --- Обработка вложений письма ---
+# Пережимать фото перед отправкой на email (нужен Pillow): уменьшение до MAX_DIMENSION и JPEG с качеством QUALITY.
+# EXIF удаляется, кроме GPS-координат
+EMAIL_IMAGE_RECOMPRESS = os.getenv("EMAIL_IMAGE_RECOMPRESS", "false").lower() in ("1", "true", "yes")
+EMAIL_IMAGE_MAX_DIMENSION = int(os.getenv("EMAIL_IMAGE_MAX_DIMENSION", "1920"))
+EMAIL_IMAGE_QUALITY = int(os.getenv("EMAIL_IMAGE_QUALITY", "80"))
+# Прикладывать к видео кадр-превью (только если найден ffmpeg)
+EMAIL_VIDEO_POSTER = os.getenv("EMAIL_VIDEO_POSTER", "true").lower() in ("1", "true", "yes")
+FFMPEG_PATH = os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg")
+# Число процессов для обработки изображений
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+
+# --- Медиа по ссылке вместо вложения в письмо ---
+# Файл сохраняется на сервере, а в письмо вставляется подписанная ссылка с ограниченным сроком действия
+MEDIA_LINKS_ENABLED = os.getenv("MEDIA_LINKS_ENABLED", "false").lower() in ("1", "true", "yes")
+# Внешний адрес бота, по которому доступны ссылки (в режиме вебхука по умолчанию - WEBHOOK_URL)
+MEDIA_LINKS_BASE_URL = os.getenv("MEDIA_LINKS_BASE_URL") or WEBHOOK_URL
+MEDIA_LINKS_PATH = os.getenv("MEDIA_LINKS_PATH", "/media")
+MEDIA_LINKS_DIR = os.getenv("MEDIA_LINKS_DIR", "data/media_links")
+# Сколько хранится файл и действует ссылка (секунды)
+MEDIA_LINKS_RETENTION_SEC = float(os.getenv("MEDIA_LINKS_RETENTION_SEC", str(30 * 24 * 60 * 60)))
+# Ключ подписи ссылок (если не задан - выводится из токена бота)
+MEDIA_LINKS_SECRET = os.getenv("MEDIA_LINKS_SECRET")
+# Адрес HTTP-сервера ссылок в режиме поллинга (в режиме вебхука используется сервер вебхука)
+MEDIA_LINKS_HOST = os.getenv("MEDIA_LINKS_HOST", "0.0.0.0")
+MEDIA_LINKS_PORT = int(os.getenv("MEDIA_LINKS_PORT", "8081"))
+if MEDIA_LINKS_ENABLED and not MEDIA_LINKS_BASE_URL:
+    logging.warning("MEDIA_LINKS_ENABLED включен, но не задан MEDIA_LINKS_BASE_URL: медиа отправляется вложением")
+    MEDIA_LINKS_ENABLED = False
+
+# --- Метрики (Prometheus) ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Отдельный сервер только для локального сбора метрик, не на публичном порту вебхука
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# --- Трассировка заявок ---
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+# Доля анкет, для которых пишутся спаны (решение принимается в /start для всей заявки)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "data/traces.jsonl")
+TRACE_FLUSH_INTERVAL_SEC = float(os.getenv("TRACE_FLUSH_INTERVAL_SEC", "5"))
+
+# --- Несколько процессов-воркеров ---
+# 1 - обычный режим; больше 1 - процесс-супервизор получает апдейты и раздает их воркерам по from_user.id
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Как часто процессы проверяют общую очередь доставки на задачи, поставленные воркерами (секунды)
+DELIVERY_POLL_INTERVAL_SEC = float(os.getenv("DELIVERY_POLL_INTERVAL_SEC", "1"))
+# После стольких падений воркера за минуту его пользователи переходят к остальным воркерам
+WORKER_MAX_RESTARTS_PER_MIN = int(os.getenv("WORKER_MAX_RESTARTS_PER_MIN", "5"))
+# Сколько ждать, пока воркеры доработают апдейты при остановке (секунды)
+WORKER_DRAIN_TIMEOUT_SEC = float(os.getenv("WORKER_DRAIN_TIMEOUT_SEC", "30"))
+
+# --- Защита от повторной отправки заявки ---
+# Сколько помнить ключи принятых заявок (секунды); с FSM_STORAGE=sqlite или redis ключи переживают перезапуск
+REPORT_DEDUP_TTL_SEC = float(os.getenv("REPORT_DEDUP_TTL_SEC", str(24 * 60 * 60)))
+# Сколько ключей держать в памяти процесса (самые старые вытесняются)
+REPORT_DEDUP_MAX_KEYS = int(os.getenv("REPORT_DEDUP_MAX_KEYS", "100000"))
+
+# --- Анти-флуд (входящие апдейты пользователя) ---
+# Лишние апдейты отбрасываются до чтения анкеты; на окно - одно предупреждение "слишком часто"
+ANTIFLOOD_ENABLED = os.getenv("ANTIFLOOD_ENABLED", "true").lower() in ("1", "true", "yes")
+# Token bucket: апдейтов в секунду в среднем и запас на всплеск (альбом из 10 фото - один всплеск)
+ANTIFLOOD_RATE_PER_SEC = float(os.getenv("ANTIFLOOD_RATE_PER_SEC", "1"))
+ANTIFLOOD_BURST = float(os.getenv("ANTIFLOOD_BURST", "10"))
+# Скользящее окно: не больше ANTIFLOOD_WINDOW_LIMIT апдейтов за ANTIFLOOD_WINDOW_SEC секунд
+ANTIFLOOD_WINDOW_SEC = float(os.getenv("ANTIFLOOD_WINDOW_SEC", "60"))
+ANTIFLOOD_WINDOW_LIMIT = int(os.getenv("ANTIFLOOD_WINDOW_LIMIT", "40"))
+# На скорость и длину окна анти-флуд делит: нулевые и отрицательные значения - ошибка настройки
+if ANTIFLOOD_RATE_PER_SEC <= 0:
+    logging.critical(f"ANTIFLOOD_RATE_PER_SEC={ANTIFLOOD_RATE_PER_SEC} должен быть больше 0, используется 1")
+    ANTIFLOOD_RATE_PER_SEC = 1.0
+if ANTIFLOOD_WINDOW_SEC <= 0:
+    logging.critical(f"ANTIFLOOD_WINDOW_SEC={ANTIFLOOD_WINDOW_SEC} должен быть больше 0, используется 60")
+    ANTIFLOOD_WINDOW_SEC = 60.0
@@ -0,0 +1,65 @@
+# file: delivery_planner.py
+from dataclasses import dataclass, field
+
+# Лимит Telegram на длину подписи к медиа
+CAPTION_LIMIT = 1024
+
+# full    - максимальная точность: геометка отдельным сообщением (нативная карта в чате)
+# compact - геометка ссылкой на карту в подписи: на один вызов Bot API меньше
+POLICIES = ("full", "compact")
+
+_MEDIA_METHODS = {
+    'photo': ("send_photo", "photo"),
+    'video': ("send_video", "video"),
+    'video_note': ("send_video_note", "video_note"),
+}
+
+
+@dataclass
+class DeliveryStep:
+    """Один вызов Bot API. name сохраняется в задаче очереди, чтобы не повторять шаг после сбоя"""
+    name: str
+    method: str
+    kwargs: dict = field(default_factory=dict)
+
+
+def map_link(latitude: float, longitude: float) -> str:
+    return f"https://www.google.com/maps/search/?api=1&query={latitude},{longitude}"
+
+
+def plan_group_delivery(payload: dict, chat_id: int) -> list[DeliveryStep]:
+    """
+    Минимальный набор вызовов для публикации заявки в группе.
+    Фото и видео уходят одним сообщением с подписью (если подпись влезает в лимит),
+    кружок не поддерживает подпись - текст идет вторым сообщением.
+    Политика берется из задачи: при повторе план не меняется, даже если поменяли настройки.
+    """
+    caption = payload['caption']
+    media_type = payload.get('media_type')
+    file_id = payload.get('file_id')
+    latitude, longitude = payload.get('latitude'), payload.get('longitude')
+    # Задачи, поставленные до появления политик, уже содержат строку о геометке в подписи
+    policy = payload.get('policy')
+
+    native_location = bool(latitude) and policy in ("full", None)
+    if latitude and policy == "full":
+        caption += "\n\n<b>Местоположение:</b> Геометка (см. ниже)"
+    elif latitude and policy is not None:
+        caption += f'\n\n<b>Местоположение:</b> <a href="{map_link(latitude, longitude)}">открыть на карте</a>'
+
+    steps = []
+    method, argument = _MEDIA_METHODS.get(media_type, (None, None))
+    if method and file_id:
+        if media_type != 'video_note' and len(caption) <= CAPTION_LIMIT:
+            steps.append(DeliveryStep("media", method, {"chat_id": chat_id, argument: file_id, "caption": caption}))
+        else:
+            # Длинная подпись (лимит считается с HTML-тегами, с запасом) или кружок: текст отдельно
+            steps.append(DeliveryStep("media", method, {"chat_id": chat_id, argument: file_id}))
+            steps.append(DeliveryStep("caption", "send_message", {"chat_id": chat_id, "text": caption}))
+    else:
+        steps.append(DeliveryStep("caption", "send_message", {"chat_id": chat_id, "text": caption}))
+
+    if native_location:
+        steps.append(DeliveryStep("location", "send_location",
+                                  {"chat_id": chat_id, "latitude": latitude, "longitude": longitude}))
+    return steps
@@ -0,0 +1,431 @@
+# file: delivery_queue.py
+import asyncio
+import json
+import logging
+import os
+import random
+import smtplib
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import (TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+                                TelegramBadRequest, TelegramForbiddenError, TelegramUnauthorizedError)
+
+import metrics
+from config import (DELIVERY_QUEUE_PATH, DELIVERY_WORKERS, DELIVERY_MAX_ATTEMPTS,
+                    DELIVERY_BACKOFF_BASE_SEC, DELIVERY_BACKOFF_MAX_SEC, DELIVERY_LEASE_SEC)
+
+# --- Метрики очереди ---
+jobs_enqueued = metrics.counter("delivery_jobs_enqueued_total", "Поставлено задач доставки в очередь")
+jobs_delivered = metrics.counter("delivery_jobs_delivered_total", "Успешно доставлено задач")
+jobs_retried = metrics.counter("delivery_jobs_retried_total", "Отложено задач для повторной попытки")
+jobs_failed = metrics.counter("delivery_jobs_failed_total", "Задач, окончательно завершившихся ошибкой")
+queue_depth = metrics.gauge("delivery_queue_depth", "Задач, ожидающих доставки")
+batches_delivered = metrics.counter("delivery_batches_delivered_total", "Доставлено пачек задач (например, сводок писем)")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deliveries_due ON deliveries (status, next_attempt_at);
+"""
+
+
+@dataclass
+class DeliveryJob:
+    id: int
+    kind: str
+    payload: dict
+    attempts: int
+    queue: "DeliveryQueue" = field(repr=False)
+
+    async def checkpoint(self):
+        """Сохраняет прогресс задачи: при повторе уже выполненные шаги не повторяются"""
+        await self.queue._run_db(self.queue._save_payload, self.id, self.payload)
+
+
+@dataclass
+class BatchConsumer:
+    """
+    Обработчик, которому задачи одного типа отдаются пачкой.
+    Пачка собирается, пока не наберется max_jobs задач, суммарный size_of не превысит max_size
+    или самая старая задача не прождет max_wait секунд.
+    """
+    handler: Callable[[list[DeliveryJob]], Awaitable[None]]
+    max_jobs: int
+    max_wait: float
+    max_size: float = float("inf")
+    size_of: Callable[[dict], float] = lambda payload: 0
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class PermanentDeliveryError(Exception):
+    """Ошибка, которую бессмысленно повторять (задача сразу помечается как failed)"""
+
+
+def _retry_delay(error: Exception, attempts: int) -> float | None:
+    """Задержка до следующей попытки или None, если ошибка неисправимая"""
+    if isinstance(error, PermanentDeliveryError):
+        return None
+    if isinstance(error, TelegramRetryAfter):
+        # Telegram сам говорит, сколько ждать
+        return float(error.retry_after)
+    if isinstance(error, (TelegramBadRequest, TelegramForbiddenError, TelegramUnauthorizedError)):
+        return None
+    if isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600:
+        # 5xx - постоянный отказ сервера (неверный адрес, письмо отклонено и т.п.)
+        return None
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return None
+    if not isinstance(error, (TelegramNetworkError, TelegramServerError, smtplib.SMTPException,
+                              OSError, asyncio.TimeoutError)):
+        logging.warning(f"Неизвестная ошибка доставки, будет повтор: {error!r}")
+    # Экспоненциальная задержка с небольшим случайным разбросом
+    delay = min(DELIVERY_BACKOFF_MAX_SEC, DELIVERY_BACKOFF_BASE_SEC * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class DeliveryQueue:
+    """
+    Персистентная очередь доставки заявок (SQLite).
+    Задачи переживают перезапуск бота: незавершенные задачи подхватываются после истечения аренды.
+    """
+
+    def __init__(self, path: str, workers: int = 4, max_attempts: int = 10, lease: float = 300.0):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = lease
+
+        self._handlers: dict[str, Callable[[DeliveryJob], Awaitable[None]]] = {}
+        self._batch_consumers: dict[str, BatchConsumer] = {}
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+        # Если задачи ставят другие процессы (режим с воркерами), их событие сюда не дойдет: проверяем базу периодически
+        self.poll_interval: float | None = None
+
+    def register(self, kind: str, handler: Callable[[DeliveryJob], Awaitable[None]]):
+        self._handlers[kind] = handler
+
+    def register_batch(self, kind: str, consumer: BatchConsumer):
+        """Задачи этого типа обычные воркеры не берут: их пачками забирает отдельная задача"""
+        self._batch_consumers[kind] = consumer
+
+    # --- Работа с базой (вызывается в отдельном потоке) ---
+    def _open(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        db.executescript(_SCHEMA)
+        self._db = db
+
+    async def _run_db(self, func, *args):
+        def call():
+            with self._db_lock:
+                return func(*args)
+        return await asyncio.to_thread(call)
+
+    def _insert(self, kind: str, payload: dict) -> int:
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO deliveries (kind, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        return cursor.lastrowid
+
+    def _insert_many(self, jobs: list[tuple[str, dict]]) -> list[int]:
+        # Одна транзакция: либо поставлены все задачи заявки, либо ни одной
+        self._db.execute("BEGIN")
+        try:
+            job_ids = [self._insert(kind, payload) for kind, payload in jobs]
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return job_ids
+
+    def _claim(self) -> tuple[DeliveryJob | None, float | None]:
+        """Забирает одну готовую задачу. Второе значение - время ближайшей отложенной задачи"""
+        now = time.time()
+        batch_kinds = list(self._batch_consumers)
+        exclude = f"AND kind NOT IN ({', '.join('?' * len(batch_kinds))}) " if batch_kinds else ""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute(
+                "SELECT id, kind, payload, attempts FROM deliveries "
+                "WHERE next_attempt_at <= ? AND (status = 'pending' OR (status = 'in_progress' AND locked_until < ?)) "
+                f"{exclude}ORDER BY next_attempt_at LIMIT 1",
+                (now, now, *batch_kinds)
+            ).fetchone()
+            if row is None:
+                # Ближайшая отложенная задача или истекающая аренда задачи упавшего процесса
+                next_row = self._db.execute(
+                    "SELECT MIN(CASE WHEN status = 'pending' THEN next_attempt_at ELSE locked_until END) "
+                    f"FROM deliveries WHERE status IN ('pending', 'in_progress') {exclude}",
+                    batch_kinds
+                ).fetchone()
+                self._db.execute("COMMIT")
+                return None, next_row[0]
+            job_id, kind, payload, attempts = row
+            self._db.execute(
+                "UPDATE deliveries SET status = 'in_progress', attempts = attempts + 1, locked_until = ? "
+                "WHERE id = ?",
+                (now + self.lease, job_id)
+            )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return DeliveryJob(job_id, kind, json.loads(payload), attempts + 1, self), None
+
+    def _claim_batch(self, kind: str, consumer: BatchConsumer,
+                     force: bool) -> tuple[list[DeliveryJob], float | None]:
+        """
+        Забирает пачку готовых задач типа kind, если пора (force - забрать все готовые, например при остановке).
+        Второе значение - когда проверить снова, если пачка еще не собралась.
+        """
+        now = time.time()
+        ready = "next_attempt_at <= ? AND (status = 'pending' OR (status = 'in_progress' AND locked_until < ?))"
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._db.execute(
+                f"SELECT id, payload, attempts, created_at FROM deliveries WHERE kind = ? AND {ready} "
+                "ORDER BY created_at LIMIT ?",
+                (kind, now, now, consumer.max_jobs)
+            ).fetchall()
+            payloads = [json.loads(row[1]) for row in rows]
+            sizes = [consumer.size_of(payload) for payload in payloads]
+            due = rows and (force or len(rows) >= consumer.max_jobs or sum(sizes) >= consumer.max_size
+                            or rows[0][3] + consumer.max_wait <= now)
+            if not due:
+                # Следующая проверка: когда истечет ожидание самой старой задачи или подойдет отложенная
+                next_row = self._db.execute(
+                    "SELECT MIN(CASE WHEN status = 'pending' THEN next_attempt_at ELSE locked_until END) "
+                    "FROM deliveries WHERE kind = ? AND status IN ('pending', 'in_progress')",
+                    (kind,)
+                ).fetchone()
+                self._db.execute("COMMIT")
+                candidates = [value for value in (next_row[0], rows[0][3] + consumer.max_wait if rows else None)
+                              if value is not None and value > now]
+                return [], min(candidates, default=None)
+
+            # Пачка не больше max_size (но хотя бы одна задача, даже если она сама больше лимита)
+            count, total = 0, 0.0
+            for size in sizes:
+                if count and total + size > consumer.max_size:
+                    break
+                count += 1
+                total += size
+            jobs = []
+            for (job_id, _, attempts, _), payload in zip(rows[:count], payloads):
+                self._db.execute(
+                    "UPDATE deliveries SET status = 'in_progress', attempts = attempts + 1, locked_until = ? "
+                    "WHERE id = ?",
+                    (now + self.lease, job_id)
+                )
+                jobs.append(DeliveryJob(job_id, kind, payload, attempts + 1, self))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return jobs, None
+
+    def _save_payload(self, job_id: int, payload: dict):
+        self._db.execute("UPDATE deliveries SET payload = ? WHERE id = ?",
+                         (json.dumps(payload, ensure_ascii=False), job_id))
+
+    def _complete(self, job_id: int):
+        self._db.execute("DELETE FROM deliveries WHERE id = ?", (job_id,))
+
+    def _complete_many(self, job_ids: list[int]):
+        self._db.executemany("DELETE FROM deliveries WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def _reschedule(self, job_id: int, delay: float, error: str):
+        self._db.execute(
+            "UPDATE deliveries SET status = 'pending', next_attempt_at = ?, locked_until = 0, last_error = ? "
+            "WHERE id = ?",
+            (time.time() + delay, error, job_id)
+        )
+
+    def _fail(self, job_id: int, error: str):
+        self._db.execute("UPDATE deliveries SET status = 'failed', last_error = ? WHERE id = ?", (error, job_id))
+
+    def _count_pending(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM deliveries WHERE status IN ('pending', 'in_progress')"
+        ).fetchone()[0]
+
+    # --- Публичный интерфейс ---
+    def _wait_timeout(self, next_due: float | None) -> float | None:
+        timeout = None if next_due is None else max(0.0, next_due - time.time())
+        if self.poll_interval is not None:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        return timeout
+
+    async def start(self, consume: bool = True, poll_interval: float | None = None):
+        """
+        consume=False - только постановка задач (процессы-воркеры), доставкой занимается другой процесс.
+        poll_interval - как часто искать задачи, поставленные другими процессами.
+        """
+        self.poll_interval = poll_interval
+        await asyncio.to_thread(self._open)
+        pending = await self._run_db(self._count_pending)
+        queue_depth.set(pending)
+        if pending:
+            logging.info(f"В очереди доставки {pending} незавершенных задач, возобновляем отправку")
+        self._stopping = False
+        if not consume:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks += [asyncio.create_task(self._batch_worker(kind, consumer))
+                        for kind, consumer in self._batch_consumers.items()]
+
+    async def enqueue(self, kind: str, payload: dict) -> int:
+        return (await self.enqueue_many([(kind, payload)]))[0]
+
+    async def enqueue_many(self, jobs: list[tuple[str, dict]]) -> list[int]:
+        """Ставит задачи (тип, данные) атомарно: при ошибке не ставится ни одна"""
+        job_ids = await self._run_db(self._insert_many, jobs)
+        jobs_enqueued.inc(len(job_ids))
+        queue_depth.inc(len(job_ids))
+        for kind, _ in jobs:
+            if kind in self._batch_consumers:
+                self._batch_consumers[kind].wakeup.set()
+            else:
+                self._wakeup.set()
+        return job_ids
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Дает воркерам дослать текущие задачи; остальные будут доставлены после перезапуска.
+        Накопленные пачки отправляются сразу, не дожидаясь max_wait.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        for consumer in self._batch_consumers.values():
+            consumer.wakeup.set()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        self._tasks = []
+        if self._db is not None:
+            await self._run_db(self._db.close)
+            self._db = None
+
+    # --- Воркеры ---
+    async def _worker(self):
+        while not self._stopping:
+            # Сбрасываем событие до проверки очереди, чтобы не пропустить новую задачу
+            self._wakeup.clear()
+            try:
+                job, next_due = await self._run_db(self._claim)
+            except sqlite3.Error as e:
+                logging.error(f"Очередь доставки: ошибка базы данных: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._wait_timeout(next_due))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._process(job)
+
+    async def _process(self, job: DeliveryJob):
+        handler = self._handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise PermanentDeliveryError(f"Нет обработчика для задач типа {job.kind}")
+            await handler(job)
+        except Exception as e:
+            delay = _retry_delay(e, job.attempts)
+            if delay is None or job.attempts >= self.max_attempts:
+                logging.error(f"Доставка #{job.id} ({job.kind}) окончательно не удалась "
+                              f"после {job.attempts} попыток: {e}")
+                jobs_failed.inc()
+                queue_depth.dec()
+                await self._run_db(self._fail, job.id, repr(e))
+            else:
+                logging.warning(f"Доставка #{job.id} ({job.kind}) не удалась: {e}. "
+                                f"Повтор через {delay:.1f} с (попытка {job.attempts})")
+                jobs_retried.inc()
+                await self._run_db(self._reschedule, job.id, delay, repr(e))
+            return
+
+        jobs_delivered.inc()
+        queue_depth.dec()
+        await self._run_db(self._complete, job.id)
+
+    async def _batch_worker(self, kind: str, consumer: BatchConsumer):
+        while True:
+            stopping = self._stopping
+            consumer.wakeup.clear()
+            try:
+                jobs, next_due = await self._run_db(self._claim_batch, kind, consumer, stopping)
+            except sqlite3.Error as e:
+                logging.error(f"Очередь доставки: ошибка базы данных: {e}")
+                if stopping:
+                    return
+                await asyncio.sleep(1)
+                continue
+
+            if jobs:
+                await self._process_batch(consumer, jobs)
+                continue
+            if stopping:
+                return
+            try:
+                await asyncio.wait_for(consumer.wakeup.wait(), timeout=self._wait_timeout(next_due))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process_batch(self, consumer: BatchConsumer, jobs: list[DeliveryJob]):
+        ids = ", ".join(f"#{job.id}" for job in jobs)
+        try:
+            await consumer.handler(jobs)
+        except Exception as e:
+            # Пачка доставляется целиком или не доставляется вовсе: каждая задача откладывается по своим попыткам
+            for job in jobs:
+                delay = _retry_delay(e, job.attempts)
+                if delay is None or job.attempts >= self.max_attempts:
+                    jobs_failed.inc()
+                    queue_depth.dec()
+                    await self._run_db(self._fail, job.id, repr(e))
+                else:
+                    jobs_retried.inc()
+                    await self._run_db(self._reschedule, job.id, delay, repr(e))
+            logging.warning(f"Доставка пачки ({ids}) не удалась: {e}")
+            return
+
+        batches_delivered.inc()
+        jobs_delivered.inc(len(jobs))
+        queue_depth.dec(len(jobs))
+        await self._run_db(self._complete_many, [job.id for job in jobs])
+
+
+delivery_queue = DeliveryQueue(
+    DELIVERY_QUEUE_PATH,
+    workers=DELIVERY_WORKERS,
+    max_attempts=DELIVERY_MAX_ATTEMPTS,
+    lease=DELIVERY_LEASE_SEC
+)
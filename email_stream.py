@@ -0,0 +1,80 @@
+# file: email_stream.py
+import base64
+import re
+import uuid
+from email.header import Header
+from email.mime.text import MIMEText
+from email.policy import SMTP
+from email.utils import formatdate, make_msgid
+from typing import BinaryIO, Iterator
+
+# Кратно 57 байтам: каждая строка base64 (76 символов) получается целой, без хвостов между чанками
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+_LEADING_DOT = re.compile(rb"^\.", re.MULTILINE)
+
+
+class StreamingEmail:
+    """
+    Письмо (HTML + необязательные вложения), которое сериализуется по частям.
+    Вложения читаются из файлов и кодируются в base64 порциями по ATTACHMENT_CHUNK_SIZE,
+    поэтому в памяти никогда не находится целиком ни исходный файл, ни его base64-копия.
+    """
+
+    def __init__(self, sender: str, recipient: str, subject: str, html_body: str,
+                 attachment: BinaryIO | None = None, attachment_name: str | None = None,
+                 extra_attachments: list[tuple[BinaryIO, str]] | None = None):
+        self.sender = sender
+        self.recipient = recipient
+        self.subject = subject
+        self.html_body = html_body
+        self.attachments: list[tuple[BinaryIO, str]] = []
+        if attachment is not None and attachment_name:
+            self.attachments.append((attachment, attachment_name))
+        self.attachments.extend(extra_attachments or [])
+        self.boundary = f"=============={uuid.uuid4().hex}=="
+        self.message_id = make_msgid()
+
+    def _headers(self) -> bytes:
+        # Длинная (а кириллическая - почти любая) тема переносится на несколько строк: перенос - CRLF,
+        # как у остальных строк (голый LF внутри DATA современные серверы отклоняют)
+        subject = Header(self.subject, "utf-8").encode(linesep="\r\n")
+        headers = [
+            f"From: {self.sender}",
+            f"To: {self.recipient}",
+            f"Subject: {subject}",
+            f"Date: {formatdate(localtime=True)}",
+            f"Message-ID: {self.message_id}",
+            "MIME-Version: 1.0",
+            f'Content-Type: multipart/mixed; boundary="{self.boundary}"',
+        ]
+        return ("\r\n".join(headers) + "\r\n\r\n").encode("ascii")
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """Сообщение целиком в формате RFC 5322 (CRLF). Каждый чанк заканчивается концом строки"""
+        yield self._headers()
+
+        html_part = MIMEText(self.html_body, "html", "utf-8")
+        yield f"--{self.boundary}\r\n".encode("ascii")
+        yield html_part.as_bytes(policy=SMTP) + b"\r\n"
+
+        for attachment, attachment_name in self.attachments:
+            yield (
+                f"--{self.boundary}\r\n"
+                f'Content-Type: application/octet-stream; name="{attachment_name}"\r\n'
+                "MIME-Version: 1.0\r\n"
+                "Content-Transfer-Encoding: base64\r\n"
+                f'Content-Disposition: attachment; filename="{attachment_name}"\r\n'
+                "\r\n"
+            ).encode("utf-8")
+            # Итерацию можно повторить (например, после переподключения к SMTP)
+            attachment.seek(0)
+            while chunk := attachment.read(ATTACHMENT_CHUNK_SIZE):
+                yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+
+        yield f"--{self.boundary}--\r\n".encode("ascii")
+
+    def iter_data(self) -> Iterator[bytes]:
+        """Чанки для команды SMTP DATA: с экранированием строк, начинающихся с точки"""
+        for chunk in self.iter_chunks():
+            yield _LEADING_DOT.sub(b"..", chunk)
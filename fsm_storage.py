@@ -0,0 +1,718 @@
+# file: fsm_storage.py
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from copy import copy
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import DisabledEventIsolation
+
+import metrics
+from config import (FSM_STORAGE, FSM_SQLITE_PATH, FSM_STATE_TTL_SEC, FSM_FLUSH_INTERVAL_SEC,
+                    FSM_FLUSH_BATCH_SIZE, REDIS_URL, EVENT_ISOLATION, EVENT_LOCK_TIMEOUT_SEC, EVENT_LOCK_WAIT_SEC,
+                    FSM_MEMORY_MAX_SESSIONS, FSM_MEMORY_MAX_BYTES, FSM_REAP_INTERVAL_SEC)
+
+# --- Метрики хранилища ---
+storage_duration = metrics.histogram("fsm_storage_duration_seconds", "Время операций FSM-хранилища",
+                                     buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                                              0.05, 0.1, 0.25, 1.0))
+
+# Обращения к хранилищу (через InstrumentedStorage): состояние и данные, прочитанные или записанные
+# одним вызовом (get_record / set_record), - одно обращение
+storage_reads = metrics.counter("fsm_storage_reads_total", "Обращений к FSM-хранилищу на чтение")
+storage_writes = metrics.counter("fsm_storage_writes_total", "Обращений к FSM-хранилищу на запись")
+
+# --- Метрики очередности апдейтов ---
+lock_wait = metrics.histogram("fsm_event_lock_wait_seconds",
+                              "Ожидание, пока обработается предыдущий апдейт того же чата",
+                              buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 30.0))
+lock_contended = metrics.counter("fsm_event_lock_contended_total",
+                                 "Апдейтов, пришедших, пока обрабатывался предыдущий апдейт того же чата")
+lock_timeouts = metrics.counter("fsm_event_lock_timeouts_total", "Апдейтов, не дождавшихся блокировки чата")
+locks_active = metrics.gauge("fsm_event_locks_active", "Чатов, у которых сейчас обрабатывается апдейт")
+
+# --- Метрики анкет в памяти ---
+sessions_live = metrics.gauge("fsm_sessions_live", "Незавершенных анкет в памяти процесса")
+sessions_bytes = metrics.gauge("fsm_sessions_bytes", "Объем незавершенных анкет в памяти (по размеру JSON)")
+sessions_expired = metrics.counter("fsm_sessions_expired_total", "Анкет, удаленных после FSM_STATE_TTL_SEC без активности")
+sessions_evicted = metrics.counter("fsm_sessions_evicted_total",
+                                   "Давно не использованных анкет, вытесненных из-за лимита числа или объема")
+
+# Вызывается для каждой удаленной по сроку или вытесненной анкеты: (ключ, состояние, данные, вытеснена ли по лимиту)
+ExpireCallback = Callable[[StorageKey, Optional[str], Dict[str, Any], bool], Awaitable[None]]
+
+_UNSET = object()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at);
+"""
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite (режим WAL).
+    Записи копятся в буфере и сбрасываются в базу одной транзакцией раз в flush_interval
+    (или сразу при накоплении batch_size ключей). Чтение сначала смотрит в буфер, затем в базу.
+    Брошенные анкеты (без изменений дольше ttl) считаются пустыми и периодически удаляются.
+    """
+
+    def __init__(self, path: str, ttl: float | None = None, flush_interval: float = 0.1,
+                 batch_size: int = 100):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Писатель работает в отдельном потоке (fsync), читатель - в потоке event loop:
+        # в режиме WAL чтение по первичному ключу не ждет записи и обходится дешевле перехода в поток
+        self._writer = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer.execute("PRAGMA busy_timeout=5000")
+        self._writer.executescript(_SCHEMA)
+        self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._reader.execute("PRAGMA busy_timeout=5000")
+
+        # key -> [state | _UNSET, data (json) | _UNSET, время изменения]
+        self._pending: dict[str, list] = {}
+        # Пачка, которая прямо сейчас пишется в базу (читается, пока запись не завершилась)
+        self._flushing: dict[str, list] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_now = asyncio.Event()
+        # Писатель - одно соединение: сбросы из фоновой задачи и явные вызовы flush идут по очереди
+        self._write_lock = asyncio.Lock()
+        self._last_purge = time.time()
+        self._closing = False
+
+    # --- Буфер записи ---
+    def _buffer(self, key: StorageKey, state: Any = _UNSET, data: Any = _UNSET):
+        record = self._pending.setdefault(self.key_builder.build(key), [_UNSET, _UNSET, 0.0])
+        if state is not _UNSET:
+            record[0] = state
+        if data is not _UNSET:
+            record[1] = data
+        record[2] = time.time()
+
+        if not self._closing and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self.batch_size:
+            self._flush_now.set()
+
+    def _write_batch(self, batch: dict[str, list]):
+        full, state_only, data_only = [], [], []
+        for key, (state, data, updated_at) in batch.items():
+            if state is not _UNSET and data is not _UNSET:
+                full.append((key, state, data, updated_at))
+            elif state is not _UNSET:
+                state_only.append((key, state, updated_at))
+            else:
+                data_only.append((key, data, updated_at))
+
+        self._writer.execute("BEGIN")
+        try:
+            self._writer.executemany(
+                "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                full
+            )
+            self._writer.executemany(
+                "INSERT INTO fsm (key, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                state_only
+            )
+            self._writer.executemany(
+                "INSERT INTO fsm (key, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                data_only
+            )
+            # Пустые записи (после state.clear()) не храним
+            self._writer.executemany(
+                "DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'",
+                [(key,) for key in batch]
+            )
+            self._writer.execute("COMMIT")
+        except Exception:
+            self._writer.execute("ROLLBACK")
+            raise
+
+    def _purge_expired(self):
+        cursor = self._writer.execute("DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,))
+        if cursor.rowcount:
+            logging.info(f"FSM: удалено {cursor.rowcount} брошенных анкет")
+
+    async def flush(self):
+        """Записывает буфер в базу; после возврата на диске все, что было записано в хранилище до вызова"""
+        async with self._write_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except sqlite3.Error as e:
+                logging.error(f"FSM: не удалось сохранить {len(batch)} записей: {e}")
+                # Возвращаем в буфер то, что не перезаписали за время попытки
+                for key, (state, data, updated_at) in batch.items():
+                    record = self._pending.setdefault(key, [state, data, updated_at])
+                    if record[0] is _UNSET:
+                        record[0] = state
+                    if record[1] is _UNSET:
+                        record[1] = data
+                raise
+            finally:
+                self._flushing = {}
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+                if self.ttl and time.time() - self._last_purge > min(self.ttl, 3600):
+                    self._last_purge = time.time()
+                    async with self._write_lock:
+                        await asyncio.to_thread(self._purge_expired)
+            except sqlite3.Error:
+                await asyncio.sleep(1)
+
+    # --- Чтение ---
+    def _lookup(self, key: StorageKey, field: int) -> Any:
+        """Значение поля (0 - состояние, 1 - данные) из буферов или из базы; None, если записи нет"""
+        built_key = self.key_builder.build(key)
+        for buffer in (self._pending, self._flushing):
+            record = buffer.get(built_key)
+            if record is not None and record[field] is not _UNSET:
+                return None if self._is_expired(record[2]) else record[field]
+        row = self._reader.execute(
+            "SELECT state, data, updated_at FROM fsm WHERE key = ?", (built_key,)
+        ).fetchone()
+        if row is None or self._is_expired(row[2]):
+            return None
+        return row[field]
+
+    def _lookup_record(self, key: StorageKey) -> tuple[Any, Any]:
+        """Состояние и данные (json) одним обращением: из буферов, недостающее - одним SELECT"""
+        built_key = self.key_builder.build(key)
+        values = [_UNSET, _UNSET]
+        for buffer in (self._pending, self._flushing):
+            record = buffer.get(built_key)
+            if record is None:
+                continue
+            for field in (0, 1):
+                if values[field] is _UNSET and record[field] is not _UNSET:
+                    values[field] = None if self._is_expired(record[2]) else record[field]
+        if values[0] is _UNSET or values[1] is _UNSET:
+            row = self._reader.execute(
+                "SELECT state, data, updated_at FROM fsm WHERE key = ?", (built_key,)
+            ).fetchone()
+            for field in (0, 1):
+                if values[field] is _UNSET:
+                    values[field] = None if row is None or self._is_expired(row[2]) else row[field]
+        return values[0], values[1]
+
+    def _is_expired(self, updated_at: float) -> bool:
+        return bool(self.ttl) and updated_at < time.time() - self.ttl
+
+    # --- Интерфейс BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._buffer(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._lookup(key, 0)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._buffer(key, data=json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = self._lookup(key, 1)
+        return json.loads(data) if data else {}
+
+    async def get_record(self, key: StorageKey) -> tuple[Optional[str], Dict[str, Any]]:
+        state, data = self._lookup_record(key)
+        return state, json.loads(data) if data else {}
+
+    async def set_record(self, key: StorageKey, state: StateType, data: Mapping[str, Any]) -> None:
+        # Одна запись буфера - одна строка в пачке сброса
+        self._buffer(key, state=state.state if isinstance(state, State) else state,
+                     data=json.dumps(dict(data), ensure_ascii=False))
+
+    async def close(self) -> None:
+        # Не отменяем фоновую задачу посреди записи: просим ее завершиться после очередного сброса
+        self._closing = True
+        self._flush_now.set()
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+        self._writer.close()
+        self._reader.close()
+
+
+class _Session:
+    __slots__ = ("state", "data", "size", "touched")
+
+    def __init__(self):
+        self.state: Optional[str] = None
+        self.data: Dict[str, Any] = {}
+        self.size = 0
+        self.touched = 0.0
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    FSM-хранилище в памяти процесса (FSM_STORAGE=memory) с уборкой брошенных анкет.
+
+    - Срок: анкета без обращений дольше ttl удаляется фоновой задачей. Сроки лежат в куче
+      (одна запись на анкету; если к анкете обращались, запись переставляется на новый срок),
+      поэтому уборка не перебирает все анкеты.
+    - Лимит: при превышении max_sessions анкет или max_bytes (по размеру JSON данных)
+      вытесняются анкеты, к которым дольше всего не обращались (OrderedDict в порядке обращений).
+    - Чтение несуществующего ключа не создает запись (в отличие от MemoryStorage),
+      пустая анкета (после state.clear()) удаляется сразу.
+    Для удаленных анкет вызывается on_expire - из фоновой задачи, а не из обработки апдейта.
+    Анкеты, чей апдейт обрабатывается или ждет очереди (busy - обычно ChatEventIsolation.busy),
+    не удаляются: после обработки анкета записалась бы обратно.
+    """
+
+    def __init__(self, ttl: float | None = None, max_sessions: int = 0, max_bytes: int = 0,
+                 reap_interval: float = 60.0, on_expire: ExpireCallback | None = None,
+                 busy: Callable[[StorageKey], bool] | None = None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.reap_interval = reap_interval
+        self.on_expire = on_expire
+        self.busy = busy
+        self._sessions: OrderedDict[StorageKey, _Session] = OrderedDict()
+        self._bytes = 0
+        # (срок, порядковый номер, ключ, анкета); запись устарела, если по ключу уже другая анкета
+        self._deadlines: list[tuple[float, int, StorageKey, _Session]] = []
+        self._seq = itertools.count()
+        # Удаленные анкеты, для которых еще не вызван on_expire: (ключ, анкета, вытеснена ли по лимиту)
+        self._removed: deque[tuple[StorageKey, _Session, bool]] = deque()
+        self._reap_task: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+        self._closing = False
+
+    # --- Учет анкет ---
+    def _touch(self, key: StorageKey) -> _Session | None:
+        session = self._sessions.get(key)
+        if session is not None:
+            session.touched = time.monotonic()
+            self._sessions.move_to_end(key)
+        return session
+
+    def _write(self, key: StorageKey, state: Any = _UNSET, data: Any = _UNSET):
+        session = self._touch(key)
+        if session is None:
+            if (state is _UNSET or state is None) and not data:
+                return
+            session = self._sessions[key] = _Session()
+            session.touched = time.monotonic()
+            if self.ttl:
+                heapq.heappush(self._deadlines, (session.touched + self.ttl, next(self._seq), key, session))
+            if not self._closing and (self._reap_task is None or self._reap_task.done()):
+                self._reap_task = asyncio.create_task(self._reap_loop())
+        if state is not _UNSET:
+            session.state = state
+        if data is not _UNSET:
+            session.data = data
+            self._bytes -= session.size
+            session.size = len(json.dumps(data, ensure_ascii=False, default=str).encode())
+            self._bytes += session.size
+
+        if session.state is None and not session.data:
+            self._remove(key, session)
+        else:
+            self._evict()
+        sessions_live.set(len(self._sessions))
+        sessions_bytes.set(self._bytes)
+
+    def _remove(self, key: StorageKey, session: _Session):
+        del self._sessions[key]
+        self._bytes -= session.size
+
+    def _evict(self):
+        count, size = len(self._sessions), self._bytes
+        # Последняя анкета - та, к которой только что обратились: ее не вытесняем
+        last = next(reversed(self._sessions))
+        victims = []
+        for key, session in self._sessions.items():
+            if key == last or not ((self.max_sessions and count > self.max_sessions)
+                                   or (self.max_bytes and size > self.max_bytes)):
+                break
+            if self.busy is not None and self.busy(key):
+                continue
+            victims.append((key, session))
+            count -= 1
+            size -= session.size
+        for key, session in victims:
+            self._remove(key, session)
+            sessions_evicted.inc()
+            self._removed.append((key, session, True))
+        if victims:
+            self._wake.set()
+
+    def _expire_idle(self, now: float):
+        busy = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            entry = heapq.heappop(self._deadlines)
+            _, _, key, session = entry
+            if self._sessions.get(key) is not session:
+                continue
+            deadline = session.touched + self.ttl
+            if deadline > now:
+                heapq.heappush(self._deadlines, (deadline, next(self._seq), key, session))
+                continue
+            if self.busy is not None and self.busy(key):
+                # Апдейт анкеты обрабатывается: проверим снова при следующей уборке
+                busy.append(entry)
+                continue
+            self._remove(key, session)
+            sessions_expired.inc()
+            self._removed.append((key, session, False))
+        for entry in busy:
+            heapq.heappush(self._deadlines, entry)
+        # Записи удаленных анкет ждут своего срока в куче; если их накопилось много - пересобираем
+        if len(self._deadlines) > 2 * len(self._sessions) + 1000:
+            self._deadlines = [(session.touched + self.ttl, next(self._seq), key, session)
+                               for key, session in self._sessions.items()]
+            heapq.heapify(self._deadlines)
+        sessions_live.set(len(self._sessions))
+        sessions_bytes.set(self._bytes)
+
+    async def _reap_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.reap_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self.ttl:
+                self._expire_idle(time.monotonic())
+            if self._removed:
+                logging.info(f"FSM: удалено {len(self._removed)} брошенных анкет")
+            while self._removed and not self._closing:
+                key, session, evicted = self._removed.popleft()
+                if self.on_expire is None:
+                    continue
+                try:
+                    await self.on_expire(key, session.state, session.data, evicted)
+                except Exception as e:
+                    logging.warning(f"Ошибка при удалении анкеты пользователя {key.user_id}: {e}")
+
+    # --- Интерфейс BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        session = self._touch(key)
+        return session.state if session is not None else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._write(key, data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        session = self._touch(key)
+        return session.data.copy() if session is not None else {}
+
+    async def get_record(self, key: StorageKey) -> tuple[Optional[str], Dict[str, Any]]:
+        session = self._touch(key)
+        return (session.state, session.data.copy()) if session is not None else (None, {})
+
+    async def set_record(self, key: StorageKey, state: StateType, data: Mapping[str, Any]) -> None:
+        self._write(key, state=state.state if isinstance(state, State) else state, data=dict(data))
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        session = self._touch(storage_key)
+        return copy(session.data.get(dict_key, default)) if session is not None else default
+
+    async def close(self) -> None:
+        self._closing = True
+        self._wake.set()
+        if self._reap_task is not None:
+            await asyncio.gather(self._reap_task, return_exceptions=True)
+
+
+class InstrumentedStorage(BaseStorage):
+    """
+    Обертка над любым FSM-хранилищем: время каждой операции в гистограмме fsm_storage_duration_seconds
+    и число обращений на чтение и запись.
+    get_record / set_record - состояние и данные одним обращением: у SQLite и хранилища в памяти
+    это свои методы, у Redis - MGET и транзакция MULTI, у остальных - два вызова.
+    """
+
+    def __init__(self, storage: BaseStorage, backend: str):
+        self.storage = storage
+        self.backend = backend
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_writes.inc()
+        with storage_duration.time(operation="set_state", backend=self.backend):
+            await self.storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        storage_reads.inc()
+        with storage_duration.time(operation="get_state", backend=self.backend):
+            return await self.storage.get_state(key)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_writes.inc()
+        with storage_duration.time(operation="set_data", backend=self.backend):
+            await self.storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        storage_reads.inc()
+        with storage_duration.time(operation="get_data", backend=self.backend):
+            return await self.storage.get_data(key)
+
+    async def get_record(self, key: StorageKey) -> tuple[Optional[str], Dict[str, Any]]:
+        storage = self.storage
+        with storage_duration.time(operation="get_record", backend=self.backend):
+            if hasattr(storage, "get_record"):
+                storage_reads.inc()
+                return await storage.get_record(key)
+            if getattr(storage, "redis", None) is not None:
+                storage_reads.inc()
+                return await _redis_get_record(storage, key)
+            storage_reads.inc(2)
+            return await storage.get_state(key), await storage.get_data(key)
+
+    async def set_record(self, key: StorageKey, state: StateType, data: Mapping[str, Any]) -> None:
+        storage = self.storage
+        with storage_duration.time(operation="set_record", backend=self.backend):
+            if hasattr(storage, "set_record"):
+                storage_writes.inc()
+                await storage.set_record(key, state, data)
+            elif getattr(storage, "redis", None) is not None:
+                storage_writes.inc()
+                await _redis_set_record(storage, key, state, data)
+            else:
+                storage_writes.inc(2)
+                await storage.set_data(key, data)
+                await storage.set_state(key, state)
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+    def __getattr__(self, name: str):
+        # Остальные методы конкретного хранилища (flush у SQLite и т.п.) - без замеров
+        return getattr(self.storage, name)
+
+
+async def _redis_get_record(storage, key: StorageKey) -> tuple[Optional[str], Dict[str, Any]]:
+    """RedisStorage: состояние и данные одним MGET (ключи и формат - как у самого RedisStorage)"""
+    state, data = await storage.redis.mget(storage.key_builder.build(key, "state"),
+                                           storage.key_builder.build(key, "data"))
+    if isinstance(state, bytes):
+        state = state.decode("utf-8")
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return state, storage.json_loads(data) if data is not None else {}
+
+
+async def _redis_set_record(storage, key: StorageKey, state: StateType, data: Mapping[str, Any]) -> None:
+    """RedisStorage: состояние и данные одной транзакцией MULTI/EXEC (пустые значения удаляются, как в RedisStorage)"""
+    state = state.state if isinstance(state, State) else state
+    state_key = storage.key_builder.build(key, "state")
+    data_key = storage.key_builder.build(key, "data")
+    async with storage.redis.pipeline(transaction=True) as pipe:
+        if state is None:
+            pipe.delete(state_key)
+        else:
+            pipe.set(state_key, state, ex=storage.state_ttl)
+        if data:
+            pipe.set(data_key, storage.json_dumps(dict(data)), ex=storage.data_ttl)
+        else:
+            pipe.delete(data_key)
+        await pipe.execute()
+
+
+class _KeyLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class ChatEventIsolation(BaseEventIsolation):
+    """
+    Апдейты одного ключа FSM (чат + пользователь) обрабатываются строго по очереди, разных - параллельно.
+    FSMContextMiddleware берет блокировку до чтения состояния и отпускает после записи анкеты,
+    поэтому второе нажатие "Отправить" увидит уже очищенную анкету и заявку не продублирует.
+    Блокировка живет, пока ее кто-то держит или ждет (SimpleEventIsolation из aiogram их не удаляет).
+    """
+
+    def __init__(self):
+        self._locks: dict[StorageKey, _KeyLock] = {}
+
+    def busy(self, key: StorageKey) -> bool:
+        """Обрабатывается ли сейчас апдейт ключа (или ждет очереди)"""
+        return key in self._locks
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = _KeyLock()
+            locks_active.inc()
+        entry.users += 1
+        if entry.lock.locked():
+            lock_contended.inc()
+        started = time.perf_counter()
+        try:
+            async with entry.lock:
+                lock_wait.observe(time.perf_counter() - started, backend="memory")
+                yield
+        finally:
+            entry.users -= 1
+            if not entry.users:
+                del self._locks[key]
+                locks_active.dec()
+
+    async def close(self) -> None:
+        self._locks.clear()
+
+
+class RedisChatEventIsolation(BaseEventIsolation):
+    """
+    Та же очередность для нескольких процессов или серверов с общим Redis-совместимым хранилищем.
+    Блокировка - ключ SET NX со сроком timeout: если процесс упал посреди апдейта, она снимется сама.
+    Снятие - через WATCH/MULTI, а не Lua-скрипт: EVAL есть не у всех совместимых серверов.
+    """
+
+    def __init__(self, redis, timeout: float = 60.0, wait: float = 30.0):
+        self.redis = redis
+        self.timeout = timeout
+        self.wait = wait
+        # Тот же формат ключей, что у RedisStorage: fsm:<бот>:<чат>:<пользователь>:lock
+        self.key_builder = DefaultKeyBuilder()
+
+    async def _acquire(self, name: str, token: str) -> bool:
+        deadline = time.monotonic() + self.wait
+        delay = 0.005
+        while not await self.redis.set(name, token, nx=True, px=int(self.timeout * 1000)):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return True
+
+    async def _release(self, name: str, token: str):
+        from redis.exceptions import WatchError
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(name)
+                if await pipe.get(name) not in (token, token.encode()):
+                    logging.warning(f"Блокировка {name} истекла до конца обработки апдейта ({self.timeout:.0f} с)")
+                    return
+                pipe.multi()
+                pipe.delete(name)
+                await pipe.execute()
+            except WatchError:
+                # Ключ изменился между GET и DELETE: блокировка уже истекла и досталась другому апдейту
+                pass
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        name = self.key_builder.build(key, "lock")
+        token = secrets.token_hex(8)
+        started = time.perf_counter()
+        if not await self.redis.set(name, token, nx=True, px=int(self.timeout * 1000)):
+            lock_contended.inc()
+            if not await self._acquire(name, token):
+                lock_timeouts.inc()
+                raise TimeoutError(f"Апдейт не дождался блокировки {name} за {self.wait:.0f} с")
+        lock_wait.observe(time.perf_counter() - started, backend="redis")
+        locks_active.inc()
+        try:
+            yield
+        finally:
+            locks_active.dec()
+            await self._release(name, token)
+
+    async def close(self) -> None:
+        pass
+
+
+def create_redis_storage(url: str, ttl: float | None = None, redis=None) -> BaseStorage:
+    """
+    Хранилище с протоколом Redis (Redis, KeyDB, Valkey...).
+    Вместо URL можно передать готовый клиент, например fakeredis.aioredis.FakeRedis() для тестов.
+    """
+    try:
+        from aiogram.fsm.storage.redis import RedisStorage
+    except ImportError:
+        raise RuntimeError("Для FSM_STORAGE=redis установите пакет redis: pip install redis")
+
+    expiry = int(ttl) if ttl else None
+    if redis is not None:
+        return RedisStorage(redis=redis, state_ttl=expiry, data_ttl=expiry)
+    return RedisStorage.from_url(url, state_ttl=expiry, data_ttl=expiry)
+
+
+def create_storage(on_expire: ExpireCallback | None = None) -> BaseStorage:
+    """
+    FSM-хранилище, выбранное в настройках (FSM_STORAGE), с замером времени операций.
+    on_expire - для анкет в памяти, удаленных по сроку или лимиту (SQLite и Redis удаляют их молча)
+    """
+    if FSM_STORAGE == "sqlite":
+        logging.info(f"FSM-хранилище: SQLite ({FSM_SQLITE_PATH})")
+        return InstrumentedStorage(SQLiteStorage(FSM_SQLITE_PATH, ttl=FSM_STATE_TTL_SEC,
+                                                 flush_interval=FSM_FLUSH_INTERVAL_SEC,
+                                                 batch_size=FSM_FLUSH_BATCH_SIZE), "sqlite")
+    if FSM_STORAGE == "redis":
+        logging.info("FSM-хранилище: Redis")
+        return InstrumentedStorage(create_redis_storage(REDIS_URL, ttl=FSM_STATE_TTL_SEC), "redis")
+    if FSM_STORAGE != "memory":
+        logging.warning(f"Неизвестное FSM_STORAGE={FSM_STORAGE}, используется хранилище в памяти")
+    return InstrumentedStorage(BoundedMemoryStorage(ttl=FSM_STATE_TTL_SEC, max_sessions=FSM_MEMORY_MAX_SESSIONS,
+                                                    max_bytes=FSM_MEMORY_MAX_BYTES, reap_interval=FSM_REAP_INTERVAL_SEC,
+                                                    on_expire=on_expire), "memory")
+
+
+def create_event_isolation(storage: BaseStorage | None = None) -> BaseEventIsolation:
+    """Очередность апдейтов одного чата (EVENT_ISOLATION); Redis-вариант использует клиент хранилища, если он есть"""
+    if EVENT_ISOLATION == "redis":
+        redis = getattr(storage, "redis", None)
+        if redis is None:
+            try:
+                from redis.asyncio import Redis
+            except ImportError:
+                raise RuntimeError("Для EVENT_ISOLATION=redis установите пакет redis: pip install redis")
+            redis = Redis.from_url(REDIS_URL)
+        return RedisChatEventIsolation(redis, timeout=EVENT_LOCK_TIMEOUT_SEC, wait=EVENT_LOCK_WAIT_SEC)
+    if EVENT_ISOLATION == "none":
+        return DisabledEventIsolation()
+    if EVENT_ISOLATION != "memory":
+        logging.warning(f"Неизвестное EVENT_ISOLATION={EVENT_ISOLATION}, используются блокировки в процессе")
+    isolation = ChatEventIsolation()
+    # Анкеты в памяти не удаляются, пока их апдейт обрабатывается
+    inner = getattr(storage, "storage", storage)
+    if isinstance(inner, BoundedMemoryStorage) and inner.busy is None:
+        inner.busy = isolation.busy
+    return isolation
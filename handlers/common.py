@@ -1,20 +1,29 @@
 # file: handlers/common.py
-from aiogram import F, Router
+from aiogram import Bot, F, Router
 from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 
+from config import FSM_EXPIRED_NOTICE
 from keyboards import (get_start_kb, get_back_cancel_kb, get_location_choice_kb,
                        get_feedback_choice_kb, get_rodents_choice_kb,
                        get_skip_email_kb)  # <<< Добавлен импорт (уже был)
+from media_prefetch import media_prefetcher
+from report_dedup import new_session_id
 from states import ReportForm
+import tracing
 
 router = Router()
 
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
+    media_prefetcher.cancel(message.from_user.id)
     await state.clear()
+    # Новая анкета - новая трасса (по ней видно, где заявка провела время до доставки)
+    # и новый ID сессии, из которого строится ключ защиты от повторной отправки
+    await state.update_data(trace=tracing.new_trace(), session_id=new_session_id())
     await message.answer(
         "👋 <b>Здравствуйте!</b>\n\n"
         "Я помогу вам сообщить об экологической проблеме. Пожалуйста, выберите тип проблемы:",
@@ -31,6 +40,7 @@ async def go_to_start_handler(call: CallbackQuery, state: FSMContext):
     Сбрасывает состояние и показывает стартовое сообщение.
     """
     await state.clear()
+    await state.update_data(trace=tracing.new_trace(), session_id=new_session_id())
     await call.message.edit_text(
         "👋 <b>Здравствуйте!</b>\n\n"
         "Я помогу вам сообщить об экологической проблеме. Пожалуйста, выберите тип проблемы:",
@@ -45,6 +55,7 @@ async def go_to_start_handler(call: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "cancel_all", StateFilter(ReportForm))
 async def cancel_handler_callback(call: CallbackQuery, state: FSMContext):
+    media_prefetcher.cancel(call.from_user.id)
     await state.clear()
     await call.message.edit_text(
         "Действие отменено. Вы можете создать новую заявку в любой момент, введя /start.",
@@ -55,6 +66,7 @@ async def cancel_handler_callback(call: CallbackQuery, state: FSMContext):
 
 @router.message(F.text == "❌ Отменить", StateFilter(ReportForm))
 async def cancel_handler_text(message: Message, state: FSMContext):
+    media_prefetcher.cancel(message.from_user.id)
     await state.clear()
     await message.answer(
         "Действие отменено. Вы можете создать новую заявку в любой момент, введя /start.",
@@ -62,6 +74,24 @@ async def cancel_handler_text(message: Message, state: FSMContext):
     )
 
 
+async def draft_expired(bot: Bot, key: StorageKey, state: str | None, data: dict, evicted: bool):
+    """
+    Анкета удалена хранилищем: брошена дольше FSM_STATE_TTL_SEC или вытеснена из-за лимита (evicted).
+    Вызывается хранилищем в памяти (create_storage(on_expire=...)), не из хэндлера.
+    """
+    media_prefetcher.cancel(key.user_id)
+    if not FSM_EXPIRED_NOTICE or state is None:
+        return
+    if evicted:
+        # Пользователь мог отойти совсем ненадолго: дело не в нем, а в нагрузке на бота
+        text = ("⚠️ Незаконченная заявка не сохранилась: бот сейчас перегружен. "
+                "Пожалуйста, начните заново: /start.")
+    else:
+        text = ("⌛ Незаконченная заявка удалена, так как долго не заполнялась. "
+                "Чтобы сообщить о проблеме, начните заново: /start.")
+    await bot.send_message(key.chat_id, text, reply_markup=ReplyKeyboardRemove())
+
+
 @router.callback_query(F.data == "go_back", StateFilter(ReportForm))
 async def back_handler_callback(call: CallbackQuery, state: FSMContext):
     current_state_str = await state.get_state()
@@ -1,11 +1,15 @@
 # file: handlers/form_editing.py
-import logging  # <<< 1. ДОБАВЛЕН ИМПОРТ
+import logging
+
 from aiogram import F, Router, Bot
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, ReplyKeyboardRemove
 
+from api_batch import StepTimer, fire_and_forget, run_parallel
 from keyboards import (get_edit_kb, get_cancel_kb, get_location_choice_kb,
                        get_feedback_choice_kb, get_rodents_choice_kb)
+from media_prefetch import media_prefetcher
+from report_dedup import report_dedup, report_key
 from states import ReportForm
 from logic import send_final_report, show_confirmation_summary
 
@@ -25,57 +29,75 @@ async def process_confirmation_send(call: CallbackQuery, state: FSMContext, bot:
                           "Пожалуйста, нажмите 'Редактировать' и 'Контактные данные'.", show_alert=True)
         return
 
+    # --- Повторное нажатие той же анкеты (ретрай колбэка, повтор апдейта после сбоя) заявку не дублирует ---
+    key = report_key(call.from_user.id, data)
+    if not await report_dedup.claim(key):
+        logging.info(f"Повторный confirm:send от {call.from_user.id}: заявка уже принята")
+        await call.answer("Эта заявка уже отправлена.")
+        media_prefetcher.release(call.from_user.id)
+        await state.clear()
+        return
+
     # --- 1. Получаем ID для удаления ---
     media_msg_id = data.get('media_summary_message_id')
     chat_id = call.message.chat.id
     text_msg_id = call.message.message_id  # Сообщение с кнопками "Отправить"
+    timer = StepTimer("process_confirmation_send")
 
-    # --- 2. Удаляем сообщение с кнопками ---
-    try:
-        await bot.delete_message(chat_id, text_msg_id)
-    except Exception as e:
-        logging.warning(f"Could not delete text summary message: {e}")
-
-    # --- 3. Удаляем сообщение с медиа (фото/видео/кружок) ---
+    # --- 2-3. Удаляем сообщения сводки в фоне (ошибки только логируются) ---
+    fire_and_forget(bot.delete_message(chat_id, text_msg_id), "удаление текста сводки")
     if media_msg_id:
-        try:
-            await bot.delete_message(chat_id, media_msg_id)
-        except Exception as e:
-            logging.warning(f"Could not delete media summary message: {e}")
-
-    # --- 4. Отвечаем на callback, чтобы убрать "часики" ---
-    await call.answer()
-
-    # --- 5. Отправляем новое сообщение "Принято" ---
-    await bot.send_message(
-        chat_id,
-        "✅ <b>Принято!</b>\n\nСпасибо за вашу помощь. Отправляю заявку в работу...",
-        reply_markup=None
-    )
-
-    # --- 6. Вызываем отправку (теперь она возвращает True/False) ---
-    success = await send_final_report(call, state, bot)
-
-    # --- 7. Обрабатываем результат и чистим состояние ---
-    if success:
-        await bot.send_message(
-            chat_id,
-            "Заявка успешно отправлена.",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        await bot.send_message(chat_id, "Чтобы создать новую заявку, просто введите /start.")
-    else:
-        # Ошибка (то, что раньше было в send_final_report)
-        await bot.send_message(
-            chat_id,
-            "❗️ <b>Произошла ошибка</b>\n\n"
-            "К сожалению, не удалось отправить вашу заявку. "
-            "Пожалуйста, попробуйте снова через несколько минут.",
-            reply_markup=ReplyKeyboardRemove()
+        fire_and_forget(bot.delete_message(chat_id, media_msg_id), "удаление медиа сводки")
+
+    # --- 4. Ответ на callback - в фоне: устаревший колбэк (ошибка ответа) не должен мешать отправке заявки ---
+    fire_and_forget(call.answer(), "ответ на callback")
+
+    # --- 5-6. Сообщение "Принято" и постановка заявки в очередь не зависят друг от друга ---
+    # Результат решает только send_final_report: ошибка "Принято" не отменяет уже поставленную заявку
+    with timer.step("accept"):
+        accepted, success = await run_parallel(
+            bot.send_message(
+                chat_id,
+                "✅ <b>Принято!</b>\n\nСпасибо за вашу помощь. Отправляю заявку в работу...",
+                reply_markup=None
+            ),
+            send_final_report(call, state, bot),
+            return_exceptions=True
         )
+    if isinstance(accepted, Exception):
+        logging.warning(f"Не удалось отправить сообщение \"Принято\" пользователю {call.from_user.id}: {accepted}")
+    if isinstance(success, Exception):
+        logging.error(f"Ошибка при постановке заявки в очередь: {success}")
+        success = False
 
-    # --- 8. Очищаем состояние здесь ---
-    await state.clear()
+    # --- 7. Обрабатываем результат и чистим состояние ---
+    try:
+        with timer.step("result"):
+            if success:
+                await bot.send_message(
+                    chat_id,
+                    "Заявка успешно отправлена.",
+                    reply_markup=ReplyKeyboardRemove()
+                )
+                await bot.send_message(chat_id, "Чтобы создать новую заявку, просто введите /start.")
+            else:
+                # Заявка не принята: повторная попытка пользователя не должна считаться дублем
+                await report_dedup.release(key)
+                # Ошибка (то, что раньше было в send_final_report)
+                await bot.send_message(
+                    chat_id,
+                    "❗️ <b>Произошла ошибка</b>\n\n"
+                    "К сожалению, не удалось отправить вашу заявку. "
+                    "Пожалуйста, попробуйте снова через несколько минут.",
+                    reply_markup=ReplyKeyboardRemove()
+                )
+    finally:
+        timer.log()
+
+        # --- 8. Очищаем состояние здесь (даже если сообщение пользователю не ушло) ---
+        # Скачанное заранее медиа дождется отправки письма, даже если пользователь начнет новую анкету
+        media_prefetcher.release(call.from_user.id)
+        await state.clear()
 
 
 # --- ⬆️ КОНЕЦ ПЕРЕПИСАННОГО БЛОКА ⬆️ ---
@@ -9,7 +9,7 @@ from keyboards import (get_back_cancel_kb, get_location_choice_kb,
                        get_feedback_choice_kb, get_rodents_choice_kb,
                        get_skip_email_kb)
 from states import ReportForm
-from logic import show_confirmation_summary, escape_html
+from logic import show_confirmation_summary, escape_html, prefetch_media
 
 router = Router()
 
@@ -50,8 +50,11 @@ async def process_photo(message: Message, state: FSMContext, bot: Bot):
     photo_file_id = message.photo[-1].file_id
 
     # --- ИЗМЕНЕНИЕ: Обнуляем другие медиа ---
+    prefetch_media(bot, message.from_user.id, photo_file_id, message.photo[-1].file_unique_id)
     await state.update_data(
         photo_id=photo_file_id,
+        media_unique_id=message.photo[-1].file_unique_id,
+        media_size=message.photo[-1].file_size,
         media_type='photo',
         video_id=None,
         video_note_id=None
@@ -92,8 +95,11 @@ async def process_video(message: Message, state: FSMContext, bot: Bot):
     video_file_id = message.video.file_id
 
     # --- ИЗМЕНЕНИЕ: Обнуляем другие медиа ---
+    prefetch_media(bot, message.from_user.id, video_file_id, message.video.file_unique_id)
     await state.update_data(
         video_id=video_file_id,
+        media_unique_id=message.video.file_unique_id,
+        media_size=message.video.file_size,
         media_type='video',
         photo_id=None,
         video_note_id=None
@@ -135,8 +141,11 @@ async def process_video_note(message: Message, state: FSMContext, bot: Bot):
     video_note_file_id = message.video_note.file_id
 
     # --- Обновляем состояние ---
+    prefetch_media(bot, message.from_user.id, video_note_file_id, message.video_note.file_unique_id)
     await state.update_data(
         video_note_id=video_note_file_id,
+        media_unique_id=message.video_note.file_unique_id,
+        media_size=message.video_note.file_size,
         media_type='video_note',
         photo_id=None,
         video_id=None
@@ -0,0 +1,198 @@
+# file: media_cache.py
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from aiogram import Bot
+
+import metrics
+import tracing
+from config import MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_TTL_SEC
+
+# --- Метрики кэша ---
+cache_hits = metrics.counter("media_cache_hits_total", "Медиа, найденных в кэше на диске")
+cache_misses = metrics.counter("media_cache_misses_total", "Медиа, скачанных из Telegram")
+cache_joined = metrics.counter("media_cache_joined_total", "Запросов, дождавшихся уже идущей загрузки того же файла")
+cache_evictions = metrics.counter("media_cache_evictions_total", "Файлов, удаленных из кэша (размер или срок)")
+cache_bytes = metrics.gauge("media_cache_bytes", "Размер кэша медиа на диске")
+cache_entries = metrics.gauge("media_cache_entries", "Файлов в кэше медиа")
+
+_TMP_PREFIX = ".tmp-"
+
+
+@dataclass
+class _Entry:
+    name: str  # имя файла в каталоге кэша: <file_unique_id><расширение>
+    size: int
+    used_at: float  # время последнего обращения (time.time), оно же mtime файла
+
+
+@dataclass
+class _Flight:
+    task: asyncio.Task
+    waiters: int = 0
+
+
+class MediaCache:
+    """
+    Кэш медиа на диске, ключ - file_unique_id (одинаков для одного файла в разных сообщениях и у разных ботов).
+    Файл записывается во временный и переименовывается: недокачанный файл в кэш не попадает.
+    Вытеснение - по давности использования (LRU) при превышении max_bytes и по сроку ttl.
+    Одновременные запросы одного файла ждут одну загрузку; если все ждущие отменены - отменяется и загрузка.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float | None = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()  # от давно использованных к недавним
+        self._total = 0
+        self._in_flight: dict[str, _Flight] = {}
+        self._loaded = False
+
+    # --- Индекс ---
+    def _load(self):
+        """Индекс восстанавливается по файлам в каталоге: порядок LRU - по mtime"""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for item in os.scandir(self.directory):
+            if not item.is_file():
+                continue
+            if item.name.startswith(_TMP_PREFIX):
+                self._remove(item.path)  # Недокачано в прошлом запуске
+                continue
+            stat = item.stat()
+            found.append(_Entry(item.name, stat.st_size, stat.st_mtime))
+        for entry in sorted(found, key=lambda e: e.used_at):
+            self._entries[entry.name.split('.')[0]] = entry
+            self._total += entry.size
+        self._loaded = True
+        self._evict()
+        logging.info(f"Кэш медиа: {len(self._entries)} файлов, {self._total / 1024 / 1024:.1f} МБ")
+
+    def _path(self, entry: _Entry) -> str:
+        return os.path.join(self.directory, entry.name)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self._total -= entry.size
+        self._remove(self._path(entry))
+        cache_evictions.inc()
+
+    def _evict(self, keep: str | None = None):
+        if self.ttl:
+            deadline = time.time() - self.ttl
+            for key in [key for key, entry in self._entries.items() if entry.used_at < deadline]:
+                self._drop(key)
+        # Только что загруженный файл не вытесняется, даже если он один больше лимита
+        for key in list(self._entries):
+            if self._total <= self.max_bytes:
+                break
+            if key != keep:
+                self._drop(key)
+        cache_bytes.set(self._total)
+        cache_entries.set(len(self._entries))
+
+    def _lookup(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        if self.ttl and entry.used_at < now - self.ttl:
+            self._drop(key)
+            return None
+        path = self._path(entry)
+        try:
+            # mtime хранит порядок LRU между перезапусками
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            self._entries.pop(key)
+            self._total -= entry.size
+            return None
+        entry.used_at = now
+        self._entries.move_to_end(key)
+        return path
+
+    # --- Загрузка ---
+    async def _fetch(self, bot: Bot, file_id: str, key: str) -> str:
+        try:
+            # Спаны попадают в трассу заявки, запросившей файл первой (контекст копируется в задачу загрузки)
+            with tracing.span("telegram.get_file"):
+                file_info = await bot.get_file(file_id)
+            extension = os.path.splitext(file_info.file_path)[1]
+            tmp_path = os.path.join(self.directory, f"{_TMP_PREFIX}{uuid.uuid4().hex}")
+            try:
+                with tracing.span("telegram.download", size=file_info.file_size):
+                    await bot.download_file(file_info.file_path, tmp_path)
+                entry = _Entry(f"{key}{extension}", os.path.getsize(tmp_path), time.time())
+                os.replace(tmp_path, self._path(entry))
+            except BaseException:
+                self._remove(tmp_path)
+                raise
+            if key in self._entries:
+                self._total -= self._entries.pop(key).size
+            self._entries[key] = entry
+            self._total += entry.size
+            self._evict(keep=key)
+            return self._path(entry)
+        finally:
+            self._in_flight.pop(key, None)
+
+    async def get(self, bot: Bot, file_id: str, unique_id: str | None = None) -> str:
+        """Путь к файлу в кэше; при промахе файл скачивается из Telegram"""
+        if not self._loaded:
+            self._load()
+        # Задачи, поставленные до появления кэша, не знают file_unique_id
+        key = unique_id or file_id
+        path = self._lookup(key)
+        if path is not None:
+            cache_hits.inc()
+            return path
+
+        flight = self._in_flight.get(key)
+        if flight is None:
+            cache_misses.inc()
+            flight = _Flight(asyncio.create_task(self._fetch(bot, file_id, key)))
+            self._in_flight[key] = flight
+        else:
+            cache_joined.inc()
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()
+
+    async def close(self):
+        flights = [flight.task for flight in self._in_flight.values()]
+        for task in flights:
+            task.cancel()
+        await asyncio.gather(*flights, return_exceptions=True)
+
+    def stats(self) -> dict:
+        hits, misses, joined = int(cache_hits.value), int(cache_misses.value), int(cache_joined.value)
+        requests = hits + misses + joined
+        return {
+            "hits": hits,
+            "misses": misses,
+            "joined": joined,
+            "hit_rate": (hits + joined) / requests if requests else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._total,
+        }
+
+
+# Глобальный экземпляр (используется фоновой загрузкой и задачей отправки письма)
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES, ttl=MEDIA_CACHE_TTL_SEC)
@@ -0,0 +1,169 @@
+# file: media_links.py
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import re
+import shutil
+import time
+from urllib.parse import quote
+
+from aiohttp import web
+
+import metrics
+from config import (BOT_TOKEN, MEDIA_LINKS_BASE_URL, MEDIA_LINKS_DIR, MEDIA_LINKS_PATH, MEDIA_LINKS_RETENTION_SEC,
+                    MEDIA_LINKS_SECRET, MEDIA_LINKS_HOST, MEDIA_LINKS_PORT)
+
+# --- Метрики ссылок на медиа ---
+links_published = metrics.counter("media_links_published_total", "Медиа, опубликованных по ссылке")
+links_served = metrics.counter("media_links_requests_total", "Запросов медиа по ссылке")
+links_rejected = metrics.counter("media_links_rejected_total", "Запросов с неверной или истекшей подписью")
+links_removed = metrics.counter("media_links_removed_total", "Файлов, удаленных по истечении срока хранения")
+
+# Имя файла: только безопасные символы (file_unique_id + расширение), без путей
+_SAFE_NAME = re.compile(r"^[A-Za-z0-9_-]+(\.[A-Za-z0-9]+)?$")
+# Срок хранения файла (unix) - рядом, в name.expires, а не в mtime: опубликованный файл - жесткая ссылка
+# на файл кэша медиа, у них общий inode, и кэш обновляет его mtime при каждом обращении
+_EXPIRES_SUFFIX = ".expires"
+
+
+def _secret() -> bytes:
+    # Без отдельного ключа подпись выводится из токена бота: ссылки переживают перезапуск
+    if MEDIA_LINKS_SECRET:
+        return MEDIA_LINKS_SECRET.encode()
+    return hashlib.sha256(f"media-links:{BOT_TOKEN}".encode()).digest()
+
+
+def sign(name: str, expires: int) -> str:
+    digest = hmac.new(_secret(), f"{name}:{expires}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode().rstrip("=")
+
+
+def _read_expires(path: str) -> float | None:
+    try:
+        with open(path + _EXPIRES_SUFFIX, encoding="ascii") as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _publish_file(source: str, name: str, expires: int):
+    destination = os.path.join(MEDIA_LINKS_DIR, name)
+    os.makedirs(MEDIA_LINKS_DIR, exist_ok=True)
+    if not os.path.exists(destination):
+        tmp_path = destination + ".part"
+        try:
+            # Жесткая ссылка - без копирования, если кэш и каталог ссылок на одном диске
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+    # Та же медиа уже опубликована: срок хранения продлевается до истечения самой поздней ссылки
+    current = _read_expires(destination)
+    if current is None or current < expires:
+        tmp_path = destination + _EXPIRES_SUFFIX + ".part"
+        with open(tmp_path, "w", encoding="ascii") as f:
+            f.write(str(expires))
+        os.replace(tmp_path, destination + _EXPIRES_SUFFIX)
+
+
+async def publish(source: str) -> tuple[str, int]:
+    """
+    Кладет файл в каталог ссылок и возвращает подписанный URL и время его истечения (unix).
+    Имя файла в кэше уже уникально для медиа (file_unique_id), оно же используется в ссылке.
+    """
+    name = os.path.basename(source)
+    if not _SAFE_NAME.match(name):
+        raise ValueError(f"Недопустимое имя файла для ссылки: {name}")
+    expires = int(time.time() + MEDIA_LINKS_RETENTION_SEC)
+    await asyncio.to_thread(_publish_file, source, name, expires)
+    links_published.inc()
+    url = f"{MEDIA_LINKS_BASE_URL.rstrip('/')}{MEDIA_LINKS_PATH}/{quote(name)}?expires={expires}&sig={sign(name, expires)}"
+    return url, expires
+
+
+async def handle_media(request: web.Request) -> web.StreamResponse:
+    """Отдача файла по подписанной ссылке. FileResponse поддерживает Range и отправляет файл через sendfile"""
+    links_served.inc()
+    name = request.match_info["name"]
+    try:
+        expires = int(request.query.get("expires", ""))
+    except ValueError:
+        expires = 0
+    # compare_digest для str принимает только ASCII: сравниваем байты, чтобы мусор в sig давал 403, а не 500
+    signature = request.query.get("sig", "").encode("utf-8", errors="replace")
+    if (not _SAFE_NAME.match(name) or expires < time.time()
+            or not hmac.compare_digest(signature, sign(name, expires).encode())):
+        links_rejected.inc()
+        raise web.HTTPForbidden(text="Ссылка недействительна или устарела")
+
+    path = os.path.join(MEDIA_LINKS_DIR, name)
+    if not os.path.isfile(path):
+        raise web.HTTPNotFound(text="Файл удален по истечении срока хранения")
+    return web.FileResponse(path, headers={
+        "Cache-Control": "private, max-age=3600",
+        "Content-Disposition": f'inline; filename="{name}"',
+    })
+
+
+def setup_media_routes(app: web.Application):
+    app.router.add_get(f"{MEDIA_LINKS_PATH}/{{name}}", handle_media)
+
+
+def _remove_expired() -> int:
+    if not os.path.isdir(MEDIA_LINKS_DIR):
+        return 0
+    now = time.time()
+    removed = 0
+    for item in os.scandir(MEDIA_LINKS_DIR):
+        if not item.is_file():
+            continue
+        if item.name.endswith(_EXPIRES_SUFFIX):
+            # Срок файла, которого уже нет
+            if not os.path.exists(item.path[:-len(_EXPIRES_SUFFIX)]):
+                try:
+                    os.remove(item.path)
+                except OSError:
+                    pass
+            continue
+        # Без файла срока (недописанные .part) - по mtime
+        expires = _read_expires(item.path)
+        if expires is None:
+            expires = item.stat().st_mtime + MEDIA_LINKS_RETENTION_SEC
+        if expires < now:
+            try:
+                os.remove(item.path)
+                removed += 1
+            except OSError:
+                continue
+            try:
+                os.remove(item.path + _EXPIRES_SUFFIX)
+            except OSError:
+                pass
+    return removed
+
+
+async def run_cleanup(interval: float = 3600.0):
+    """Фоновая задача: удаление файлов, срок хранения которых истек (ссылки на них тоже уже истекли)"""
+    while True:
+        try:
+            removed = await asyncio.to_thread(_remove_expired)
+            if removed:
+                links_removed.inc(removed)
+                logging.info(f"Ссылки на медиа: удалено {removed} файлов с истекшим сроком хранения")
+        except Exception as e:
+            logging.warning(f"Ошибка очистки каталога ссылок на медиа: {e}")
+        await asyncio.sleep(min(interval, MEDIA_LINKS_RETENTION_SEC))
+
+
+async def start_media_server() -> web.AppRunner:
+    """Отдельный HTTP-сервер для ссылок (в режиме вебхука ссылки обслуживает приложение вебхука)"""
+    app = web.Application()
+    setup_media_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, MEDIA_LINKS_HOST, MEDIA_LINKS_PORT).start()
+    logging.info(f"Ссылки на медиа обслуживаются на {MEDIA_LINKS_HOST}:{MEDIA_LINKS_PORT}{MEDIA_LINKS_PATH}")
+    return runner
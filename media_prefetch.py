@@ -0,0 +1,77 @@
+# file: media_prefetch.py
+import asyncio
+import logging
+
+from aiogram import Bot
+
+import metrics
+from media_cache import MediaCache, media_cache
+
+# --- Метрики предзагрузки ---
+prefetch_started = metrics.counter("media_prefetch_started_total", "Запущено фоновых загрузок медиа")
+prefetch_cancelled = metrics.counter("media_prefetch_cancelled_total", "Загрузок, отмененных из-за замены медиа")
+prefetch_in_progress = metrics.gauge("media_prefetch_in_progress", "Фоновых загрузок медиа в работе")
+
+
+class MediaPrefetcher:
+    """
+    Фоновая загрузка медиа заявки в кэш, пока пользователь заполняет остальные поля.
+    Загрузка привязана к пользователю: новое медиа от того же пользователя отменяет предыдущую.
+    Отправка письма берет файл из кэша (или дожидается уже идущей загрузки).
+    """
+
+    def __init__(self, cache: MediaCache):
+        self.cache = cache
+        self._tasks: dict[int, tuple[str, asyncio.Task]] = {}  # ID пользователя -> (file_id, загрузка)
+        self._released: set[asyncio.Task] = set()
+
+    async def _prefetch(self, bot: Bot, file_id: str, unique_id: str | None):
+        prefetch_in_progress.inc()
+        try:
+            await self.cache.get(bot, file_id, unique_id)
+        except Exception as e:
+            # Не страшно: при отправке письма медиа будет скачано заново
+            logging.warning(f"Фоновая загрузка медиа {file_id} не удалась: {e}")
+        finally:
+            prefetch_in_progress.dec()
+
+    def start(self, bot: Bot, owner: int, file_id: str, unique_id: str | None = None):
+        """Запускает загрузку медиа пользователя owner, отменяя загрузку его прежнего медиа"""
+        current = self._tasks.get(owner)
+        if current is not None and current[0] == file_id:
+            return
+        self.cancel(owner)
+        task = asyncio.create_task(self._prefetch(bot, file_id, unique_id))
+        task.add_done_callback(lambda t: self._forget(owner, t))
+        self._tasks[owner] = (file_id, task)
+        prefetch_started.inc()
+
+    def _forget(self, owner: int, task: asyncio.Task):
+        self._released.discard(task)
+        if owner in self._tasks and self._tasks[owner][1] is task:
+            del self._tasks[owner]
+
+    def cancel(self, owner: int):
+        """Медиа заменено или анкета отменена: загрузка больше не нужна"""
+        _, task = self._tasks.pop(owner, (None, None))
+        if task is not None and not task.done():
+            prefetch_cancelled.inc()
+            task.cancel()
+
+    def release(self, owner: int):
+        """Заявка отправлена: загрузка продолжается для письма, но уже не отменяется пользователем"""
+        _, task = self._tasks.pop(owner, (None, None))
+        if task is not None and not task.done():
+            self._released.add(task)
+
+    async def close(self):
+        tasks = [task for _, task in self._tasks.values()] + list(self._released)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._released.clear()
+
+
+# Глобальный экземпляр (используется хэндлерами)
+media_prefetcher = MediaPrefetcher(media_cache)
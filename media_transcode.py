@@ -0,0 +1,129 @@
+# file: media_transcode.py
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+import metrics
+from config import (EMAIL_IMAGE_RECOMPRESS, EMAIL_IMAGE_MAX_DIMENSION, EMAIL_IMAGE_QUALITY,
+                    EMAIL_VIDEO_POSTER, FFMPEG_PATH, MEDIA_WORKERS)
+
+# --- Метрики обработки вложений ---
+images_recompressed = metrics.counter("email_images_recompressed_total", "Фото, пережатых перед отправкой на email")
+bytes_saved = metrics.counter("email_image_bytes_saved_total", "Байт, сэкономленных пережатием фото")
+posters_extracted = metrics.counter("email_video_posters_total", "Кадров-превью, извлеченных из видео")
+
+_executor: ProcessPoolExecutor | None = None
+_pillow_available = importlib.util.find_spec("PIL") is not None
+
+
+def _recompress_photo(source: str, destination: str, max_dimension: int, quality: int) -> int:
+    """
+    Выполняется в отдельном процессе. Уменьшает фото до max_dimension по большей стороне
+    и пересохраняет в JPEG. Из EXIF остаются только GPS-координаты (поворот применяется к пикселям).
+    Возвращает размер результата в байтах.
+    """
+    from PIL import ExifTags, Image, ImageOps
+
+    with Image.open(source) as original:
+        gps = original.getexif().get_ifd(ExifTags.IFD.GPSInfo)
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        exif = Image.Exif()
+        if gps:
+            exif[ExifTags.IFD.GPSInfo] = gps
+        image.save(destination, "JPEG", quality=quality, optimize=True, progressive=True, exif=exif)
+    return os.path.getsize(destination)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Пул процессов создается при первом пережатии: обработка фото не блокирует event loop.
+    Процессы запускаются через spawn, а не fork: копия процесса с event loop и потоками
+    (SQLite, SMTP, to_thread) может унаследовать захваченные блокировки и зависнуть
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=MEDIA_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def recompress_photo(source: str, destination: str) -> bool:
+    """True, если пережатое фото записано в destination и оно меньше исходного"""
+    original_size = os.path.getsize(source)
+    loop = asyncio.get_running_loop()
+    try:
+        size = await loop.run_in_executor(get_executor(), _recompress_photo, source, destination,
+                                          EMAIL_IMAGE_MAX_DIMENSION, EMAIL_IMAGE_QUALITY)
+    except Exception as e:
+        logging.warning(f"Не удалось пережать фото {source}: {e}")
+        return False
+    if size >= original_size:
+        return False
+    images_recompressed.inc()
+    bytes_saved.inc(original_size - size)
+    return True
+
+
+async def extract_poster(source: str, destination: str) -> bool:
+    """Кадр-превью из видео (через ffmpeg, если он установлен)"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-v", "error", "-y", "-i", source, "-frames:v", "1",
+            "-vf", f"scale='min({EMAIL_IMAGE_MAX_DIMENSION},iw)':-2", "-q:v", "4", destination,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
+    except (OSError, asyncio.TimeoutError) as e:
+        logging.warning(f"Не удалось получить превью видео {source}: {e}")
+        return False
+    if process.returncode != 0 or not os.path.exists(destination):
+        logging.warning(f"ffmpeg не смог получить превью видео {source}: {stderr.decode(errors='replace')[:200]}")
+        return False
+    posters_extracted.inc()
+    return True
+
+
+@asynccontextmanager
+async def email_attachments(path: str, media_type: str | None):
+    """
+    Список вложений письма [(путь, имя)] для медиа заявки.
+    Фото при включенном EMAIL_IMAGE_RECOMPRESS заменяется пережатой копией, к видео добавляется превью.
+    Временные файлы удаляются при выходе из контекста.
+    """
+    name = os.path.basename(path)
+    attachments = [(path, name)]
+    temp_dir = None
+    try:
+        if media_type == 'photo' and EMAIL_IMAGE_RECOMPRESS and _pillow_available:
+            temp_dir = tempfile.mkdtemp(prefix="email-media-")
+            destination = os.path.join(temp_dir, f"{os.path.splitext(name)[0]}.jpg")
+            if await recompress_photo(path, destination):
+                attachments = [(destination, os.path.basename(destination))]
+        elif media_type in ('video', 'video_note') and EMAIL_VIDEO_POSTER and FFMPEG_PATH:
+            temp_dir = tempfile.mkdtemp(prefix="email-media-")
+            destination = os.path.join(temp_dir, f"{os.path.splitext(name)[0]}_poster.jpg")
+            if await extract_poster(path, destination):
+                attachments.append((destination, os.path.basename(destination)))
+        yield attachments
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if EMAIL_IMAGE_RECOMPRESS and not _pillow_available:
+    logging.warning("EMAIL_IMAGE_RECOMPRESS включен, но Pillow не установлен: фото отправляются без пережатия")
@@ -0,0 +1,166 @@
+# file: metrics.py
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Counter:
+    """Монотонно растущий счетчик"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Gauge:
+    """Значение, которое может как расти, так и уменьшаться"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+# Границы корзин по умолчанию (секунды): от миллисекунд хэндлера до долгой отправки письма
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """
+    Распределение значений (обычно длительностей) по корзинам, с метками:
+    histogram.observe(0.12, handler="process_photo").
+    """
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # Метки -> (счетчики по корзинам, сумма, количество); последняя корзина - +Inf
+        self._series: dict[tuple[tuple[str, str], ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted((name, str(label)) for name, label in labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Замер длительности блока (в том числе с await внутри)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def series(self) -> list[tuple[dict[str, str], list[int], float, int]]:
+        """Копия всех рядов: (метки, счетчики по корзинам, сумма, количество)"""
+        with self._lock:
+            return [(dict(key), list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+
+    @property
+    def value(self) -> float:
+        # Для snapshot(): общее число наблюдений по всем меткам
+        with self._lock:
+            return sum(series[2] for series in self._series.values())
+
+
+# --- Глобальный реестр метрик ---
+_registry: dict[str, Counter | Gauge | Histogram] = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_create(cls, name: str, description: str, *args):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = cls(name, description, *args)
+            _registry[name] = metric
+        elif not isinstance(metric, cls):
+            raise TypeError(f"Метрика {name} уже зарегистрирована с другим типом")
+        return metric
+
+
+def counter(name: str, description: str = "") -> Counter:
+    return _get_or_create(Counter, name, description)
+
+
+def gauge(name: str, description: str = "") -> Gauge:
+    return _get_or_create(Gauge, name, description)
+
+
+def histogram(name: str, description: str = "", buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, description, buckets)
+
+
+def snapshot() -> dict[str, float]:
+    """Текущие значения всех метрик (для логов и отладки)"""
+    with _registry_lock:
+        return {name: metric.value for name, metric in _registry.items()}
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + "}"
+
+
+def render_prometheus() -> str:
+    """Все метрики в текстовом формате Prometheus (для /metrics)"""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        if metric.description:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+        if isinstance(metric, Histogram):
+            lines.append(f"# TYPE {metric.name} histogram")
+            for labels, counts, total, count in metric.series():
+                cumulative = 0
+                for bound, bucket_count in zip((*metric.buckets, "+Inf"), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{metric.name}_bucket{_format_labels({**labels, 'le': str(bound)})} {cumulative}")
+                lines.append(f"{metric.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{metric.name}_count{_format_labels(labels)} {count}")
+        else:
+            lines.append(f"# TYPE {metric.name} {'counter' if isinstance(metric, Counter) else 'gauge'}")
+            lines.append(f"{metric.name} {metric.value}")
+    return "\n".join(lines) + "\n"
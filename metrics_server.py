@@ -0,0 +1,28 @@
+# file: metrics_server.py
+import asyncio
+import logging
+
+from aiohttp import web
+
+import metrics
+from config import METRICS_HOST, METRICS_PORT
+
+# --- Метрики процесса, которые считаются в момент запроса ---
+asyncio_tasks = metrics.gauge("asyncio_tasks", "Задач asyncio в процессе (апдейты, фоновые вызовы, воркеры)")
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    asyncio_tasks.set(len(asyncio.all_tasks()))
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-store"})
+
+
+async def start_metrics_server() -> web.AppRunner:
+    """HTTP-сервер с /metrics в формате Prometheus"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
@@ -0,0 +1,56 @@
+from aiogram import Bot, Dispatcher
+
+from config import (RATE_LIMIT_GLOBAL_PER_SEC, RATE_LIMIT_PRIVATE_PER_SEC, RATE_LIMIT_PRIVATE_BURST,
+                    RATE_LIMIT_GROUP_PER_MIN, RATE_LIMIT_MAX_RETRIES, TRACING_ENABLED, ANTIFLOOD_ENABLED,
+                    ANTIFLOOD_RATE_PER_SEC, ANTIFLOOD_BURST, ANTIFLOOD_WINDOW_SEC, ANTIFLOOD_WINDOW_LIMIT)
+from .anti_flood import AntiFloodMiddleware
+from .instrumentation import ApiMetricsMiddleware, HandlerMetricsMiddleware, UpdateMetricsMiddleware
+from .rate_limit import RateLimitMiddleware
+from .state_session import RecordFSMContextMiddleware, StateSessionMiddleware
+from .tracing import TraceMiddleware
+
+
+def setup_middlewares(dp: Dispatcher):
+    # Dispatcher регистрирует FSMContextMiddleware (чтение состояния) сам; переносим его в конец цепочки,
+    # чтобы замер апдейта включал чтение состояния, а анти-флуд отбрасывал апдейты до него.
+    # Заменяем на RecordFSMContextMiddleware: состояние и данные анкеты читаются одним обращением
+    fsm_registered = dp.fsm in dp.update.outer_middleware
+    if fsm_registered:
+        dp.update.outer_middleware.unregister(dp.fsm)
+    if not isinstance(dp.fsm, RecordFSMContextMiddleware):
+        dp.fsm = RecordFSMContextMiddleware(storage=dp.fsm.storage, events_isolation=dp.fsm.events_isolation,
+                                            strategy=dp.fsm.strategy)
+    # Время обработки апдейтов и хэндлеров (inner-middleware знает, какой хэндлер выбран)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    if ANTIFLOOD_ENABLED:
+        dp.update.outer_middleware(AntiFloodMiddleware(
+            rate=ANTIFLOOD_RATE_PER_SEC,
+            burst=ANTIFLOOD_BURST,
+            window=ANTIFLOOD_WINDOW_SEC,
+            window_limit=ANTIFLOOD_WINDOW_LIMIT
+        ))
+    if fsm_registered:
+        dp.update.outer_middleware(dp.fsm)
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    # Спаны переходов анкеты (сама трасса создается в /start)
+    if TRACING_ENABLED:
+        dp.message.middleware(TraceMiddleware())
+        dp.callback_query.middleware(TraceMiddleware())
+    # Одно чтение и одна запись анкеты на апдейт вместо нескольких обращений из каждого хэндлера
+    dp.message.outer_middleware(StateSessionMiddleware())
+    dp.callback_query.outer_middleware(StateSessionMiddleware())
+
+
+def setup_session_middlewares(bot: Bot, rate_share: float = 1.0):
+    # Лимиты Telegram на отправку: общий на бота, на личный чат и (строже) на группу.
+    # rate_share - доля общего лимита, если бот отправляет из нескольких процессов
+    bot.session.middleware(RateLimitMiddleware(
+        global_rate=RATE_LIMIT_GLOBAL_PER_SEC * rate_share,
+        private_rate=RATE_LIMIT_PRIVATE_PER_SEC,
+        group_rate=RATE_LIMIT_GROUP_PER_MIN / 60,
+        private_burst=RATE_LIMIT_PRIVATE_BURST,
+        max_retries=RATE_LIMIT_MAX_RETRIES
+    ))
+    # Регистрируется после ограничителя, то есть ближе к сети: ожидание лимита в замер не входит
+    bot.session.middleware(ApiMetricsMiddleware())
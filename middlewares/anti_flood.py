@@ -0,0 +1,118 @@
+# file: middlewares/anti_flood.py
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+import metrics
+
+# --- Метрики анти-флуда ---
+flood_dropped = metrics.counter("antiflood_dropped_total", "Апдейтов, отброшенных до чтения анкеты")
+flood_warnings = metrics.counter("antiflood_warnings_total", "Отправленных предупреждений \"слишком часто\"")
+flood_users = metrics.gauge("antiflood_tracked_users", "Пользователей, для которых хранится счетчик")
+
+SLOW_DOWN_TEXT = "⏳ Слишком много сообщений. Пожалуйста, подождите немного и продолжите."
+
+
+class _UserFlood:
+    __slots__ = ("tokens", "updated", "window", "count", "previous", "warned")
+
+    def __init__(self, burst: float, now: float, window: int):
+        self.tokens = burst
+        self.updated = now
+        self.window = window
+        self.count = 0
+        self.previous = 0
+        self.warned = -1
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """
+    Outer-middleware на dp.update, стоит до FSMContextMiddleware: лишние апдейты пользователя
+    отбрасываются до чтения анкеты, фильтров и ответов хэндлеров.
+
+    Два ограничения на пользователя:
+    - token bucket (rate в секунду, запас burst) - пропускает альбом или быстрые нажатия, режет очереди;
+    - скользящее окно window секунд, не больше window_limit апдейтов - приближение по двум соседним
+      фиксированным окнам (счетчик прошлого окна берется с весом оставшейся доли), O(1) памяти.
+    На все отброшенное за окно - не больше одного ответа "слишком часто".
+    Счетчики пользователей, молчащих дольше двух окон, удаляются (OrderedDict в порядке последней активности).
+    """
+
+    def __init__(self, rate: float, burst: float, window: float, window_limit: int):
+        if rate <= 0 or window <= 0:
+            raise ValueError(f"Скорость и окно анти-флуда должны быть больше 0: rate={rate}, window={window}")
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.window_limit = window_limit
+        self._users: OrderedDict[int, _UserFlood] = OrderedDict()
+
+    def _forget_idle(self, now: float):
+        # За два окна без апдейтов bucket наполняется, а оценка окна обнуляется: счетчик не нужен
+        idle_before = now - max(self.window * 2, self.burst / self.rate)
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            if state.updated >= idle_before:
+                break
+            del self._users[user_id]
+
+    def allow(self, user_id: int, now: float) -> tuple[bool, bool]:
+        """(пропустить ли апдейт, нужно ли предупредить пользователя)"""
+        window = int(now // self.window)
+        state = self._users.get(user_id)
+        if state is None:
+            self._forget_idle(now)
+            state = self._users[user_id] = _UserFlood(self.burst, now, window)
+            flood_users.set(len(self._users))
+        else:
+            self._users.move_to_end(user_id)
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        state.updated = now
+
+        if window != state.window:
+            state.previous = state.count if window == state.window + 1 else 0
+            state.count = 0
+            state.window = window
+        estimate = state.previous * (1 - (now % self.window) / self.window) + state.count
+
+        if state.tokens >= 1 and estimate < self.window_limit:
+            state.tokens -= 1
+            state.count += 1
+            return True, False
+        if state.warned != window:
+            state.warned = window
+            return False, True
+        return False, False
+
+    async def _warn(self, event: Message | CallbackQuery):
+        flood_warnings.inc()
+        try:
+            # Для колбэка - всплывающая подсказка (заодно снимает "часики" с кнопки), для сообщения - ответ в чат
+            await event.answer(SLOW_DOWN_TEXT)
+        except Exception as e:
+            logging.warning(f"Не удалось отправить предупреждение о флуде: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        # Ограничиваются только сообщения и нажатия кнопок (прямая проверка полей дешевле Update.event_type)
+        target = (event.message or event.callback_query) if isinstance(event, Update) else None
+        if user is None or target is None:
+            return await handler(event, data)
+
+        allowed, warn = self.allow(user.id, time.monotonic())
+        if allowed:
+            return await handler(event, data)
+        flood_dropped.inc()
+        if warn:
+            await self._warn(target)
+        return UNHANDLED
@@ -0,0 +1,94 @@
+# file: middlewares/instrumentation.py
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+
+import metrics
+
+# --- Метрики обработки апдейтов ---
+updates_in_flight = metrics.gauge("updates_in_flight", "Апдейтов, обрабатываемых прямо сейчас")
+update_duration = metrics.histogram("update_duration_seconds", "Полное время обработки апдейта по типу события")
+handler_duration = metrics.histogram("handler_duration_seconds",
+                                     "Время хэндлера по имени и состоянию анкеты, в котором пришел апдейт")
+handler_errors = metrics.counter("handler_errors_total", "Исключений, вылетевших из хэндлеров")
+
+# --- Метрики вызовов Bot API ---
+api_duration = metrics.histogram("bot_api_request_duration_seconds", "Время вызова Bot API по методу")
+api_errors = metrics.counter("bot_api_errors_total", "Вызовов Bot API, завершившихся ошибкой")
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Outer-middleware на dp.update: число апдейтов в обработке и полное время обработки
+    (включая чтение состояния, фильтры и запись анкеты). Необработанные апдейты - с handled="false".
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        event_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        updates_in_flight.inc()
+        started = time.perf_counter()
+        handled = "error"
+        try:
+            result = await handler(event, data)
+            handled = "false" if result is UNHANDLED else "true"
+            return result
+        finally:
+            updates_in_flight.dec()
+            update_duration.observe(time.perf_counter() - started, event=event_type, handled=handled)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner-middleware: вызывается уже для выбранного хэндлера, поэтому знает его имя.
+    Состояние - то, в котором пришел апдейт (raw_state, до перехода).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "unknown") if handler_object else "unknown"
+        state = data.get("raw_state") or "none"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc()
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, handler=name, state=state)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot: время каждого вызова Bot API по имени метода"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            status = "error"
+            api_errors.inc()
+            raise
+        finally:
+            api_duration.observe(time.perf_counter() - started, method=type(method).__name__, status=status)
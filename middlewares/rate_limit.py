@@ -0,0 +1,137 @@
+# file: middlewares/rate_limit.py
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+import metrics
+
+# --- Метрики ограничителя ---
+rate_limit_queue_depth = metrics.gauge("rate_limit_queue_depth", "Вызовов Bot API, ожидающих разрешения на отправку")
+rate_limit_throttled = metrics.counter("rate_limit_throttled_total", "Вызовов, придержанных ограничителем")
+rate_limit_retry_after = metrics.counter("rate_limit_retry_after_total", "Полученных от Telegram ответов RetryAfter")
+
+# Методы, на которые распространяются лимиты Telegram на отправку сообщений
+_LIMITED_PREFIXES = ("Send", "Copy", "Forward", "Edit")
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше capacity про запас.
+    Ожидающие вызовы обслуживаются по очереди (asyncio.Lock честный - FIFO).
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.waiting = 0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return not self.waiting and self.tokens >= self.capacity and time.monotonic() >= self._blocked_until
+
+    async def acquire(self):
+        self.waiting += 1
+        rate_limit_queue_depth.inc()
+        try:
+            async with self._lock:
+                throttled = False
+                while True:
+                    now = time.monotonic()
+                    if now < self._blocked_until:
+                        delay = self._blocked_until - now
+                    else:
+                        self._refill(now)
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            break
+                        delay = (1 - self.tokens) / self.rate
+                    if not throttled:
+                        throttled = True
+                        rate_limit_throttled.inc()
+                    await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+            rate_limit_queue_depth.dec()
+
+    def block(self, seconds: float):
+        """Telegram попросил подождать: до истечения срока вызовы не выпускаются"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Ограничитель исходящих вызовов Bot API (middleware сессии бота).
+    Общий лимит на бота плюс отдельные лимиты на каждый чат (для групп - строже).
+    Вызов, превышающий лимит, не падает, а ждет своей очереди. На RetryAfter чат
+    (или весь бот) ставится на паузу, и вызов повторяется.
+    """
+
+    def __init__(self, global_rate: float, private_rate: float, group_rate: float,
+                 private_burst: int = 3, max_retries: int = 3, max_buckets: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.private_burst = private_burst
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_buckets:
+                # Забываем чаты, которые давно ничего не отправляли (их бакеты полные)
+                self._chat_buckets = {key: b for key, b in self._chat_buckets.items() if not b.is_idle()}
+            # Отрицательный ID (или @username канала) - группа/канал
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.private_rate
+            # Небольшой запас для личных чатов, чтобы пара сообщений подряд уходила без задержки
+            bucket = TokenBucket(rate, capacity=1 if is_group else self.private_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def queue_depth(self) -> int:
+        return self.global_bucket.waiting + sum(b.waiting for b in self._chat_buckets.values())
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if not type(method).__name__.startswith(_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        attempt = 0
+        while True:
+            chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            # Сначала ждем лимит чата, потом общий: придержанный чат не занимает общий токен
+            if chat_bucket is not None:
+                await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                rate_limit_retry_after.inc()
+                (chat_bucket or self.global_bucket).block(e.retry_after)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logging.warning(f"Telegram RetryAfter {e.retry_after} с для {type(method).__name__} "
+                                f"в чат {chat_id}, повтор {attempt}/{self.max_retries}")
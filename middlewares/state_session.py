@@ -0,0 +1,148 @@
+# file: middlewares/state_session.py
+import logging
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, cast
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+import metrics
+
+# --- Метрики FSM-сессий (обращения к хранилищу считает InstrumentedStorage) ---
+state_sessions = metrics.counter("fsm_state_sessions_total", "Обработанных апдейтов с FSM-сессией")
+state_flush_errors = metrics.counter("fsm_state_flush_errors_total", "Апдейтов, изменения анкеты которых не сохранились")
+
+SAVE_FAILED_TEXT = "⚠️ Не удалось сохранить ответ. Пожалуйста, отправьте его еще раз."
+
+
+class RecordFSMContextMiddleware(FSMContextMiddleware):
+    """
+    FSMContextMiddleware, который под блокировкой чата читает состояние и данные анкеты одним обращением
+    к хранилищу (get_record): StateSession берет данные отсюда и сам хранилище не читает.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = self.resolve_event_context(cast(Bot, data["bot"]), data)
+        data["fsm_storage"] = self.storage
+        if context is None:
+            return await handler(event, data)
+        async with self.events_isolation.lock(key=context.key):
+            if hasattr(self.storage, "get_record"):
+                raw_state, state_data = await self.storage.get_record(context.key)
+                data.update({"state": context, "raw_state": raw_state, "state_data": state_data})
+            else:
+                data.update({"state": context, "raw_state": await context.get_state()})
+            return await handler(event, data)
+
+
+class StateSession(FSMContext):
+    """
+    FSMContext, который работает с копией анкеты в памяти на время одного апдейта.
+    Данные читаются из хранилища не больше одного раза, а все изменения
+    записываются одним сбросом в flush() после завершения хэндлера.
+    """
+
+    def __init__(self, context: FSMContext, raw_state: Optional[str], data: Optional[Dict[str, Any]] = None):
+        super().__init__(storage=context.storage, key=context.key)
+        # Состояние (и данные, если их прочитал RecordFSMContextMiddleware) уже прочитаны, повторно не читаем
+        self._state = raw_state
+        self._state_dirty = False
+        self._data = data
+        self._data_dirty = False
+
+    async def _load(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        return self._data
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_state(self) -> Optional[str]:
+        return self._state
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        self._data = dict(data)
+        self._data_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        return (await self._load()).copy()
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return (await self._load()).get(key, default)
+
+    async def update_data(self, data: Optional[Mapping[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        current = await self._load()
+        current.update(kwargs)
+        self._data_dirty = True
+        return current.copy()
+
+    async def flush(self):
+        if self._state_dirty and self._data_dirty and hasattr(self.storage, "set_record"):
+            # Состояние и данные - одним обращением к хранилищу
+            await self.storage.set_record(self.key, self._state, self._data)
+        else:
+            if self._data_dirty:
+                await self.storage.set_data(key=self.key, data=self._data)
+            if self._state_dirty:
+                await self.storage.set_state(key=self.key, state=self._state)
+        self._state_dirty = self._data_dirty = False
+
+
+class StateSessionMiddleware(BaseMiddleware):
+    """Подменяет state в хэндлерах на StateSession и сохраняет изменения после обработки апдейта"""
+
+    @staticmethod
+    async def _report_save_failed(event: TelegramObject):
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(SAVE_FAILED_TEXT, show_alert=True)
+            elif isinstance(event, Message):
+                await event.answer(SAVE_FAILED_TEXT)
+        except Exception as e:
+            logging.warning(f"Не удалось сообщить пользователю об ошибке сохранения: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+
+        session = StateSession(context, data.get("raw_state"), data.get("state_data"))
+        data["state"] = session
+        state_sessions.inc()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            # Изменения, сделанные до ошибки в хэндлере, сохраняются (как и без сессии);
+            # наружу уходит ошибка хэндлера
+            try:
+                await session.flush()
+            except Exception as e:
+                state_flush_errors.inc()
+                logging.error(f"Не удалось сохранить состояние анкеты: {e}")
+            raise
+
+        try:
+            await session.flush()
+        except Exception:
+            # Хэндлер уже ответил так, будто шаг принят: сообщаем пользователю, что ответ не сохранился
+            state_flush_errors.inc()
+            await self._report_save_failed(event)
+            raise
+        return result
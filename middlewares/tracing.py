@@ -0,0 +1,48 @@
+# file: middlewares/tracing.py
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+import tracing
+
+
+class TraceMiddleware(BaseMiddleware):
+    """
+    Inner-middleware: спан на каждый хэндлер анкеты (переход FSM из состояния в состояние).
+    Трасса берется из данных анкеты; вложенные спаны хэндлера (постановка в очередь) становятся его детьми.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        state = data.get("state")
+        if state is None:
+            return await handler(event, data)
+
+        # Данные анкеты StateSession читает один раз за апдейт, хэндлер их все равно запросит
+        before = tracing.context_from(await state.get_value("trace"))
+        handler_object = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "unknown") if handler_object else "unknown"
+        state_from = data.get("raw_state")
+        span_id = tracing.new_span_id()
+        token = tracing.activate(tracing.child_context(before, span_id))
+        started = time.time()
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            tracing.deactivate(token)
+            # /start создает новую трассу, а confirm:send очищает анкету: берем ту, что есть
+            context = tracing.context_from(await state.get_value("trace")) or before
+            user = data.get("event_from_user")
+            tracing.record_span(f"fsm.{name}", context, started, time.time(), span_id=span_id, error=error,
+                                state_from=state_from, state_to=await state.get_state(),
+                                user_id=user.id if user else None)
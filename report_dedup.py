@@ -0,0 +1,197 @@
+# file: report_dedup.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from config import FSM_STORAGE, FSM_SQLITE_PATH, REDIS_URL, REPORT_DEDUP_MAX_KEYS, REPORT_DEDUP_TTL_SEC
+
+# --- Метрики защиты от повторной отправки ---
+duplicates_suppressed = metrics.counter("report_duplicates_suppressed_total",
+                                        "Повторных confirm:send, не поставивших заявку в очередь второй раз")
+dedup_keys = metrics.gauge("report_dedup_keys", "Ключей принятых заявок в памяти процесса")
+
+# Поля анкеты, из которых состоит заявка (служебные - трасса, ID сообщений сводки - в ключ не входят)
+_CONTENT_FIELDS = ("complaint_type", "media_type", "media_unique_id", "photo_id", "video_id", "video_note_id",
+                   "description", "rodents", "latitude", "longitude", "address_text", "name",
+                   "wants_feedback", "email", "phone")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_keys (
+    key TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS report_keys_expires_at ON report_keys (expires_at);
+"""
+
+
+def new_session_id() -> str:
+    """ID анкеты: создается в /start и входит в ключ заявки"""
+    return secrets.token_hex(8)
+
+
+def report_key(user_id: int, data: dict) -> str:
+    """Ключ идемпотентности: пользователь, сессия анкеты и хеш ее содержимого"""
+    content = {field: data.get(field) for field in _CONTENT_FIELDS}
+    raw = json.dumps([user_id, data.get("session_id"), content], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class SQLiteDedupBackend:
+    """Ключи в таблице report_keys рядом с анкетами (тот же файл SQLite, общий для процессов-воркеров)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._claims = 0
+
+    def _open(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        db.executescript(_SCHEMA)
+        self._db = db
+
+    def _claim(self, key: str, expires_at: float) -> bool:
+        now = time.time()
+        with self._lock:
+            if self._db is None:
+                self._open()
+            # Вставка или перезапись истекшего ключа; живой ключ не меняется (rowcount = 0)
+            cursor = self._db.execute(
+                "INSERT INTO report_keys (key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE report_keys.expires_at < ?",
+                (key, expires_at, now)
+            )
+            self._claims += 1
+            if self._claims % 1000 == 0:
+                self._db.execute("DELETE FROM report_keys WHERE expires_at < ?", (now,))
+            return cursor.rowcount == 1
+
+    def _release(self, key: str):
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("DELETE FROM report_keys WHERE key = ?", (key,))
+
+    async def claim(self, key: str, expires_at: float) -> bool:
+        return await asyncio.to_thread(self._claim, key, expires_at)
+
+    async def release(self, key: str):
+        await asyncio.to_thread(self._release, key)
+
+    async def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class RedisDedupBackend:
+    """Ключи в Redis-совместимом хранилище: SET NX с истечением, общий для всех процессов и серверов"""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return f"report_sent:{key}"
+
+    async def claim(self, key: str, expires_at: float) -> bool:
+        return bool(await self.redis.set(self._name(key), 1, nx=True, exat=int(expires_at) + 1))
+
+    async def release(self, key: str):
+        await self.redis.delete(self._name(key))
+
+    async def close(self):
+        pass
+
+
+class ReportDedup:
+    """
+    Ключи уже принятых заявок: повторный confirm:send той же анкеты (ретрай колбэка, апдейт, повторно
+    отправленный после падения воркера) не ставит заявку в очередь второй раз.
+    Проверка - по словарю в памяти за O(1), ограниченному ttl и max_keys (вытесняются самые старые).
+    С постоянным хранилищем (backend) ключ еще и записывается туда: дубль узнается и после перезапуска.
+    """
+
+    def __init__(self, ttl: float, max_keys: int, backend=None):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.backend = backend
+        self._keys: OrderedDict[str, float] = OrderedDict()  # ключ -> время истечения, по порядку добавления
+
+    def _cached(self, key: str, now: float) -> bool:
+        expires_at = self._keys.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < now:
+            del self._keys[key]
+            return False
+        return True
+
+    def _remember(self, key: str, expires_at: float):
+        self._keys[key] = expires_at
+        while len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+        dedup_keys.set(len(self._keys))
+
+    async def claim(self, key: str) -> bool:
+        """True - заявка с этим ключом еще не принималась и теперь считается принятой"""
+        now = time.time()
+        if self._cached(key, now):
+            duplicates_suppressed.inc()
+            return False
+        expires_at = now + self.ttl
+        self._remember(key, expires_at)
+        if self.backend is None:
+            return True
+        try:
+            first = await self.backend.claim(key, expires_at)
+        except Exception as e:
+            # Лучше возможный дубль, чем потерянная заявка
+            logging.warning(f"Не удалось проверить ключ заявки в хранилище, проверка только в памяти: {e}")
+            return True
+        if not first:
+            duplicates_suppressed.inc()
+        return first
+
+    async def release(self, key: str):
+        """Заявку не удалось поставить в очередь: повторное нажатие должно пройти"""
+        self._keys.pop(key, None)
+        dedup_keys.set(len(self._keys))
+        if self.backend is not None:
+            try:
+                await self.backend.release(key)
+            except Exception as e:
+                logging.warning(f"Не удалось удалить ключ заявки из хранилища: {e}")
+
+    async def close(self):
+        if self.backend is not None:
+            await self.backend.close()
+
+
+def create_report_dedup() -> ReportDedup:
+    """Ключи хранятся там же, где анкеты: с FSM_STORAGE=memory - только в памяти"""
+    backend = None
+    if FSM_STORAGE == "sqlite":
+        backend = SQLiteDedupBackend(FSM_SQLITE_PATH)
+    elif FSM_STORAGE == "redis":
+        try:
+            from redis.asyncio import Redis
+        except ImportError:
+            raise RuntimeError("Для FSM_STORAGE=redis установите пакет redis: pip install redis")
+        backend = RedisDedupBackend(Redis.from_url(REDIS_URL))
+    return ReportDedup(REPORT_DEDUP_TTL_SEC, REPORT_DEDUP_MAX_KEYS, backend)
+
+
+report_dedup = create_report_dedup()
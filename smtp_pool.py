@@ -0,0 +1,233 @@
+# file: smtp_pool.py
+import asyncio
+import logging
+import smtplib
+import threading
+import time
+from collections import deque
+
+import metrics
+from email_stream import StreamingEmail
+
+# --- Метрики пула ---
+connections_opened = metrics.counter("smtp_pool_connections_opened_total", "Открыто SMTP-соединений")
+connections_closed = metrics.counter("smtp_pool_connections_closed_total", "Закрыто SMTP-соединений")
+reconnects = metrics.counter("smtp_pool_reconnects_total", "Переподключений после разрыва")
+messages_sent = metrics.counter("smtp_pool_messages_sent_total", "Отправлено писем через пул")
+keepalive_noops = metrics.counter("smtp_pool_keepalive_noops_total", "Отправлено NOOP для поддержания соединений")
+connections_idle = metrics.gauge("smtp_pool_connections_idle", "Свободных соединений в пуле")
+connections_in_use = metrics.gauge("smtp_pool_connections_in_use", "Занятых соединений пула")
+
+
+class _TrackedSMTP:
+    """Отмечает начало передачи письма (DATA): после этого разрыв не значит, что сервер его не принял"""
+    data_sent = False
+
+    def data(self, msg):
+        self.data_sent = True
+        return super().data(msg)
+
+
+class _SMTP(_TrackedSMTP, smtplib.SMTP):
+    pass
+
+
+class _SMTP_SSL(_TrackedSMTP, smtplib.SMTP_SSL):
+    pass
+
+
+def _send_data_streaming(conn: smtplib.SMTP, message: StreamingEmail):
+    """MAIL FROM / RCPT TO / DATA, где тело письма пишется в сокет чанками"""
+    code, resp = conn.mail(message.sender)
+    if code != 250:
+        conn.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, message.sender)
+    code, resp = conn.rcpt(message.recipient)
+    if code not in (250, 251):
+        conn.rset()
+        raise smtplib.SMTPRecipientsRefused({message.recipient: (code, resp)})
+    code, resp = conn.docmd("data")
+    if code != 354:
+        conn.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    conn.data_sent = True
+    try:
+        for chunk in message.iter_data():
+            conn.sock.sendall(chunk)
+        conn.sock.sendall(b".\r\n")
+    except OSError:
+        conn.close()
+        raise smtplib.SMTPServerDisconnected("Соединение разорвано во время передачи письма")
+    code, resp = conn.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+
+
+class SMTPConnectionPool:
+    """
+    Пул постоянных SMTP-соединений.
+    Соединение открывается (TLS + логин) один раз и переиспользуется для следующих писем.
+    Методы блокирующие: вызывать через asyncio.to_thread.
+    """
+
+    def __init__(self, host: str, port: int, username: str | None, password: str | None,
+                 size: int = 2, security: str = "ssl", timeout: float = 30.0,
+                 keepalive_interval: float = 60.0, max_idle: float = 300.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.security = security
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.max_idle = max_idle
+
+        self._idle: deque[tuple[smtplib.SMTP, float]] = deque()  # (соединение, время последнего использования)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    # --- Работа с соединениями ---
+    def _connect(self) -> smtplib.SMTP:
+        if self.security == "ssl":
+            conn = _SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            conn = _SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == "starttls":
+                conn.starttls()
+        conn.ehlo_or_helo_if_needed()
+        # Локальные тестовые серверы (aiosmtpd) обычно не объявляют AUTH
+        if self.username and self.password and conn.has_extn("auth"):
+            conn.login(self.username, self.password)
+        connections_opened.inc()
+        return conn
+
+    @staticmethod
+    def _close(conn: smtplib.SMTP):
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+        connections_closed.inc()
+
+    @staticmethod
+    def _is_alive(conn: smtplib.SMTP) -> bool:
+        try:
+            keepalive_noops.inc()
+            return conn.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def _acquire(self) -> smtplib.SMTP:
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, last_used = self._idle.pop()
+                    connections_idle.set(len(self._idle))
+                idle_for = time.monotonic() - last_used
+                if idle_for > self.max_idle:
+                    self._close(conn)
+                    continue
+                # Давно не использовалось: проверяем, что сервер нас еще не отключил
+                if idle_for > self.keepalive_interval and not self._is_alive(conn):
+                    self._close(conn)
+                    continue
+                connections_in_use.inc()
+                return conn
+            conn = self._connect()
+            connections_in_use.inc()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: smtplib.SMTP | None):
+        connections_in_use.dec()
+        if conn is not None:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+                connections_idle.set(len(self._idle))
+        self._slots.release()
+
+    # --- Публичный интерфейс ---
+    def _send(self, deliver):
+        conn = self._acquire()
+        try:
+            try:
+                conn.data_sent = False
+                deliver(conn)
+            except smtplib.SMTPServerDisconnected:
+                # Письмо уже передавалось: сервер мог его принять, повтор отправил бы его дважды.
+                # Решает очередь доставки
+                if conn.data_sent:
+                    raise
+                # Сервер закрыл соединение, пока оно лежало в пуле: одна попытка переподключиться
+                logging.info("SMTP-соединение разорвано сервером, переподключаемся...")
+                reconnects.inc()
+                conn.close()
+                conn = self._connect()
+                deliver(conn)
+            messages_sent.inc()
+        except Exception:
+            self._close(conn)
+            self._release(None)
+            raise
+        self._release(conn)
+
+    def send_message(self, msg):
+        self._send(lambda conn: conn.send_message(msg))
+
+    def send_streaming(self, message: StreamingEmail):
+        """Отправляет письмо, записывая его в сокет по частям (без сборки всего письма в памяти)"""
+        self._send(lambda conn: _send_data_streaming(conn, message))
+
+    def keepalive(self):
+        """Отправляет NOOP свободным соединениям и закрывает слишком долго простаивающие"""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        now = time.monotonic()
+        alive = []
+        for conn, last_used in idle:
+            if now - last_used > self.max_idle or not self._is_alive(conn):
+                self._close(conn)
+            else:
+                alive.append((conn, last_used))
+        with self._lock:
+            # Соединения, вернувшиеся в пул во время проверки, остаются в конце очереди
+            self._idle.extendleft(reversed(alive))
+            connections_idle.set(len(self._idle))
+
+    def close(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+            connections_idle.set(0)
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": int(connections_idle.value),
+            "in_use": int(connections_in_use.value),
+            "opened": int(connections_opened.value),
+            "closed": int(connections_closed.value),
+            "reconnects": int(reconnects.value),
+            "sent": int(messages_sent.value),
+        }
+
+
+async def run_keepalive(pool: SMTPConnectionPool):
+    """Фоновая задача: периодический NOOP для свободных соединений пула"""
+    while True:
+        await asyncio.sleep(pool.keepalive_interval)
+        try:
+            await asyncio.to_thread(pool.keepalive)
+        except Exception as e:
+            logging.warning(f"Ошибка keepalive SMTP-пула: {e}")
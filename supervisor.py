@@ -0,0 +1,504 @@
+# file: supervisor.py
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import metrics
+from config import (DROP_PENDING_UPDATES, FSM_STORAGE, METRICS_ENABLED, METRICS_PORT, TRACE_EXPORT_PATH,
+                    TRACING_ENABLED, WORKER_DRAIN_TIMEOUT_SEC, WORKER_MAX_RESTARTS_PER_MIN)
+from delivery_queue import delivery_queue
+from fsm_storage import create_event_isolation, create_storage
+from handlers import router as main_router
+from metrics_server import start_metrics_server
+from middlewares import setup_middlewares
+from report_dedup import report_dedup
+from tracing import exporter as trace_exporter
+
+# --- Метрики супервизора ---
+updates_routed = metrics.counter("supervisor_updates_routed_total", "Апдейтов, отправленных воркерам")
+updates_redelivered = metrics.counter("supervisor_updates_redelivered_total",
+                                      "Апдейтов, повторно отправленных после падения воркера")
+updates_dropped = metrics.counter("supervisor_updates_dropped_total",
+                                  "Апдейтов, отброшенных после нескольких падений обрабатывавших их воркеров")
+updates_pending = metrics.gauge("supervisor_updates_pending", "Апдейтов, отправленных воркерам и еще не обработанных")
+worker_restarts = metrics.counter("supervisor_worker_restarts_total", "Перезапусков упавших воркеров")
+workers_alive = metrics.gauge("supervisor_workers_alive", "Воркеров, готовых принимать апдейты")
+
+# Сколько раз апдейт отправляется заново, прежде чем считаться причиной падений
+MAX_REDELIVERIES = 2
+# Пауза перед перезапуском воркера, выведенного из кольца: удваивается с каждым выводом, не больше потолка
+RETIRE_BACKOFF_SEC = 60.0
+RETIRE_BACKOFF_MAX_SEC = 600.0
+
+
+# --- Распределение пользователей ---
+class HashRing:
+    """
+    Консистентное хеширование: у каждого воркера replicas точек на кольце, ключ достается ближайшей точке.
+    При удалении воркера к другим переходят только его пользователи, остальные остаются на месте.
+    """
+
+    def __init__(self, nodes=(), replicas: int = 100):
+        self.replicas = replicas
+        self._points: list[int] = []
+        self._owners: list[int] = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def add(self, node: int):
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}:{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node: int):
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    @property
+    def nodes(self) -> set[int]:
+        return set(self._owners)
+
+    def node_for(self, key: int) -> int:
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        return self._owners[index]
+
+
+def routing_key(raw: dict) -> int:
+    """ID пользователя из апдейта (from у сообщения, колбэка...); без пользователя - ID чата или апдейта"""
+    for key, value in raw.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat")
+        if chat:
+            return chat["id"]
+    return raw["update_id"]
+
+
+def _start_reader(source, loop: asyncio.AbstractEventLoop, callback: Callable[[Any], None], name: str):
+    """Поток, который читает очередь multiprocessing и передает сообщения в цикл asyncio (None - конец)"""
+    def read():
+        while True:
+            message = source.get()
+            try:
+                loop.call_soon_threadsafe(callback, message)
+            except RuntimeError:
+                return  # Цикл уже закрыт
+            if message is None:
+                return
+    threading.Thread(target=read, name=name, daemon=True).start()
+
+
+@contextmanager
+def _environ(overrides: dict[str, str]):
+    # Дочерний процесс (spawn) получает копию окружения на момент запуска и читает config заново
+    saved = {key: os.environ.get(key) for key in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+# --- Процесс-воркер ---
+def _worker_main(slot: int, inbox, outbox, bot_factory: Callable[[float], Bot], rate_share: float):
+    # Остановкой управляет супервизор: Ctrl+C из терминала приходит всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"%(levelname)s:worker{slot}:%(name)s:%(message)s")
+    asyncio.run(_run_worker(slot, inbox, outbox, bot_factory, rate_share))
+
+
+async def _flush_storage(storage):
+    """Дожидается записи буфера хранилища (SQLite) на диск; при ошибке - повтор, пока запись не пройдет"""
+    flush = getattr(storage, "flush", None)
+    if flush is None:
+        return
+    delay = 1.0
+    while True:
+        try:
+            await flush()
+            return
+        except Exception as e:
+            logging.error(f"Анкеты не сохранены ({type(e).__name__}: {e}), повтор через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+async def _handle(dp: Dispatcher, bot: Bot, update_id: int, raw: dict, outbox, slot: int):
+    try:
+        await dp.feed_update(bot, Update.model_validate(raw, context={"bot": bot}))
+    except Exception:
+        logging.exception(f"Ошибка обработки апдейта {update_id}")
+    finally:
+        # Подтверждение - только после записи анкеты: если воркер упадет после done, апдейт не отправят заново,
+        # и изменения анкеты из буфера записи пропали бы вместе с процессом
+        await _flush_storage(dp.storage)
+        outbox.put(("done", slot, update_id))
+
+
+async def _run_worker(slot: int, inbox, outbox, bot_factory: Callable[[float], Bot], rate_share: float):
+    """
+    Воркер обрабатывает апдейты своих пользователей настоящим Dispatcher с общим постоянным хранилищем анкет.
+    Готовые заявки он только ставит в общую очередь доставки, отправляет их супервизор.
+    """
+    bot = bot_factory(rate_share)
+    storage = create_storage()
+    dp = Dispatcher(storage=storage, events_isolation=create_event_isolation(storage))
+    dp.include_router(main_router)
+    setup_middlewares(dp)
+    await delivery_queue.start(consume=False)
+    metrics_server = await start_metrics_server() if METRICS_ENABLED else None
+    trace_export_task = asyncio.create_task(trace_exporter.run()) if TRACING_ENABLED else None
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    tasks: set[asyncio.Task] = set()
+
+    def on_message(message):
+        if message is None:
+            stopping.set()
+            return
+        update_id, raw = message
+        task = asyncio.create_task(_handle(dp, bot, update_id, raw, outbox, slot))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    _start_reader(inbox, loop, on_message, f"worker{slot}-inbox")
+    outbox.put(("ready", slot, os.getpid()))
+    try:
+        await stopping.wait()
+        # Супервизор присылает None, когда все отправленные апдейты уже обработаны; на всякий случай - дожидаемся
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        # Закрытие SQLite-хранилища сбрасывает буфер записи анкет на диск
+        await dp.storage.close()
+        await delivery_queue.stop()
+        await report_dedup.close()
+        if metrics_server:
+            await metrics_server.cleanup()
+        if trace_export_task:
+            trace_export_task.cancel()
+            await trace_exporter.flush()
+        await bot.session.close()
+
+
+# --- Супервизор ---
+@dataclass
+class _Worker:
+    slot: int
+    process: Any = None
+    inbox: Any = None
+    ready: bool = False
+    retired: bool = False
+    retirements: int = 0
+    crashes: deque = field(default_factory=deque)
+    # Апдейты пользователей воркера, которые еще обрабатывают соседи (после возвращения в кольцо)
+    waiting: set = field(default_factory=set)
+
+
+@dataclass
+class _Pending:
+    raw: dict
+    slot: int
+    future: asyncio.Future
+    redeliveries: int = 0
+
+
+class Supervisor:
+    """
+    Запускает workers процессов и раздает им апдейты по консистентному хешу from_user.id:
+    все апдейты пользователя обрабатывает один воркер, поэтому переходы его анкеты идут по порядку.
+
+    Каждый апдейт ждет подтверждения от воркера. Если воркер упал, супервизор перезапускает его
+    и отправляет заново неподтвержденные апдейты (новые апдейты его пользователей ждут запуска).
+    Если воркер падает слишком часто, он выводится из кольца и его пользователи переходят к остальным;
+    после паузы (растет с каждым выводом) воркер запускается снова и возвращается в кольцо.
+    """
+
+    def __init__(self, workers: int, bot_factory: Callable[[float], Bot], rate_share: float,
+                 max_pending: int = 1000, max_restarts: int = WORKER_MAX_RESTARTS_PER_MIN):
+        self.bot_factory = bot_factory
+        self.rate_share = rate_share
+        self.max_restarts = max_restarts
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._workers = [_Worker(slot) for slot in range(workers)]
+        self.ring = HashRing(range(workers))
+        self._pending: dict[int, _Pending] = {}
+        self._capacity = asyncio.Semaphore(max_pending)
+        self._idle = asyncio.Event()
+        self._ready = asyncio.Event()
+        self._stopping = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def _overrides(self, slot: int) -> dict[str, str]:
+        overrides = {
+            # Анкеты пользователя должны пережить перезапуск воркера и переезд к другому воркеру
+            "FSM_STORAGE": "sqlite" if FSM_STORAGE == "memory" else FSM_STORAGE,
+            # Индекс кэша медиа у каждого процесса свой: скачанное воркером супервизор все равно скачает заново
+            "MEDIA_PREFETCH_ENABLED": "false",
+            "METRICS_PORT": str(METRICS_PORT + 1 + slot),
+        }
+        root, extension = os.path.splitext(TRACE_EXPORT_PATH)
+        overrides["TRACE_EXPORT_PATH"] = f"{root}.worker{slot}{extension}"
+        return overrides
+
+    def _spawn(self, worker: _Worker):
+        if self._stopping:
+            return
+        worker.inbox = self._context.Queue()
+        worker.process = self._context.Process(
+            target=_worker_main, name=f"bot-worker-{worker.slot}",
+            args=(worker.slot, worker.inbox, self._outbox, self.bot_factory, self.rate_share),
+        )
+        with _environ(self._overrides(worker.slot)):
+            worker.process.start()
+        self._loop.add_reader(worker.process.sentinel, self._on_exit, worker)
+
+    async def start(self, timeout: float = 120.0):
+        self._loop = asyncio.get_running_loop()
+        if FSM_STORAGE == "memory":
+            logging.warning("FSM_STORAGE=memory не подходит для нескольких воркеров: воркеры используют SQLite")
+        _start_reader(self._outbox, self._loop, self._on_message, "supervisor-outbox")
+        for worker in self._workers:
+            self._spawn(worker)
+        await asyncio.wait_for(self._ready.wait(), timeout)
+        logging.info(f"Супервизор: запущено воркеров - {len(self._workers)}")
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    # --- Отправка апдейтов ---
+    async def submit(self, raw: dict) -> asyncio.Future:
+        """Отправляет апдейт воркеру; ждет, если воркерам уже отдано max_pending апдейтов"""
+        await self._capacity.acquire()
+        return self._dispatch(raw)
+
+    def _dispatch(self, raw: dict) -> asyncio.Future:
+        future = self._loop.create_future()
+        pending = _Pending(raw, self.ring.node_for(routing_key(raw)), future)
+        self._pending[raw["update_id"]] = pending
+        updates_pending.inc()
+        self._idle.clear()
+        self._send(pending)
+        return future
+
+    def _send(self, pending: _Pending):
+        worker = self._workers[pending.slot]
+        updates_routed.inc()
+        # Пока воркер перезапускается (или соседи дообрабатывают апдейты его пользователей),
+        # апдейт ждет в _pending и уйдет после его готовности
+        if worker.ready and not worker.waiting:
+            worker.inbox.put((pending.raw["update_id"], pending.raw))
+
+    def _finish(self, update_id: int, handled: bool):
+        pending = self._pending.pop(update_id, None)
+        if pending is None:
+            return
+        updates_pending.dec()
+        self._capacity.release()
+        if not pending.future.done():
+            pending.future.set_result(handled)
+        for worker in self._workers:
+            if update_id in worker.waiting:
+                worker.waiting.discard(update_id)
+                self._release(worker)
+        if not self._pending:
+            self._idle.set()
+
+    def _owned_by(self, slot: int) -> list[_Pending]:
+        return [pending for pending in self._pending.values() if pending.slot == slot]
+
+    def _release(self, worker: _Worker):
+        """Отправляет готовому воркеру накопившиеся апдейты, если он больше ничего не ждет (по порядку)"""
+        if worker.ready and not worker.waiting:
+            for pending in self._owned_by(worker.slot):
+                worker.inbox.put((pending.raw["update_id"], pending.raw))
+
+    def _rejoin(self, worker: _Worker):
+        # Пользователи возвращаются к воркеру сразу, но их новые апдейты он получит, когда соседи обработают
+        # уже отправленные им: иначе апдейты одного пользователя обрабатывали бы два процесса одновременно
+        worker.retired = False
+        self.ring.add(worker.slot)
+        for update_id, pending in self._pending.items():
+            if pending.slot != worker.slot and self.ring.node_for(routing_key(pending.raw)) == worker.slot:
+                worker.waiting.add(update_id)
+        logging.info(f"Воркер {worker.slot} возвращен в кольцо")
+
+    # --- Сообщения от воркеров ---
+    def _on_message(self, message):
+        if message is None:
+            return
+        kind, slot, value = message
+        if kind == "done":
+            self._finish(value, True)
+        elif kind == "ready":
+            worker = self._workers[slot]
+            worker.ready = True
+            workers_alive.set(sum(w.ready for w in self._workers))
+            logging.info(f"Воркер {slot} готов (pid {value})")
+            if worker.retired:
+                self._rejoin(worker)
+            # Неподтвержденные апдейты упавшего воркера и накопившиеся за время перезапуска - по порядку
+            self._release(worker)
+            if all(w.ready or w.retired for w in self._workers):
+                self._ready.set()
+
+    def _on_exit(self, worker: _Worker):
+        self._loop.remove_reader(worker.process.sentinel)
+        # Новые апдейты больше не уходят в очередь упавшего процесса
+        worker.ready = False
+        workers_alive.set(sum(w.ready for w in self._workers))
+        task = self._loop.create_task(self._after_exit(worker))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _after_exit(self, worker: _Worker):
+        # Сигнал sentinel приходит чуть раньше, чем процесс можно забрать: join почти не ждет, но не в цикле событий
+        await asyncio.to_thread(worker.process.join, 1.0)
+        exitcode = worker.process.exitcode
+        if self._stopping:
+            return
+
+        now = time.monotonic()
+        worker.crashes.append(now)
+        while worker.crashes and worker.crashes[0] < now - 60:
+            worker.crashes.popleft()
+        lost = self._owned_by(worker.slot)
+        logging.error(f"Воркер {worker.slot} завершился с кодом {exitcode}, неподтвержденных апдейтов: {len(lost)}")
+
+        # Апдейт, который раз за разом роняет воркеры, отбрасывается, чтобы не ронять их дальше
+        for pending in lost:
+            pending.redeliveries += 1
+            if pending.redeliveries > MAX_REDELIVERIES:
+                updates_dropped.inc()
+                logging.error(f"Апдейт {pending.raw['update_id']} отброшен после {MAX_REDELIVERIES} повторных отправок")
+                self._finish(pending.raw["update_id"], False)
+            else:
+                updates_redelivered.inc()
+
+        if len(worker.crashes) >= self.max_restarts and len(self.ring.nodes) > 1:
+            # Перебалансировка: пользователи воркера переходят к соседям по кольцу вместе с их апдейтами
+            worker.retired = True
+            worker.retirements += 1
+            worker.waiting.clear()
+            self.ring.remove(worker.slot)
+            delay = min(RETIRE_BACKOFF_MAX_SEC, RETIRE_BACKOFF_SEC * 2 ** (worker.retirements - 1))
+            logging.error(f"Воркер {worker.slot} упал {len(worker.crashes)} раз за минуту и выведен из работы "
+                          f"на {delay:.0f} с, его пользователи переданы остальным воркерам")
+            for pending in self._owned_by(worker.slot):
+                pending.slot = self.ring.node_for(routing_key(pending.raw))
+                target = self._workers[pending.slot]
+                if pending.raw["update_id"] in target.waiting:
+                    # Апдейт пришел к воркеру, который ждал именно его: ждать больше нечего
+                    target.waiting.discard(pending.raw["update_id"])
+                    self._release(target)
+                else:
+                    self._send(pending)
+        else:
+            delay = min(30.0, 2.0 ** (len(worker.crashes) - 1))
+
+        worker_restarts.inc()
+        logging.info(f"Перезапуск воркера {worker.slot} через {delay:.0f} с")
+        self._loop.call_later(delay, self._spawn, worker)
+
+    # --- Остановка ---
+    async def wait_idle(self):
+        """Ждет, пока все отправленные апдейты будут обработаны"""
+        while self._pending:
+            await self._idle.wait()
+
+    async def stop(self, timeout: float = WORKER_DRAIN_TIMEOUT_SEC):
+        try:
+            await asyncio.wait_for(self.wait_idle(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Воркеры не обработали {self.pending} апдейтов за {timeout:.0f} с")
+        self._stopping = True
+        running = [w for w in self._workers if w.process is not None and w.process.is_alive()]
+        for worker in running:
+            self._loop.remove_reader(worker.process.sentinel)
+            worker.inbox.put(None)
+        await asyncio.gather(*(asyncio.to_thread(w.process.join, timeout) for w in running))
+        for worker in running:
+            if worker.process.is_alive():
+                logging.warning(f"Воркер {worker.slot} не завершился за {timeout:.0f} с, принудительная остановка")
+                worker.process.terminate()
+        workers_alive.set(0)
+        self._outbox.put(None)
+
+
+# --- Получение апдейтов ---
+async def poll_updates(bot: Bot, supervisor: Supervisor, allowed_updates: list[str], timeout: int = 30):
+    """
+    Long polling getUpdates без разбора апдейтов: супервизор только смотрит на from.id,
+    модели aiogram строит воркер. Подтверждение Telegram (offset) - как в dp.start_polling.
+    """
+    session = await bot.session.create_session()
+    url = bot.session.api.api_url(bot.token, "getUpdates")
+    offset = None
+    backoff = 1.0
+    while True:
+        params = {"timeout": timeout, "allowed_updates": allowed_updates}
+        if offset is not None:
+            params["offset"] = offset
+        try:
+            async with session.post(url, json=params,
+                                    timeout=aiohttp.ClientTimeout(total=timeout + 10)) as response:
+                body = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.warning(f"getUpdates: {type(e).__name__}: {e}, повтор через {backoff:.0f} с")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        if not body.get("ok"):
+            retry_after = (body.get("parameters") or {}).get("retry_after")
+            logging.warning(f"getUpdates: {body.get('description')}")
+            await asyncio.sleep(retry_after or backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = 1.0
+        for raw in body["result"]:
+            offset = raw["update_id"] + 1
+            await supervisor.submit(raw)
+
+
+async def run_supervised_polling(bot: Bot, dp: Dispatcher, bot_factory: Callable[[float], Bot], workers: int):
+    # Доля общего лимита Bot API: поровну между воркерами и супервизором (он отправляет заявки из очереди)
+    supervisor = Supervisor(workers, bot_factory, rate_share=1 / (workers + 1))
+    await supervisor.start()
+    try:
+        await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+        logging.info(f"Поллинг в режиме супервизора, воркеров: {workers}")
+        await poll_updates(bot, supervisor, dp.resolve_used_update_types())
+    finally:
+        await supervisor.stop()
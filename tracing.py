@@ -0,0 +1,193 @@
+# file: tracing.py
+import asyncio
+import json
+import logging
+import os
+import random
+import secrets
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+import metrics
+from config import TRACING_ENABLED, TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH, TRACE_FLUSH_INTERVAL_SEC
+
+# --- Метрики трассировки ---
+spans_recorded = metrics.counter("trace_spans_recorded_total", "Записанных спанов")
+spans_dropped = metrics.counter("trace_spans_dropped_total", "Спанов, отброшенных из-за переполнения буфера")
+traces_started = metrics.counter("traces_started_total", "Начатых трасс (по одной на анкету)")
+traces_sampled = metrics.counter("traces_sampled_total", "Трасс, попавших в выборку")
+
+
+@dataclass
+class SpanContext:
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+
+@dataclass
+class Span:
+    """Открытый спан: атрибуты можно дописать до его завершения"""
+    context: SpanContext
+    attributes: dict = field(default_factory=dict)
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+
+class _NoopSpan:
+    # Для трасс вне выборки: вызывающему коду не нужно проверять, пишется ли спан
+    context = None
+
+    def set(self, key: str, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+# Текущий спан задачи asyncio: вложенные спаны (скачивание, SMTP) становятся его детьми
+_current: ContextVar[SpanContext | None] = ContextVar("trace_span", default=None)
+
+
+def new_trace() -> dict:
+    """
+    Трасса анкеты, создается в cmd_start и хранится в данных FSM (ключ trace), затем - в задачах очереди.
+    Решение о выборке принимается один раз: трасса пишется целиком или не пишется вовсе.
+    """
+    sampled = TRACING_ENABLED and random.random() < TRACE_SAMPLE_RATE
+    traces_started.inc()
+    if sampled:
+        traces_sampled.inc()
+    return {"trace_id": secrets.token_hex(16), "span_id": new_span_id(), "sampled": sampled,
+            "started": time.time()}
+
+
+def context_from(trace: dict | None) -> SpanContext | None:
+    """Контекст корневого спана трассы из данных FSM или задачи очереди"""
+    if not trace:
+        return None
+    return SpanContext(trace["trace_id"], trace["span_id"], trace.get("sampled", False))
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def child_context(parent: SpanContext | None, span_id: str) -> SpanContext | None:
+    return SpanContext(parent.trace_id, span_id, parent.sampled) if parent else None
+
+
+def activate(context: SpanContext | None):
+    return _current.set(context)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def record_span(name: str, parent: SpanContext | None, started: float, ended: float,
+                span_id: str | None = None, error: str | None = None, **attributes):
+    """Спан с уже известными временем начала и конца (unix, секунды)"""
+    if parent is None or not parent.sampled:
+        return
+    exporter.export({
+        "traceId": parent.trace_id,
+        "spanId": span_id or new_span_id(),
+        "parentSpanId": parent.span_id,
+        "name": name,
+        "startTimeUnixNano": int(started * 1e9),
+        "endTimeUnixNano": int(ended * 1e9),
+        "durationMs": round((ended - started) * 1000, 3),
+        "status": "error" if error else "ok",
+        "attributes": {**attributes, **({"error": error} if error else {})},
+    })
+
+
+def record_root(trace: dict, ended: float, **attributes):
+    """Корневой спан заявки (report): от создания трассы в /start до ended"""
+    if not trace.get("sampled"):
+        return
+    exporter.export({
+        "traceId": trace["trace_id"],
+        "spanId": trace["span_id"],
+        "parentSpanId": None,
+        "name": "report",
+        "startTimeUnixNano": int(trace["started"] * 1e9),
+        "endTimeUnixNano": int(ended * 1e9),
+        "durationMs": round((ended - trace["started"]) * 1000, 3),
+        "status": "ok",
+        "attributes": attributes,
+    })
+
+
+@contextmanager
+def span(name: str, parent: SpanContext | None = None, **attributes):
+    """
+    Спан вокруг блока (в том числе с await). Родитель - явно переданный контекст или текущий спан задачи.
+    Вне выборки ничего не записывается и не выделяется.
+    """
+    parent = parent or _current.get()
+    if parent is None or not parent.sampled:
+        yield _NOOP_SPAN
+        return
+    current = Span(child_context(parent, new_span_id()), attributes)
+    token = _current.set(current.context)
+    started = time.time()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        record_span(name, parent, started, time.time(), span_id=current.context.span_id, error=error,
+                    **current.attributes)
+
+
+class JsonlExporter:
+    """
+    Спаны копятся в памяти и пачкой дописываются в JSONL-файл из фонового потока.
+    Поля названы как в OTLP (traceId, spanId, startTimeUnixNano...), чтобы файл можно было загрузить в коллектор.
+    """
+
+    def __init__(self, path: str, max_buffer: int = 10000):
+        self.path = path
+        self._buffer: deque[dict] = deque()
+        self.max_buffer = max_buffer
+
+    def export(self, record: dict):
+        if len(self._buffer) >= self.max_buffer:
+            # Под нагрузкой лучше потерять спаны, чем память
+            spans_dropped.inc()
+            return
+        self._buffer.append(record)
+        spans_recorded.inc()
+
+    def _write(self, records: list[dict]):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        records = list(self._buffer)
+        self._buffer.clear()
+        try:
+            await asyncio.to_thread(self._write, records)
+        except OSError as e:
+            spans_dropped.inc(len(records))
+            logging.warning(f"Не удалось записать {len(records)} спанов в {self.path}: {e}")
+
+    async def run(self, interval: float = TRACE_FLUSH_INTERVAL_SEC):
+        """Фоновая задача: периодический сброс спанов в файл (при остановке бота остаток сбрасывает flush())"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+
+exporter = JsonlExporter(TRACE_EXPORT_PATH)
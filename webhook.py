@@ -0,0 +1,115 @@
+# file: webhook.py
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+import metrics
+from config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+                    WEBHOOK_MAX_CONCURRENCY, WEBHOOK_DRAIN_TIMEOUT_SEC, DROP_PENDING_UPDATES,
+                    MEDIA_LINKS_ENABLED)
+from media_links import setup_media_routes
+
+webhook_updates = metrics.counter("webhook_updates_total", "Апдейтов, полученных через вебхук")
+webhook_in_flight = metrics.gauge("webhook_updates_in_flight", "Апдейтов, обрабатываемых прямо сейчас")
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с ограничением числа одновременно обрабатываемых апдейтов.
+    Ответ Telegram отправляется только после завершения хэндлера: если процесс упадет,
+    Telegram повторит доставку апдейта, и заявка не потеряется.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str | None,
+                 max_concurrency: int, drain_timeout: float, **data):
+        super().__init__(dispatcher, bot, handle_in_background=False, secret_token=secret_token, **data)
+        self.drain_timeout = drain_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def _handle_request(self, bot: Bot, request: web.Request) -> web.Response:
+        async with self._semaphore:
+            webhook_updates.inc()
+            webhook_in_flight.inc()
+            self._in_flight += 1
+            self._idle.clear()
+            try:
+                return await super()._handle_request(bot, request)
+            finally:
+                webhook_in_flight.dec()
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self._idle.set()
+
+    async def close(self) -> None:
+        """
+        Вызывается при остановке приложения. aiohttp запускает on_shutdown раньше,
+        чем дожидается запросов, поэтому сначала сами дожидаемся текущих хэндлеров.
+        Сессию бота закрывает bot.main.
+        """
+        if self._in_flight:
+            logging.info(f"Ожидаем завершения {self._in_flight} апдейтов...")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не дождались {self._in_flight} апдейтов за {self.drain_timeout} с")
+
+
+def create_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """aiohttp-приложение, принимающее апдейты (можно проверить локально, отправив POST с JSON апдейта)"""
+    app = web.Application()
+    handler = LimitedRequestHandler(
+        dp, bot,
+        secret_token=WEBHOOK_SECRET,
+        max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+        drain_timeout=WEBHOOK_DRAIN_TIMEOUT_SEC
+    )
+    handler.register(app, path=WEBHOOK_PATH)
+    if MEDIA_LINKS_ENABLED:
+        setup_media_routes(app)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Запуск бота в режиме вебхука. Останавливается по SIGINT/SIGTERM"""
+    if not WEBHOOK_SECRET:
+        logging.warning("WEBHOOK_SECRET не задан: запросы к вебхуку не проверяются!")
+
+    runner = web.AppRunner(create_webhook_app(dp, bot), shutdown_timeout=WEBHOOK_DRAIN_TIMEOUT_SEC)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        # Вебхук не удаляется при остановке: пока бот перезапускается, Telegram копит апдейты у себя
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),  # Лимит Telegram
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=DROP_PENDING_UPDATES
+        )
+    else:
+        logging.warning("WEBHOOK_URL не задан: вебхук в Telegram не регистрируется (локальный режим)")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows
+
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Остановка вебхука...")
+        await runner.cleanup()